@@ -0,0 +1,295 @@
+"""
+Reproducible benchmark of the extraction pipeline over the bundled `images/` corpus.
+
+    python -m benchmarks.pipeline --mode all --output bench.json
+    python -m benchmarks.pipeline --mode load --concurrency 1,4,16 --limit 100
+    python -m benchmarks.pipeline --mode scheduling --workers 4 --concurrency 1,8 --limit 40
+
+Modes:
+    stages      per-stage latency (download_and_validate against a local file server,
+                img_preprocessing, get_ocr, get_bill) and the full pipeline, run sequentially
+    throughput  images/sec of `InferenceEngine.execute_image` at several concurrency levels
+    load        drives the FastAPI app in-process over ASGI at several concurrency levels
+    all         everything above
+    scheduling  throughput of --workers processes side by side (like gunicorn workers) under each
+                OCR_SCHEDULING policy; "off" runs with the previous defaults (pools sized to the
+                host's cores, unlimited tesseract/OpenCV threads)
+
+Results are printed and optionally written as JSON so runs can be diffed across commits. The result
+cache is disabled so every image really goes through OCR.
+"""
+import os
+
+os.environ.setdefault("RESULT_CACHE_ENABLED", "false")
+os.environ.setdefault("LOG_ENV", "production")
+
+import argparse
+import asyncio
+import functools
+import http.server
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from loguru import logger
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class FileServer:
+    """
+    The class `FileServer` serves a directory over HTTP on a free local port, standing in for the
+    object store the receipts are normally downloaded from.
+    """
+    def __init__(self, directory):
+        handler = functools.partial(_QuietHandler, directory=directory)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.server.server_port}/{name}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def summarize(samples):
+    """
+    The function `summarize` reduces latency samples (seconds) to count/mean/p50/p95/p99/max in ms.
+
+    :param samples: The `samples` parameter is a list of durations in seconds
+    :return: a dict of statistics, empty when there are no samples.
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {"count": len(ordered), "mean_ms": statistics.fmean(ordered) * 1000, "p50_ms": pct(50),
+            "p95_ms": pct(95), "p99_ms": pct(99), "max_ms": ordered[-1] * 1000}
+
+
+def peak_rss_mb():
+    """
+    The function `peak_rss_mb` reports the peak resident set size of this process and of its reaped
+    children (the tesseract subprocesses), in MB.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {"self_mb": round(own, 1), "children_mb": round(children, 1)}
+
+
+def list_images(directory, limit):
+    names = sorted(name for name in os.listdir(directory) if not name.startswith("."))
+    return names[:limit] if limit else names
+
+
+def _timed_call(samples, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        samples.append(time.perf_counter() - start)
+
+
+def bench_stages(engine, server, names):
+    """
+    The function `bench_stages` runs each image through every stage sequentially and records the
+    latency of each stage separately, plus the end-to-end time.
+
+    :return: a dict of per-stage latency summaries and the error count.
+    """
+    stages = {"download_and_validate": [], "img_preprocessing": [], "get_ocr": [], "get_bill": [], "pipeline": []}
+    errors = 0
+    for name in names:
+        start = time.perf_counter()
+        try:
+            file_bytes, ext, pages = _timed_call(stages["download_and_validate"], engine.download_and_validate, server.url(name))
+            image = _timed_call(stages["img_preprocessing"], engine.img_preprocessing, file_bytes)
+            text = _timed_call(stages["get_ocr"], engine.get_ocr, image)
+            _timed_call(stages["get_bill"], engine.get_bill, text)
+        except Exception as e:
+            errors += 1
+            logger.warning(f"{name} failed --- {e}")
+            continue
+        stages["pipeline"].append(time.perf_counter() - start)
+    result = {stage: summarize(samples) for stage, samples in stages.items()}
+    result["errors"] = errors
+    return result
+
+
+async def _drive(names, concurrency, call):
+    slots = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(name):
+        nonlocal errors
+        async with slots:
+            start = time.perf_counter()
+            try:
+                await call(name)
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(name) for name in names))
+    elapsed = time.perf_counter() - start
+    return {"concurrency": concurrency, "images": len(names), "errors": errors, "elapsed_sec": elapsed,
+            "images_per_sec": len(names) / elapsed, "latency": summarize(latencies)}
+
+
+def bench_throughput(server, names, levels):
+    """
+    The function `bench_throughput` measures images/sec of `InferenceEngine.execute_image` (with the
+    configured execution mode and pools) at each concurrency level.
+    """
+    from src.inferenceEngine import InferenceEngine
+
+    async def call(name):
+        await InferenceEngine(f"bench-{name}").execute_image({"img_url": [server.url(name)]})
+
+    async def run():
+        return [await _drive(names, level, call) for level in levels]
+
+    return asyncio.run(run())
+
+
+def bench_load(server, names, levels):
+    """
+    The function `bench_load` drives the FastAPI app in-process through an ASGI transport, so the
+    measurement includes validation, middleware and serialization but no network or gunicorn.
+    """
+    import httpx
+    from src.app import app
+
+    async def run():
+        results = []
+        async with httpx.AsyncClient(app=app, base_url="http://bench", timeout=None) as client:
+            async def call(name):
+                response = await client.post("/ai/extraction/receipt", json={"img_url": [server.url(name)]})
+                if response.status_code != 200:
+                    raise RuntimeError(response.status_code)
+
+            for level in levels:
+                results.append(await _drive(names, level, call))
+        return results
+
+    return asyncio.run(run())
+
+
+def bench_scheduling(args, levels):
+    """
+    The function `bench_scheduling` compares the `OCR_SCHEDULING` policies. Thread limits are fixed
+    when a process loads tesseract, so every policy and level runs in fresh processes: `--workers` of
+    them at once, each told it shares the cores with the others (WEB_CONCURRENCY) and each driving
+    `execute_image` over the images at the given concurrency.
+
+    :return: a dict of policy -> list of per-level results with the combined images/sec.
+    """
+    results = {}
+    for policy in args.policies.split(","):
+        env = dict(os.environ, OCR_SCHEDULING=policy, WEB_CONCURRENCY=str(args.workers))
+        if policy == "off":
+            # the previous defaults: every worker sized its pools to all of the host's cores
+            env.setdefault("OCR_CONCURRENCY", str(os.cpu_count()))
+            env.setdefault("PREPROCESS_CONCURRENCY", str(os.cpu_count()))
+        results[policy] = []
+        for level in levels:
+            with tempfile.TemporaryDirectory() as tmp:
+                outputs = [os.path.join(tmp, f"{worker}.json") for worker in range(args.workers)]
+                command = [sys.executable, "-m", "benchmarks.pipeline", "--mode", "throughput", "--images", args.images,
+                           "--limit", str(args.limit), "--concurrency", str(level)]
+                procs = [subprocess.Popen(command + ["--output", output], cwd=REPO_ROOT, env=env,
+                                          stdout=subprocess.DEVNULL) for output in outputs]
+                for proc in procs:
+                    proc.wait()
+                reports = [json.load(open(output)) for output in outputs if os.path.exists(output)]
+            runs = [report["throughput"][0] for report in reports]
+            images = sum(run["images"] - run["errors"] for run in runs)
+            # the processes start together; interpreter start-up is left out of the measurement
+            elapsed = max((run["elapsed_sec"] for run in runs), default=float("inf"))
+            results[policy].append({
+                "concurrency": level, "workers": args.workers, "images": images,
+                "errors": sum(run["errors"] for run in runs) + args.workers - len(runs),
+                "images_per_sec": images / elapsed,
+                "p50_ms": statistics.median(run["latency"].get("p50_ms", 0) for run in runs) if runs else None,
+                "ocr_concurrency": reports[0]["environment"]["ocr_concurrency"] if reports else None})
+            logger.warning(f"{policy} | {args.workers} workers x concurrency {level} | "
+                           f"{results[policy][-1]['images_per_sec']:.2f} images/sec")
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    from src import config
+    return {"commit": commit, "python": platform.python_version(), "machine": platform.machine(),
+            "cpu_count": os.cpu_count(), "available_cpus": config.CPU_COUNT, "worker_cpus": config.WORKER_CPUS,
+            "execution_mode": config.EXECUTION_MODE, "stage_pool_kind": config.STAGE_POOL_KIND,
+            "ocr_backend": config.OCR_BACKEND, "ocr_scheduling": config.OCR_SCHEDULING,
+            "ocr_concurrency": config.OCR_CONCURRENCY, "ocr_max_threads": config.OCR_MAX_THREADS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the receipt extraction pipeline.")
+    parser.add_argument("--mode", choices=["stages", "throughput", "load", "all", "scheduling"], default="stages")
+    parser.add_argument("--images", default=os.path.join(REPO_ROOT, "images"))
+    parser.add_argument("--limit", type=int, default=0, help="only use the first N images")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="comma separated concurrency levels")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--workers", type=int, default=2, help="processes run side by side in scheduling mode")
+    parser.add_argument("--policies", default="off,throughput,latency,adaptive",
+                        help="comma separated OCR_SCHEDULING policies compared in scheduling mode")
+    args = parser.parse_args(argv)
+
+    # the src modules configure logging on import; import them first, then quieten the output
+    from src.inferenceEngine import InferenceEngine
+    import src.app
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    names = list_images(args.images, args.limit)
+    levels = [int(level) for level in args.concurrency.split(",")]
+    report = {"environment": environment(), "images": len(names)}
+    if args.mode == "scheduling":
+        report["scheduling"] = bench_scheduling(args, levels)
+    with FileServer(args.images) as server:
+        if args.mode in ("stages", "all"):
+            report["stages"] = bench_stages(InferenceEngine("bench"), server, names)
+        if args.mode in ("throughput", "all"):
+            report["throughput"] = bench_throughput(server, names, levels)
+        if args.mode in ("load", "all"):
+            report["load"] = bench_load(server, names, levels)
+    report["peak_rss"] = peak_rss_mb()
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""
+Compares the single-pass total extraction (`src.totals.extract_total`) with the legacy `get_bill`
+regex loops on OCR text from the `images/` corpus, for speed and agreement.
+
+    python -m benchmarks.totals --save-texts texts.json      # OCR the corpus once and keep the text
+    python -m benchmarks.totals --texts texts.json --repeat 50
+
+OCR dominates the cost of building the texts, so `--texts` lets later runs reuse them.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from loguru import logger
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy_get_bill(ocr_text):
+    """`InferenceEngine.get_bill` as it was before the single-pass rewrite, kept verbatim for comparison."""
+    k=[]
+    k.append(ocr_text.split('\n'))
+    for i in k:
+      j=0
+      while j<len(i):
+          result1=re.search(r"subtotal", i[j].lower())
+          result2=re.search(r"total", i[j].lower())
+          result3=re.search(r"amount", i[j].lower())
+          result4=re.search(r"cash", i[j].lower())
+          if result1==None and result2==None and result3==None:
+            i.pop(j)
+          else:
+            j=j+1
+    final=[]
+    for i in range(len(k)):
+      for_this=[]
+      for j in range(len(k[i])):
+        result=re.findall(r"\d+\.\d+",k[i][j])
+        if len(result)>0:
+          for_this.append(float(result[0]))
+      if len(for_this)==0:
+        final.append(0)
+      else:
+        final.append(max(for_this))
+    for i in range(len(final)):
+      if final[i]==0:
+        final[i]=sum(final)/len(final)
+    return final[0]
+
+
+def ocr_corpus(directory, limit):
+    """
+    The function `ocr_corpus` preprocesses and OCRs every image with the configured backend.
+
+    :return: a dict of file name -> OCR text (undecodable files are skipped).
+    """
+    from src.inferenceEngine import InferenceEngine
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    engine = InferenceEngine("bench-totals")
+    names = sorted(os.listdir(directory))
+    texts = {}
+    for name in names[:limit] if limit else names:
+        with open(os.path.join(directory, name), "rb") as f:
+            file_bytes = f.read()
+        try:
+            texts[name] = engine.get_ocr(engine.img_preprocessing(file_bytes))
+        except Exception as e:
+            logger.warning(f"{name} skipped --- {e}")
+    return texts
+
+
+def time_parser(parser, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            parser(text)
+    return (time.perf_counter() - start) / (repeat * len(texts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare total extraction against the legacy get_bill.")
+    parser.add_argument("--images", default=os.path.join(REPO_ROOT, "images"))
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--texts", help="reuse OCR texts saved by --save-texts")
+    parser.add_argument("--save-texts", help="write the OCR texts to this JSON file")
+    parser.add_argument("--repeat", type=int, default=20, help="parse the corpus this many times for timing")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    if args.texts:
+        with open(args.texts) as f:
+            texts = json.load(f)
+    else:
+        texts = ocr_corpus(args.images, args.limit)
+    if args.save_texts:
+        with open(args.save_texts, "w") as f:
+            json.dump(texts, f)
+
+    from src.totals import extract_total
+    new_parser = lambda text: extract_total(text).total
+    values = list(texts.values())
+    disagreements = []
+    found = {"legacy": 0, "single_pass": 0}
+    for name, text in texts.items():
+        old, new = legacy_get_bill(text), new_parser(text)
+        found["legacy"] += bool(old)
+        found["single_pass"] += bool(new)
+        if abs(old - new) > 1e-9:
+            disagreements.append({"image": name, "legacy": old, "single_pass": new})
+
+    legacy_sec = time_parser(legacy_get_bill, values, args.repeat)
+    new_sec = time_parser(new_parser, values, args.repeat)
+    report = {
+        "texts": len(values),
+        "agreement": 1 - len(disagreements) / len(values) if values else None,
+        "totals_found": found,
+        "legacy_us_per_text": legacy_sec * 1e6,
+        "single_pass_us_per_text": new_sec * 1e6,
+        "speedup": legacy_sec / new_sec if new_sec else None,
+        "disagreements": disagreements,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Admission control for the extraction endpoints: per-client rate limits and request deadlines.
+
+Concurrency itself is bounded by the "admission" stage of `src.executor`, which rejects with 503 once
+its wait queue is full; this module decides who may enter at all and for how long their work may run.
+"""
+import asyncio
+import contextvars
+import math
+import time
+from collections import OrderedDict
+from loguru import logger
+from src import config
+from src.metrics import REJECTIONS
+from src.schemas import ErrorObject
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class RateLimiter:
+    """
+    The class `RateLimiter` keeps one token bucket per client key. A bucket holds up to `burst`
+    tokens and refills at `rate` tokens per second; the least recently seen clients are forgotten
+    beyond `max_clients`.
+    """
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+
+    def acquire(self, key, cost=1):
+        """
+        The function `acquire` takes `cost` tokens from the bucket of `key`.
+
+        :return: 0 when the request may proceed, otherwise the seconds until enough tokens are back.
+        """
+        # a batch larger than the bucket would never fit; it may drain a full bucket instead
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+_limiter = None
+
+
+def get_limiter():
+    """The function `get_limiter` returns this worker's `RateLimiter`, or None when rate limiting is off."""
+    global _limiter
+    if config.RATE_LIMIT_PER_SEC <= 0:
+        return None
+    if _limiter is None:
+        _limiter = RateLimiter(config.RATE_LIMIT_PER_SEC, config.RATE_LIMIT_BURST, config.RATE_LIMIT_MAX_CLIENTS)
+    return _limiter
+
+
+def client_key(request):
+    """
+    The function `client_key` identifies the caller for rate limiting.
+
+    :param request: The `request` parameter is the incoming starlette `Request`
+    :return: the `RATE_LIMIT_KEY_HEADER` value, else the client address.
+    """
+    key = request.headers.get(config.RATE_LIMIT_KEY_HEADER)
+    if key:
+        return f"key:{key}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+def check_rate_limit(request, request_id=None, cost=1):
+    """
+    The function `check_rate_limit` raises a 429 with Retry-After when the caller is over its rate.
+
+    :param cost: The `cost` parameter is the number of tokens the request uses (one per image)
+    """
+    limiter = get_limiter()
+    if limiter is None:
+        return
+    key = client_key(request)
+    wait = limiter.acquire(key, cost)
+    if wait:
+        logger.warning(f"REQUEST_ID : {request_id} | client {key} rate limited | returning 429")
+        REJECTIONS.labels("rate_limited").inc()
+        raise ErrorObject({"error": {"status": "429"}}, headers={"Retry-After": str(math.ceil(wait))})
+
+
+def start_deadline(request):
+    """
+    The function `start_deadline` sets the time budget of the current request: `REQUEST_DEADLINE_SEC`,
+    or less when the client sends a smaller `X-Request-Timeout`. Tasks spawned afterwards inherit it.
+    A timeout of 0 or less is a budget already spent, answered with a 504 rather than no deadline.
+    """
+    budget = config.REQUEST_DEADLINE_SEC
+    try:
+        requested = float(request.headers.get("X-Request-Timeout") or "nan")
+    except ValueError:
+        requested = math.nan
+    if requested <= 0:
+        _deadline.set(time.monotonic())
+        return
+    if requested > 0:
+        budget = min(budget, requested) if budget > 0 else requested
+    if budget > 0:
+        _deadline.set(time.monotonic() + budget)
+
+
+def remaining():
+    """The function `remaining` returns the seconds left in the current request's budget, or None without a deadline."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def deadline_exceeded(request_id=None, where="request"):
+    logger.error(f"REQUEST_ID : {request_id} | deadline exceeded in {where} | returning 504")
+    REJECTIONS.labels("deadline").inc()
+    return ErrorObject({"error": {"status": "504"}})
+
+
+def check_deadline(request_id=None, where="request"):
+    """The function `check_deadline` raises a 504 if the current request's budget is already spent."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise deadline_exceeded(request_id, where)
+
+
+async def within_deadline(coro, request_id=None):
+    """
+    The function `within_deadline` awaits `coro`, cancelling it with a 504 once the request's budget
+    runs out. Work queued on the stage pools but not yet started is dropped with it.
+    """
+    left = remaining()
+    if left is None:
+        return await coro
+    if left <= 0:
+        coro.close()
+        raise deadline_exceeded(request_id)
+    try:
+        return await asyncio.wait_for(coro, left)
+    except asyncio.TimeoutError:
+        raise deadline_exceeded(request_id) from None
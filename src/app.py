@@ -1,18 +1,52 @@
 import uuid
-from fastapi import  Request
+import json
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import  Request, UploadFile, File, Form, Query
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response, ORJSONResponse
 from fastapi.encoders import jsonable_encoder
 import traceback
 from loguru import logger
 from fastapi import FastAPI
-from src.inferenceEngine import InferenceEngine
+from src.inferenceEngine import get_engine, warm_up
 from src.schemas import *
 import os
 import sys
+import time
+import sqlite3
+from typing import Union, Optional
 from src.utils import async_timed_app as async_timed
+from src import executor
+from src import downloader
+from src.cache import get_cache
+from src.dedup import get_index
+from src import metrics
+from src import jobs
+from src import admission
+from src import tracing
+from src import memory
+from src import archive
+from src.config import (BATCH_MAX_URLS, BATCH_CONCURRENCY, MAX_FILE_SIZE_BYTES, MEMORY_TRACE_FRAMES,
+                        ARCHIVE_ENABLED, ARCHIVE_DB_PATH)
 
 ENDPOINT1= "/ai/extraction/receipt"
+BATCH_ENDPOINT = "/ai/extraction/receipt/batch"
+UPLOAD_ENDPOINT = "/ai/extraction/receipt/upload"
+JOBS_ENDPOINT = "/ai/extraction/receipt/jobs"
+CACHE_ENDPOINT = "/ai/extraction/cache"
+ADMISSION_ENDPOINT = "/ai/extraction/admission"
+METRICS_ENDPOINT = "/metrics"
+MEMORY_ENDPOINT = "/ai/extraction/memory"
+ARCHIVE_ENDPOINT = "/ai/extraction/archive"
+
+try:
+    # structured results carry a few thousand values; orjson (the `fast-json` extra) encodes them
+    # several times faster than the standard library
+    import orjson
+    FastJSONResponse = ORJSONResponse
+except ImportError:
+    FastJSONResponse = JSONResponse
 
 if os.getenv("LOG_ENV", "production") == "production":
     # logger.disable("DEBUG")
@@ -31,12 +65,36 @@ tags_metadata = [
     },
 ]
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    The function `lifespan` owns the per-worker resources of the application: the pooled download
+    client, the result cache and the dedup index are opened and the shared engine is warmed up at startup (so the first request after a
+    worker (re)start is not the slow one), the memory watchdog is started, and the client and stage
+    pools are closed on exit.
+    """
+    downloader.start_client()
+    # opening a disk-backed cache or dedup index runs sqlite: not on the event loop, nor in the first request
+    await asyncio.to_thread(get_cache)
+    await asyncio.to_thread(get_index)
+    await asyncio.to_thread(warm_up, get_engine())
+    # sampled from here on, so the warmed-up worker is the baseline of its memory growth
+    watchdog = memory.start_watchdog()
+    yield
+    watchdog.cancel()
+    await downloader.close_client()
+    executor.shutdown()
+    tracing.shutdown()
+    archive.shutdown()
+
+
 app = FastAPI(
     title="receipt extraction",
     description="Information Extraction from photos",
     version="2.5.0",
     redoc_url=f"/documentation", docs_url="/explore",
     openapi_tags=tags_metadata,
+    lifespan=lifespan,
 )
 
 
@@ -60,6 +118,7 @@ async def error_response_exception_handler(request: Request, exc: ErrorObject):
     return JSONResponse(
         status_code=int(exc.error_obj.error.status),
         content=exc.error_obj.dict(),
+        headers=exc.headers,
     )
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
@@ -81,7 +140,7 @@ async def validation_exception_handler(request, exc):
         if len(error_dict['loc']) > 1 and 'value_error.any_str.min_length' in error_dict['type']\
                 or 'value_error.url' in error_dict['type'] or \
                 'min_items' in error_dict['type'] or 'value_error.number' in error_dict['type']\
-                or 'url_parsing' in error_dict["type"]:
+                or 'url_parsing' in error_dict["type"] or 'url_scheme' in error_dict["type"]:
             return JSONResponse(status_code=422, content={
                 "error": {
                             'name': "Invalid Input Request JSON Parameter",
@@ -142,6 +201,15 @@ async def validation_exception_handler(request, exc):
                             'responseCode': 'fail',
                 }
             })
+        if len(error_dict['loc']) > 1 and error_dict['type'] == 'too_long' and request.url.path == BATCH_ENDPOINT:
+            return JSONResponse(status_code=400, content={
+                "error": {
+                            'name': "Invalid Request",
+                            'status': '400',
+                            'msg': f"Request must contain at most {BATCH_MAX_URLS} image urls",
+                            'responseCode': 'fail',
+                }
+            })
         if len(error_dict['loc']) > 1 and error_dict['msg'] == 'List should have at most 1 item after validation, not 2':
             return JSONResponse(status_code=400, content={
                 "error": {
@@ -199,8 +267,8 @@ async def add_request_id(request: Request, call_next):
     middleware or route handler in the
     :return: The response object is being returned.
     """
-    # Generate or obtain a request ID
-    request_id = str(uuid.uuid4())  # Replace with your custom logic
+    # Take the caller's request ID (X-Request-ID) or generate one
+    request_id = _incoming_request_id(request) or str(uuid.uuid4())
 
     # Store the request ID in the request state for access in route handlers
     request.state.request_id = request_id
@@ -209,31 +277,362 @@ async def add_request_id(request: Request, call_next):
     # # Replace the original request with the modified ImgRequest object
     # request = Request(img_request)
     # Proceed with the request handling
-    response = await call_next(request)
-
+    start = time.monotonic()
+    status = 500
+    # root span of the request, sampled at the head: the caller's traceparent decides when present
+    with tracing.trace("http.request", request.headers.get("traceparent"),
+                       {"http.method": request.method, "http.target": request.url.path}) as span:
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            route = request.scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            metrics.REQUESTS.labels(route, str(status)).inc()
+            metrics.REQUEST_LATENCY.labels(route).observe(time.monotonic() - start)
+            memory.count_request()
+            # handlers adopt the body's requestId, if any, in place of the generated one
+            span.update({"http.route": route, "http.status_code": status, "request.id": request.state.request_id})
+        # a streamed body (batch `stream`) is still being produced: the root span ends with it
+        span.keep_open()
+    response.body_iterator = _end_with_body(response.body_iterator, span)
+    response.headers["X-Request-ID"] = request.state.request_id
     return response
 
+
+async def _end_with_body(body, span):
+    try:
+        async for chunk in body:
+            yield chunk
+    except GeneratorExit:
+        # the client went away before the end of the body
+        span.end(asyncio.CancelledError())
+        raise
+    except BaseException as e:
+        span.end(e)
+        raise
+    span.end()
+
+
+def _valid_request_id(value):
+    # ids are echoed into logs and headers: keep them short and printable
+    value = (value or "").strip()
+    if value and len(value) <= 128 and value.isprintable():
+        return value
+    return None
+
+
+def _incoming_request_id(request):
+    return _valid_request_id(request.headers.get("X-Request-ID"))
+
+
+def _adopt_request_id(req, request_id):
+    """
+    The function `_adopt_request_id` makes the `requestId` of a request body, when the caller sent one,
+    the id of the whole request: logs, the trace and the `X-Request-ID` response header then carry it.
+
+    :return: the request id in effect.
+    """
+    request_id = _valid_request_id(request_id)
+    if request_id is not None:
+        req.state.request_id = request_id
+    return req.state.request_id
+
 @app.post(f"{ENDPOINT1}",
-          tags=["Serve"], responses={200: {"model": ResponseSchema},
+          tags=["Serve"], responses={200: {"model": Union[float, StructuredResult],
+                                           "description": "The total, or a `StructuredResult` when `structured` is set."},
                                      400: {"model": ErrorResponse400},
                                      422: {"model": ErrorResponse422},
                                      413: {"model": ErrorResponse413},
-                                     415: {"model": ErrorResponse415}})
+                                     415: {"model": ErrorResponse415},
+                                     429: {"model": ErrorResponse429},
+                                     503: {"model": ErrorResponse503},
+                                     504: {"model": ErrorResponse504}})
 @async_timed()
 async def serve_image(
-    Imgrequest: ImgRequest, req :Request
+    Imgrequest: ImgRequest, req :Request, response: Response
     ):
+    """
+    The function `serve_image` extracts the total of one receipt. With dedup enabled, a receipt that
+    matches one processed before is answered with its result and flagged with the
+    `X-Probable-Duplicate`, `X-Duplicate-Of` (content hash of the original) and `X-Duplicate-Distance`
+    headers. With `structured` set, the lines, word boxes and confidences of the same OCR pass come
+    back column-oriented along with the total, encoded by orjson when it is installed.
+    """
     request_dict = Imgrequest.dict()
-    request_id = req.state.request_id
+    request_id = _adopt_request_id(req, Imgrequest.requestId)
     try:
         logger.debug(f"REQUEST_ID : {request_id} | input request -- {request_dict}")
-        ie = InferenceEngine(request_id)
-        response = await ie.execute_image(request_dict)
+        admission.check_rate_limit(req, request_id)
+        admission.start_deadline(req)
+        ie = get_engine()
+        meta = {}
+        result = await admission.within_deadline(
+            executor.get_stage("admission").run(ie.execute_image, request_dict, request_id, meta, request_id=request_id),
+            request_id)
     except Exception as e:
         logger.error(f'REQUEST_ID : {request_id} |  error -- {e}')
         logger.error(f'REQUEST_ID : {request_id} |  traceback --- {traceback.format_exc()}')
         raise e
-
     # response = ResponseSchema(**response)
-    return response
+    return _respond(result, meta, Imgrequest.structured, response)
+
+def _respond(result, meta, structured, response):
+    """
+    The function `_respond` finishes a single-receipt response: duplicate headers, and structured
+    results rendered directly (skipping FastAPI's per-value `jsonable_encoder` pass).
+
+    :param meta: The `meta` parameter is the dict filled by the engine
+    :param response: The `response` parameter is the endpoint's injected `Response`, carrying the headers of plain results
+    :return: the result, or a JSON response for structured results.
+    """
+    headers = {}
+    duplicate = meta.get("duplicateOf")
+    if duplicate is not None:
+        headers["X-Probable-Duplicate"] = "true"
+        headers["X-Duplicate-Of"] = duplicate["contentHash"]
+        headers["X-Duplicate-Distance"] = str(duplicate["distance"])
+    if structured:
+        return FastJSONResponse(result, headers=headers)
+    response.headers.update(headers)
+    return result
+
+@app.post(f"{UPLOAD_ENDPOINT}",
+          tags=["Serve"], responses={200: {"model": Union[float, StructuredResult],
+                                           "description": "The total, or a `StructuredResult` when `structured` is set."},
+                                     413: {"model": ErrorResponse413},
+                                     415: {"model": ErrorResponse415},
+                                     422: {"model": ErrorResponse422},
+                                     429: {"model": ErrorResponse429},
+                                     503: {"model": ErrorResponse503},
+                                     504: {"model": ErrorResponse504}})
+@async_timed()
+async def serve_upload(
+    req :Request, response: Response,
+    file: UploadFile = File(..., description="The receipt [JPEG/TIFF/PNG/PDF] as a multipart file."),
+    structured: bool = Form(False, description="Return the lines, word boxes and confidences along with the total."),
+    ):
+    """
+    The function `serve_upload` is `serve_image` for a receipt posted as multipart form data instead
+    of a url, for callers that hold the bytes already. Uploads share the result cache (by content),
+    the dedup index, the rate limit and the deadline with the url endpoint.
+    """
+    request_id = req.state.request_id
+    try:
+        logger.debug(f"REQUEST_ID : {request_id} | upload {file.filename!r} ({file.size} bytes)")
+        admission.check_rate_limit(req, request_id)
+        admission.start_deadline(req)
+        if file.size is not None and file.size > MAX_FILE_SIZE_BYTES:
+            logger.error(f"REQUEST_ID : {request_id} | payload too large ({file.size} bytes) | returning 413")
+            raise ErrorObject({"error": {"status": "413"}})
+        file_bytes = await file.read()
+        meta = {}
+        result = await admission.within_deadline(
+            executor.get_stage("admission").run(get_engine().execute_upload, file_bytes, request_id, meta, structured,
+                                                request_id=request_id),
+            request_id)
+    except Exception as e:
+        logger.error(f'REQUEST_ID : {request_id} |  error -- {e}')
+        logger.error(f'REQUEST_ID : {request_id} |  traceback --- {traceback.format_exc()}')
+        raise e
+    finally:
+        await file.close()
+    return _respond(result, meta, structured, response)
+
+async def _run_batch_item(index, url, request_id, slots):
+    """
+    The function `_run_batch_item` extracts one URL of a batch and folds any `ErrorObject` into the
+    item instead of failing the whole batch.
+
+    :param index: The `index` parameter is the position of the URL in the request
+    :param slots: The `slots` parameter is the semaphore bounding how many items of the batch run at once
+    :return: a `BatchItem`-shaped dict.
+    """
+    item = {"index": index, "img_url": str(url), "result": None, "error": None}
+    async with slots:
+        try:
+            item_id = f"{request_id}-{index}"
+            meta = {}
+            item["result"] = await admission.within_deadline(
+                executor.get_stage("admission").run(get_engine().execute_image, {"img_url": [url]}, item_id, meta,
+                                                    request_id=item_id),
+                item_id)
+            if "duplicateOf" in meta:
+                item["duplicateOf"] = meta["duplicateOf"]
+        except ErrorObject as e:
+            error = e.error_obj.error
+            item["error"] = {"status": error.status, "msg": error.msg, "responseCode": error.responseCode}
+    return item
+
+
+@app.post(f"{BATCH_ENDPOINT}",
+          tags=["Serve"], responses={200: {"model": BatchResponseSchema},
+                                     400: {"model": ErrorResponse400},
+                                     422: {"model": ErrorResponse422},
+                                     429: {"model": ErrorResponse429}})
+@async_timed()
+async def serve_batch(
+    Batchrequest: BatchImageRequest, req :Request
+    ):
+    """
+    The function `serve_batch` extracts up to `BATCH_MAX_URLS` receipts in one call. Items are
+    downloaded concurrently and pipelined through the preprocessing/OCR pools, at most
+    `BATCH_CONCURRENCY` at a time. Per-item failures carry the same status codes as the single
+    endpoint. Results come back in input order, or as NDJSON lines in completion order when `stream`
+    is set. Every url counts against the caller's rate limit, and items still unfinished when the
+    request deadline passes fail with 504.
+    """
+    request_id = _adopt_request_id(req, Batchrequest.requestId)
+    logger.debug(f"REQUEST_ID : {request_id} | batch of {len(Batchrequest.img_url)} urls")
+    admission.check_rate_limit(req, request_id, cost=len(Batchrequest.img_url))
+    admission.start_deadline(req)
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    tasks = [asyncio.ensure_future(_run_batch_item(index, url, request_id, slots))
+             for index, url in enumerate(Batchrequest.img_url)]
+    if Batchrequest.stream:
+        async def ndjson():
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    yield json.dumps(await finished) + "\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    return {"results": await asyncio.gather(*tasks)}
+
+
+@app.post(f"{JOBS_ENDPOINT}", status_code=202,
+          tags=["Serve"], responses={202: {"model": JobResponse},
+                                     400: {"model": ErrorResponse400},
+                                     422: {"model": ErrorResponse422}})
+async def submit_job(
+    Jobrequest: JobRequest, req :Request
+    ):
+    """
+    The function `submit_job` queues an extraction on the local job queue and answers at once; the
+    job workers (`python -m src.jobs`) pick it up. Poll `GET {JOBS_ENDPOINT}/{jobId}` for the result,
+    or pass `callback_url` to have the finished job POSTed there.
+    """
+    request_id = _adopt_request_id(req, Jobrequest.requestId)
+    callback_url = str(Jobrequest.callback_url) if Jobrequest.callback_url else None
+    # the root span when this request is sampled, else the caller's own (unsampled) trace context
+    traceparent = tracing.current().traceparent or req.headers.get("traceparent")
+    job_id = await asyncio.to_thread(jobs.get_store().submit, str(Jobrequest.img_url[0]), request_id, callback_url,
+                                     traceparent)
+    logger.info(f"REQUEST_ID : {request_id} | queued job {job_id}")
+    return {"jobId": job_id, "status": jobs.QUEUED, "requestId": request_id}
+
+
+@app.get(f"{JOBS_ENDPOINT}/{{job_id}}",
+         tags=["Serve"], responses={200: {"model": JobResponse},
+                                    404: {"model": ErrorResponse404}})
+async def get_job(job_id: str):
+    """
+    The function `get_job` returns the status of a job and, once it is `done` or `failed`, its
+    `result` or `error` (the same error object the synchronous endpoint would have returned).
+    """
+    job = await asyncio.to_thread(jobs.get_store().get, job_id)
+    if job is None:
+        raise ErrorObject({"error": {"status": "404"}})
+    return jobs.public_view(job)
+
+
+@app.get(f"{CACHE_ENDPOINT}", tags=["Serve"])
+async def cache_stats():
+    """
+    The function `cache_stats` reports the hit/miss/eviction counters of this worker's result cache,
+    and of the near-duplicate index when dedup is enabled.
+
+    :return: a dict of counters (`{"enabled": False}` when result caching is turned off).
+    """
+    cache = get_cache()
+    stats = dict(cache.stats(), enabled=True) if cache is not None else {"enabled": False}
+    index = get_index()
+    if index is not None:
+        stats["dedup"] = index.stats()
+    return stats
+
+
+@app.get(f"{ADMISSION_ENDPOINT}", tags=["Serve"])
+async def admission_stats():
+    """
+    The function `admission_stats` reports, for this worker, how many requests and stage calls are
+    running and waiting against their limits. Rejection counts are in `/metrics`
+    (`receipt_rejections_total`).
+    """
+    executor.get_stage("admission")
+    return executor.stage_stats()
+
+
+@app.get(f"{MEMORY_ENDPOINT}", tags=["Serve"])
+async def memory_stats():
+    """
+    The function `memory_stats` reports the resident memory of the worker that answers: current,
+    peak and baseline RSS, growth per hour and per request, and the limits it is recycled at.
+    """
+    return memory.get_watchdog().stats()
+
+
+@app.post(f"{MEMORY_ENDPOINT}/snapshot", tags=["Serve"])
+async def start_memory_trace():
+    """
+    The function `start_memory_trace` starts tracemalloc in the worker that answers (with
+    `MEMORY_TRACE_FRAMES` frames per allocation) and takes the baseline for `GET {MEMORY_ENDPOINT}/growth`.
+    Posting again takes a new baseline.
+    """
+    return await asyncio.to_thread(memory.start_tracing, MEMORY_TRACE_FRAMES)
+
+
+@app.get(f"{MEMORY_ENDPOINT}/growth", tags=["Serve"], responses={404: {"model": ErrorResponse404}})
+async def memory_growth(limit: int = 20):
+    """
+    The function `memory_growth` attributes the memory allocated since the baseline snapshot to the
+    pipeline functions and allocation sites that hold it, largest first. 404 when this worker has
+    no snapshot.
+    """
+    report = await asyncio.to_thread(memory.growth_report, max(1, limit))
+    if report is None:
+        raise ErrorObject({"error": {"status": "404", "msg": f"no memory snapshot in worker {os.getpid()} "
+                                                             f"- POST {MEMORY_ENDPOINT}/snapshot first"}})
+    return report
+
+
+@app.delete(f"{MEMORY_ENDPOINT}/snapshot", tags=["Serve"])
+async def stop_memory_trace():
+    """The function `stop_memory_trace` stops tracemalloc and drops the baseline in the worker that answers."""
+    return memory.stop_tracing()
+
+
+@app.get(f"{ARCHIVE_ENDPOINT}", tags=["Serve"], responses={404: {"model": ErrorResponse404},
+                                                            422: {"model": ErrorResponse422}})
+async def query_archive(min_total: Optional[float] = Query(None, alias="minTotal"),
+                        max_total: Optional[float] = Query(None, alias="maxTotal"),
+                        since: Optional[str] = None, until: Optional[str] = None,
+                        q: Optional[str] = None, limit: int = Query(100, ge=1, le=1000),
+                        text: bool = False):
+    """
+    The function `query_archive` searches the archived results without re-running OCR: totals
+    between `minTotal` and `maxTotal`, archived between `since` and `until` (ISO dates or date-times,
+    UTC unless an offset is given; `until` exclusive), and `q`, an FTS5 query over the OCR text.
+    Returns the count and the sum of the totals of every match, and the newest `limit` of them
+    (with their OCR text when `text` is set). 404 when the archive is disabled.
+    """
+    if not ARCHIVE_ENABLED and not os.path.exists(ARCHIVE_DB_PATH):
+        raise ErrorObject({"error": {"status": "404", "msg": "results archive is disabled (ARCHIVE_ENABLED)"}})
+    try:
+        window = archive.parse_time(since), archive.parse_time(until)
+        return await asyncio.to_thread(archive.query, min_total, max_total, *window, q, limit, text)
+    except (ValueError, sqlite3.OperationalError) as e:
+        logger.error(f"invalid archive query --- {e}")
+        raise ErrorObject({"error": {"status": "422", "msg": f"invalid archive query - {e}"}})
+
+
+@app.get(f"{METRICS_ENDPOINT}", include_in_schema=False)
+async def serve_metrics():
+    """
+    The function `serve_metrics` exposes stage latency histograms, request counters by status code,
+    stage queue gauges and cache counters in Prometheus text format.
+    """
+    payload, content_type = metrics.render()
+    return Response(content=payload, media_type=content_type)
 
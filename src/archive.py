@@ -0,0 +1,270 @@
+"""
+Append-only archive of extraction results, searchable without touching the receipts again.
+
+Each extraction the service runs is queued, with its content hash, url, total, OCR text and stage
+timings, to a background thread of the worker. That thread inserts in batches into one sqlite file
+(WAL, so every worker writes while queries read). Rows are indexed by time and by total, and the OCR
+text is indexed with FTS5, so "totals above X in March" or "receipts mentioning 'STARBUCKS'" are
+answered in milliseconds:
+
+    GET /ai/extraction/archive?minTotal=100&since=2026-03-01&until=2026-04-01
+    python -m src.archive --search starbucks --since 2026-03-01
+"""
+import argparse
+import contextvars
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from loguru import logger
+from src import config
+from src.metrics import ARCHIVE_ROWS
+from src.persistence import BatchWriter, ProcessLocal, wal_connection
+
+COLUMNS = ("created_at", "request_id", "content_hash", "url", "file_type", "total", "duplicate_of",
+           "ocr_text", "timings")
+
+# timings and OCR text of the extraction in progress, collected by the stages it runs through
+_record = contextvars.ContextVar("archive_record", default=None)
+# the stages of one extraction (TIFF frames, cascade variants) add their timings from parallel threads
+_timings_lock = threading.Lock()
+
+
+class ArchiveStore:
+    """
+    The class `ArchiveStore` is the sqlite results table and its indexes. The FTS5 table is an
+    external-content index over `results.ocr_text`, filled by a trigger, so the text is stored once.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY, created_at REAL NOT NULL, request_id TEXT, content_hash TEXT NOT NULL,
+            url TEXT, file_type TEXT, total REAL, duplicate_of TEXT, ocr_text TEXT, timings TEXT)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_total ON results (total, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_hash ON results (content_hash)")
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS results_text USING fts5("
+                     "ocr_text, content='results', content_rowid='id')")
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS results_text_insert AFTER INSERT ON results
+            WHEN new.ocr_text IS NOT NULL BEGIN
+            INSERT INTO results_text (rowid, ocr_text) VALUES (new.id, new.ocr_text); END""")
+
+    def _conn(self):
+        return wal_connection(self._local, self.path, 10, autocommit=True, rows=True)
+
+    def insert(self, rows):
+        """
+        The function `insert` appends a batch of rows in a single transaction.
+
+        :param rows: The `rows` parameter is a list of tuples in `COLUMNS` order
+        """
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(f"INSERT INTO results ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def query(self, min_total=None, max_total=None, since=None, until=None, search=None, limit=100,
+              with_text=False):
+        """
+        The function `query` finds archived results by total, time range and OCR text.
+
+        :param min_total: The `min_total` parameter keeps totals greater than or equal to it
+        :param max_total: The `max_total` parameter keeps totals less than or equal to it
+        :param since: The `since` parameter keeps results archived at or after this epoch time
+        :param until: The `until` parameter keeps results archived before this epoch time
+        :param search: The `search` parameter is an FTS5 query over the OCR text (words, "phrases",
+        prefix*, AND/OR/NOT)
+        :param limit: The `limit` parameter is the most rows returned, newest first
+        :param with_text: The `with_text` parameter includes the full OCR text of each row
+        :return: a dict with the `count` and `sumTotal` of every match and the newest `limit` rows.
+        """
+        conditions, params = [], []
+        for condition, value in (("r.total >= ?", min_total), ("r.total <= ?", max_total),
+                                 ("r.created_at >= ?", since), ("r.created_at < ?", until)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        source = "results r"
+        snippet = "NULL"
+        if search:
+            source = "results_text JOIN results r ON r.id = results_text.rowid"
+            conditions.append("results_text MATCH ?")
+            params.append(search)
+            snippet = "snippet(results_text, 0, '[', ']', '...', 12)"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        conn = self._conn()
+        count, total = conn.execute(f"SELECT COUNT(*), SUM(r.total) FROM {source} {where}", params).fetchone()
+        rows = conn.execute(f"SELECT r.*, {snippet} AS snippet FROM {source} {where} "
+                            f"ORDER BY r.created_at DESC LIMIT ?", params + [limit]).fetchall()
+        return {"count": count, "sumTotal": round(total or 0, 2),
+                "results": [self._as_dict(row, with_text) for row in rows]}
+
+    @staticmethod
+    def _as_dict(row, with_text):
+        result = {"id": row["id"], "createdAt": row["created_at"], "requestId": row["request_id"],
+                  "contentHash": row["content_hash"], "url": row["url"], "fileType": row["file_type"],
+                  "total": row["total"], "duplicateOf": row["duplicate_of"],
+                  "timings": json.loads(row["timings"]) if row["timings"] else None}
+        if row["snippet"] is not None:
+            result["snippet"] = row["snippet"]
+        if with_text:
+            result["ocrText"] = row["ocr_text"]
+        return result
+
+
+class ArchiveWriter(BatchWriter):
+    """
+    The class `ArchiveWriter` inserts queued rows every `interval` seconds, at most `batch_size` rows
+    per transaction, from the background thread of a `BatchWriter`.
+    """
+    def __init__(self, store, batch_size, interval, max_queue):
+        self.store = store
+        super().__init__(interval, max_queue, ARCHIVE_ROWS, batch_size, name="archive-writer")
+
+    def write(self, batch):
+        try:
+            self.store.insert(batch)
+            ARCHIVE_ROWS.labels("written").inc(len(batch))
+        except sqlite3.Error as e:
+            ARCHIVE_ROWS.labels("failed").inc(len(batch))
+            logger.warning(f"unable to archive {len(batch)} results to {self.store.path} --- {e}")
+
+
+_store = None
+_store_lock = threading.Lock()
+_writer = ProcessLocal(lambda: ArchiveWriter(get_store(), config.ARCHIVE_BATCH_SIZE, config.ARCHIVE_FLUSH_INTERVAL_SEC,
+                                             config.ARCHIVE_QUEUE_SIZE))
+
+
+def get_store():
+    """The function `get_store` returns this process's `ArchiveStore` for `ARCHIVE_DB_PATH`."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ArchiveStore(config.ARCHIVE_DB_PATH)
+    return _store
+
+
+def query(*args):
+    """
+    The function `query` runs `ArchiveStore.query` on this process's store, opening (and on first use
+    creating) the database in the calling thread: the API calls it through `asyncio.to_thread`.
+    """
+    return get_store().query(*args)
+
+
+def get_writer():
+    """The function `get_writer` returns this process's `ArchiveWriter`."""
+    return _writer.get()
+
+
+def shutdown():
+    """The function `shutdown` writes the rows still queued; called when the worker stops."""
+    _writer.shutdown()
+
+
+def start_record():
+    """
+    The function `start_record` starts collecting the stage timings and OCR text of the extraction
+    about to run in the current context. Does nothing when the archive is disabled.
+    """
+    if config.ARCHIVE_ENABLED:
+        _record.set({"timings": {}, "text": None, "duplicate_of": None})
+
+
+def add_timing(stage, seconds):
+    """The function `add_timing` adds a stage's duration to the current record (summed over repeated calls)."""
+    record = _record.get()
+    if record is not None:
+        timings = record["timings"]
+        with _timings_lock:
+            timings[stage] = round(timings.get(stage, 0) + seconds, 4)
+
+
+def note_text(text):
+    """The function `note_text` keeps the OCR text the result of the current record was extracted from."""
+    record = _record.get()
+    if record is not None:
+        record["text"] = text
+
+
+def note_duplicate(content_hash):
+    """The function `note_duplicate` marks the current record as a near-duplicate match of an archived receipt."""
+    record = _record.get()
+    if record is not None:
+        record["duplicate_of"] = content_hash
+
+
+def submit(request_id, content_hash, url, file_type, result):
+    """
+    The function `submit` queues the current record for the archive, off the request path.
+
+    :param content_hash: The `content_hash` parameter is the hash of the receipt bytes
+    :param url: The `url` parameter is the receipt url, None for uploads
+    :param file_type: The `file_type` parameter is the extension detected by `validate_file`, None for url cache hits
+    :param result: The `result` parameter is the total, or the structured result
+    """
+    record = _record.get()
+    if record is None:
+        return
+    total = result.get("total") if isinstance(result, dict) else result
+    with _timings_lock:
+        timings = json.dumps(record["timings"])
+    get_writer().put((time.time(), request_id, content_hash, url, file_type, total, record["duplicate_of"], record["text"],
+                      timings))
+
+
+def parse_time(value):
+    """
+    The function `parse_time` reads an ISO-8601 date or date-time (UTC unless an offset is given).
+
+    :return: the epoch time, or None for an empty value.
+    """
+    if not value:
+        return None
+    moment = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the archive of extraction results.")
+    parser.add_argument("--min-total", type=float)
+    parser.add_argument("--max-total", type=float)
+    parser.add_argument("--since", help="ISO date or date-time, UTC unless an offset is given")
+    parser.add_argument("--until", help="ISO date or date-time (exclusive)")
+    parser.add_argument("--search", "-s", help="FTS5 query over the OCR text")
+    parser.add_argument("--limit", "-n", type=int, default=100)
+    parser.add_argument("--text", action="store_true", help="print the OCR text of each result")
+    parser.add_argument("--db", default=config.ARCHIVE_DB_PATH)
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        print(f"no archive at {args.db}", file=sys.stderr)
+        return 1
+    start = time.monotonic()
+    try:
+        found = ArchiveStore(args.db).query(args.min_total, args.max_total, parse_time(args.since),
+                                            parse_time(args.until), args.search, args.limit, args.text)
+    except (sqlite3.OperationalError, ValueError) as e:
+        print(f"invalid query --- {e}", file=sys.stderr)
+        return 2
+    for row in found["results"]:
+        print(json.dumps(row))
+    print(f"{found['count']} results | sum of totals {found['sumTotal']} | {len(found['results'])} shown "
+          f"| {(time.monotonic() - start) * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from loguru import logger
+from src import config
+from src.metrics import CACHE_EVENTS
+from src.persistence import wal_connection
+
+
+def content_hash(file_bytes):
+    """The function `content_hash` returns the SHA-256 hex digest used as the result cache key."""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+class DiskStore:
+    """
+    The class `DiskStore` is the optional sqlite backend of the result cache. The database runs in WAL
+    mode so every gunicorn worker on the host can read and write it concurrently.
+    """
+    PRUNE_EVERY = 500
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS url_map (url TEXT PRIMARY KEY, content_hash TEXT NOT NULL, expires_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS results (content_hash TEXT PRIMARY KEY, result TEXT NOT NULL, last_used REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        conn.commit()
+
+    def _conn(self):
+        return wal_connection(self._local, self.path, 5)
+
+    def get_hash(self, url, now):
+        row = self._conn().execute("SELECT content_hash, expires_at FROM url_map WHERE url = ?", (url,)).fetchone()
+        if row is None or row[1] < now:
+            return None
+        return row[0]
+
+    def put_hash(self, url, digest, expires_at):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO url_map VALUES (?, ?, ?)", (url, digest, expires_at))
+        conn.commit()
+
+    def get_result(self, digest):
+        conn = self._conn()
+        row = conn.execute("SELECT result FROM results WHERE content_hash = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE results SET last_used = ? WHERE content_hash = ?", (time.time(), digest))
+        conn.commit()
+        return json.loads(row[0])
+
+    def put_result(self, digest, result):
+        """
+        The function `put_result` stores a result and, every `PRUNE_EVERY` writes, drops the least
+        recently used rows beyond `max_entries` and expired url mappings.
+
+        :return: the number of evicted results.
+        """
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (digest, json.dumps(result), time.time()))
+        evicted = 0
+        self._puts += 1
+        if self._puts % self.PRUNE_EVERY == 0:
+            evicted = conn.execute(
+                "DELETE FROM results WHERE content_hash IN (SELECT content_hash FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)).rowcount
+            conn.execute("DELETE FROM url_map WHERE expires_at < ?", (time.time(),))
+        conn.commit()
+        return evicted
+
+
+class ResultCache:
+    """
+    The class `ResultCache` is a two-level cache in front of the inference engine: URL -> content hash
+    (with a TTL, since the bytes behind a URL may change) and content hash -> extracted result (LRU in
+    memory, optionally backed by a `DiskStore`). A hit at either level skips decoding and OCR.
+
+    The engine uses the `a`-prefixed methods: they answer memory hits inline and run the sqlite
+    queries of the disk tier in a thread, so lock waits and pruning never stall the event loop.
+    """
+    def __init__(self, max_entries, url_ttl, disk=None):
+        self.max_entries = max_entries
+        self.url_ttl = url_ttl
+        self.disk = disk
+        self._urls = {}
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        # counted under `_lock` and from the threads of the disk tier
+        self._counters_lock = threading.Lock()
+        self.counters = {"urlHits": 0, "urlMisses": 0, "contentHits": 0, "contentMisses": 0,
+                         "evictions": 0, "diskHits": 0}
+
+    def _count(self, name, amount=1):
+        with self._counters_lock:
+            self.counters[name] += amount
+        if amount:
+            CACHE_EVENTS.labels(name).inc(amount)
+
+    def lookup_hash(self, url):
+        """
+        The function `lookup_hash` resolves a URL to the hash of the content it served last time.
+
+        :param url: The `url` parameter is the requested image URL
+        :return: the content hash, or None when unknown or expired.
+        """
+        digest = self._memory_hash(url)
+        return digest if digest is not None else self._disk_hash(url)
+
+    async def alookup_hash(self, url):
+        digest = self._memory_hash(url)
+        return digest if digest is not None else await self._off_loop(self._disk_hash, url)
+
+    def _memory_hash(self, url):
+        with self._lock:
+            entry = self._urls.get(url)
+            if entry is not None and entry[1] < time.time():
+                del self._urls[url]
+                entry = None
+        if entry is None:
+            return None
+        self._count("urlHits")
+        return entry[0]
+
+    def _disk_hash(self, url):
+        now = time.time()
+        digest = self.disk.get_hash(url, now) if self.disk is not None else None
+        if digest is not None:
+            with self._lock:
+                self._urls[url] = (digest, now + self.url_ttl)
+        self._count("urlHits" if digest is not None else "urlMisses")
+        return digest
+
+    def remember_url(self, url, digest):
+        expires_at = self._remember_url(url, digest)
+        if self.disk is not None:
+            self.disk.put_hash(url, digest, expires_at)
+
+    async def aremember_url(self, url, digest):
+        expires_at = self._remember_url(url, digest)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put_hash, url, digest, expires_at)
+
+    def _remember_url(self, url, digest):
+        expires_at = time.time() + self.url_ttl
+        with self._lock:
+            self._urls[url] = (digest, expires_at)
+        return expires_at
+
+    def get(self, digest):
+        """
+        The function `get` returns the stored result for a content hash, consulting the disk store on
+        a memory miss and promoting what it finds.
+
+        :param digest: The `digest` parameter is the SHA-256 hex digest of the image bytes
+        :return: the cached result, or None.
+        """
+        result = self._memory_result(digest)
+        return result if result is not None else self._disk_result(digest)
+
+    async def aget(self, digest):
+        result = self._memory_result(digest)
+        return result if result is not None else await self._off_loop(self._disk_result, digest)
+
+    def _memory_result(self, digest):
+        with self._lock:
+            if digest not in self._results:
+                return None
+            self._results.move_to_end(digest)
+            self._count("contentHits")
+            return self._results[digest]
+
+    def _disk_result(self, digest):
+        result = self.disk.get_result(digest) if self.disk is not None else None
+        if result is None:
+            self._count("contentMisses")
+            return None
+        self._count("contentHits")
+        self._count("diskHits")
+        self._remember_result(digest, result)
+        return result
+
+    def put(self, url, digest, result, key=None):
+        # `key` stores the result under another name than the content hash (e.g. a structured result);
+        # uploads have no `url` to remember
+        key = key or digest
+        self._remember_result(key, result)
+        if url is not None:
+            self.remember_url(url, digest)
+        if self.disk is not None:
+            self._count("evictions", self.disk.put_result(key, result))
+
+    async def aput(self, url, digest, result, key=None):
+        key = key or digest
+        self._remember_result(key, result)
+        if url is not None:
+            await self.aremember_url(url, digest)
+        if self.disk is not None:
+            self._count("evictions", await asyncio.to_thread(self.disk.put_result, key, result))
+
+    async def _off_loop(self, func, *args):
+        # without a disk tier there is nothing to wait on
+        if self.disk is None:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    def _remember_result(self, digest, result):
+        with self._lock:
+            self._results[digest] = result
+            self._results.move_to_end(digest)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+                self._count("evictions")
+            # expired url mappings are dropped lazily; bound the map to a few times the result store
+            if len(self._urls) > 4 * self.max_entries:
+                now = time.time()
+                self._urls = {url: entry for url, entry in self._urls.items() if entry[1] >= now}
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._results), urls=len(self._urls),
+                        maxEntries=self.max_entries, disk=self.disk.path if self.disk is not None else None)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    The function `get_cache` returns the worker-wide `ResultCache`, or None when caching is disabled.
+    """
+    global _cache
+    if _cache is None and config.RESULT_CACHE_ENABLED:
+        with _cache_lock:
+            if _cache is None:
+                disk = None
+                if config.RESULT_CACHE_DISK_PATH:
+                    disk = DiskStore(config.RESULT_CACHE_DISK_PATH, config.RESULT_CACHE_DISK_MAX_ENTRIES)
+                    logger.info(f"result cache backed by {config.RESULT_CACHE_DISK_PATH}")
+                _cache = ResultCache(config.RESULT_CACHE_MAX_ENTRIES, config.URL_CACHE_TTL_SEC, disk)
+    return _cache
@@ -0,0 +1,117 @@
+"""
+Preprocessing variants for the OCR cascade.
+
+Each variant turns the decoded grayscale page into the image handed to OCR, or returns None when it
+does not apply to this page (e.g. `downscaled` on a page that is already small, `deskew` on a
+straight one). `InferenceEngine` tries them in `PREPROCESS_CASCADE` order and stops at the first
+confident total; `receipt_cascade_variants_total` counts attempts and wins per variant so the order
+can be tuned.
+"""
+import cv2
+import numpy as np
+from loguru import logger
+from src import imaging
+from src.metrics import CASCADE_VARIANTS
+
+# long side of the page OCRed by the cheap first pass.
+DOWNSCALED_MAX_SIDE = 1600
+# skew angles smaller than this (degrees) are left alone.
+MIN_SKEW_DEG = 0.5
+MAX_SKEW_DEG = 15
+
+
+def binarize(gray):
+    """The function `binarize` is the original preprocessing: median blur 5 and a Gaussian adaptive threshold."""
+    return cv2.adaptiveThreshold(cv2.medianBlur(gray, 5), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+
+
+def downscaled(gray):
+    small, factor = imaging.thumbnail(gray, DOWNSCALED_MAX_SIDE)
+    return binarize(small) if factor < 1.0 else None
+
+
+def skew_angle(gray):
+    """
+    The function `skew_angle` estimates the rotation of the text lines from the minimum-area
+    rectangle around the ink of a thumbnail.
+
+    :return: the angle in degrees to rotate by to straighten the page, 0 when unsure.
+    """
+    thumb, _ = imaging.thumbnail(gray)
+    ink = cv2.adaptiveThreshold(thumb, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+    points = cv2.findNonZero(ink)
+    if points is None or len(points) < 100:
+        return 0.0
+    (_, _), (width, height), angle = cv2.minAreaRect(points)
+    # OpenCV reports the angle of the rectangle's first side; fold it into (-45, 45]
+    if width < height:
+        angle -= 90
+    if angle <= -45:
+        angle += 90
+    return angle if abs(angle) <= MAX_SKEW_DEG else 0.0
+
+
+def deskew(gray):
+    angle = skew_angle(gray)
+    if abs(angle) < MIN_SKEW_DEG:
+        return None
+    height, width = gray.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    rotated = cv2.warpAffine(gray, matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    return binarize(rotated)
+
+
+def otsu(gray):
+    _, out = cv2.threshold(cv2.GaussianBlur(gray, (5, 5), 0), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return out
+
+
+def mean_threshold(gray):
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 31, 10)
+
+
+def denoise(gray):
+    return otsu(cv2.fastNlMeansDenoising(gray, None, h=10, templateWindowSize=7, searchWindowSize=21))
+
+
+def plain(gray):
+    # no thresholding at all: tesseract binarizes internally, which suits clean, evenly lit scans
+    return np.ascontiguousarray(gray)
+
+
+VARIANTS = {
+    "downscaled": downscaled,
+    "default": binarize,
+    "deskew": deskew,
+    "otsu": otsu,
+    "mean": mean_threshold,
+    "denoise": denoise,
+    "gray": plain,
+}
+
+
+def parse_order(value):
+    """
+    The function `parse_order` reads the `PREPROCESS_CASCADE` setting.
+
+    :param value: The `value` parameter is a comma separated list of variant names
+    :return: the list of known variant names, in order (empty when the cascade is off).
+    """
+    order = []
+    for name in (part.strip() for part in value.split(",")):
+        if not name:
+            continue
+        if name not in VARIANTS:
+            logger.warning(f"unknown preprocessing variant {name!r} in PREPROCESS_CASCADE, ignored")
+            continue
+        order.append(name)
+    return order
+
+
+def apply(gray, name):
+    """The function `apply` runs variant `name` on the grayscale page; None when it does not apply."""
+    return VARIANTS[name](gray)
+
+
+def record(name, outcome):
+    CASCADE_VARIANTS.labels(name, outcome).inc()
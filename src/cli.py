@@ -0,0 +1,163 @@
+"""
+Offline bulk extraction over local receipt files, without the web service.
+
+    python -m src.cli "images/*.jpeg" --output results.jsonl
+    python -m src.cli /archive/2023 --output results.csv --workers 16
+
+Output is appended one row per file as results arrive, so an interrupted run can simply be started
+again: files already present in the output are skipped.
+"""
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from loguru import logger
+from src import config
+from src.schemas import ErrorObject
+
+FIELDS = ["path", "total", "error", "elapsed"]
+EXTENSIONS = (".jpeg", ".jpg", ".png", ".tif", ".tiff", ".pdf")
+
+_engine = None
+
+
+def collect_paths(sources):
+    """
+    The function `collect_paths` expands directories (recursively) and glob patterns into a sorted
+    list of receipt files.
+
+    :param sources: The `sources` parameter is a list of directories, files or glob patterns
+    :return: a sorted list of unique file paths.
+    """
+    paths = set()
+    for source in sources:
+        if os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                paths.update(os.path.join(root, name) for name in files if name.lower().endswith(EXTENSIONS))
+        else:
+            paths.update(path for path in glob.glob(source, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def read_done(output, retry_errors):
+    """
+    The function `read_done` loads the paths already recorded in an existing output file.
+
+    :param output: The `output` parameter is the CSV or JSONL results file
+    :param retry_errors: The `retry_errors` parameter makes failed rows count as not yet processed
+    :return: a set of paths to skip.
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, newline="") as f:
+        if output.endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            if retry_errors and row.get("error"):
+                continue
+            done.add(row["path"])
+    return done
+
+
+def _init_worker(log_level):
+    global _engine
+    # one tesseract thread per process: the pool already provides the parallelism
+    from src import scheduler
+    scheduler.set_mode("throughput")
+    from src.inferenceEngine import InferenceEngine
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+    _engine = InferenceEngine("cli")
+
+
+def process_file(path):
+    """
+    The function `process_file` runs validation, preprocessing, OCR and total extraction on one
+    local file inside a pool worker.
+
+    :param path: The `path` parameter is the file to process
+    :return: an output row dict.
+    """
+    start = time.monotonic()
+    row = {"path": path, "total": None, "error": None}
+    try:
+        with open(path, "rb") as f:
+            file_bytes = f.read()
+        _engine.request_id = os.path.basename(path)
+        ext, pages = _engine.validate_file(file_bytes)
+        row["total"] = _engine.get_bill(_engine.extract_text(file_bytes, ext, pages))
+    except ErrorObject as e:
+        row["error"] = e.error_obj.error.status
+    except Exception as e:
+        logger.warning(f"REQUEST_ID : {path} | failed --- {e}")
+        row["error"] = "500"
+    row["elapsed"] = round(time.monotonic() - start, 4)
+    return row
+
+
+class ResultWriter:
+    """The class `ResultWriter` appends rows to a CSV or JSONL file, flushing after every row."""
+    def __init__(self, output):
+        self.csv = output.endswith(".csv")
+        new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+        self.f = open(output, "a", newline="")
+        if self.csv:
+            self.writer = csv.DictWriter(self.f, fieldnames=FIELDS)
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, row):
+        if self.csv:
+            self.writer.writerow(row)
+        else:
+            self.f.write(json.dumps(row) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract receipt totals from local files.")
+    parser.add_argument("sources", nargs="+", help="directories, files or glob patterns")
+    parser.add_argument("--output", "-o", required=True, help="results file (.csv or .jsonl)")
+    parser.add_argument("--workers", "-w", type=int, default=config.CPU_COUNT, help="number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=4, help="files handed to a worker at a time")
+    parser.add_argument("--retry-errors", action="store_true", help="reprocess files that failed previously")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    paths = collect_paths(args.sources)
+    done = read_done(args.output, args.retry_errors)
+    todo = [path for path in paths if path not in done]
+    logger.info(f"{len(paths)} files found, {len(paths) - len(todo)} already processed, {len(todo)} to go")
+    if not todo:
+        return 0
+
+    writer = ResultWriter(args.output)
+    start = time.monotonic()
+    failed = 0
+    try:
+        with multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(args.log_level,)) as pool:
+            for count, row in enumerate(pool.imap_unordered(process_file, todo, chunksize=args.chunksize), 1):
+                writer.write(row)
+                failed += bool(row["error"])
+                if count % 100 == 0 or count == len(todo):
+                    rate = count / (time.monotonic() - start)
+                    logger.info(f"{count}/{len(todo)} files | {failed} failed | {rate:.2f} files/sec")
+    finally:
+        writer.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
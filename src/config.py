@@ -0,0 +1,210 @@
+import os
+from src.cpus import available_cpus
+
+
+def env_int(name, default):
+    """
+    The function `env_int` reads an integer setting from the environment.
+
+    :param name: The `name` parameter is the name of the environment variable
+    :param default: The `default` parameter is returned when the variable is unset or empty
+    :return: the integer value of the setting.
+    """
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name, default):
+    """
+    The function `env_float` reads a float setting from the environment.
+
+    :param name: The `name` parameter is the name of the environment variable
+    :param default: The `default` parameter is returned when the variable is unset or empty
+    :return: the float value of the setting.
+    """
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def env_bool(name, default):
+    """
+    The function `env_bool` reads a boolean setting ("1"/"true"/"yes"/"on") from the environment.
+
+    :param name: The `name` parameter is the name of the environment variable
+    :param default: The `default` parameter is returned when the variable is unset or empty
+    :return: the boolean value of the setting.
+    """
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# cores this process may use (affinity and cgroup CPU quota), not the host's
+CPU_COUNT = available_cpus()
+# gunicorn workers sharing those cores; src.gunicorn_conf exports its worker count here
+WEB_CONCURRENCY = env_int("WEB_CONCURRENCY", 1)
+# this worker's share of the cores: the OCR and preprocessing pools and their threads are sized to it
+WORKER_CPUS = env_int("WORKER_CPUS", max(1, CPU_COUNT // WEB_CONCURRENCY))
+# how OCR calls share the worker's cores (see src.scheduler): "throughput" (one thread per image),
+# "latency" (OCR_MAX_THREADS threads per image, fewer at once), "adaptive" (many threads while idle,
+# one each under load) or "off" (tesseract and OpenCV defaults: every call may use every core)
+OCR_SCHEDULING = os.getenv("OCR_SCHEDULING", "adaptive")
+# most threads a single OCR call gets; tesseract gains little beyond 4
+OCR_MAX_THREADS = env_int("OCR_MAX_THREADS", min(WORKER_CPUS, 4))
+
+# "inline" runs every stage on the event loop (legacy behaviour), "pool" awaits the download and
+# hands preprocessing/OCR to bounded worker pools.
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "pool")
+# "thread" or "process"; tesseract and OpenCV release the GIL so threads are usually enough.
+STAGE_POOL_KIND = os.getenv("STAGE_POOL_KIND", "thread")
+
+DOWNLOAD_CONCURRENCY = env_int("DOWNLOAD_CONCURRENCY", 32)
+DOWNLOAD_QUEUE_DEPTH = env_int("DOWNLOAD_QUEUE_DEPTH", 64)
+PREPROCESS_CONCURRENCY = env_int("PREPROCESS_CONCURRENCY", WORKER_CPUS)
+PREPROCESS_QUEUE_DEPTH = env_int("PREPROCESS_QUEUE_DEPTH", 32)
+OCR_CONCURRENCY = env_int("OCR_CONCURRENCY", max(1, WORKER_CPUS // OCR_MAX_THREADS)
+                          if OCR_SCHEDULING == "latency" else WORKER_CPUS)
+OCR_QUEUE_DEPTH = env_int("OCR_QUEUE_DEPTH", 32)
+
+MAX_FILE_SIZE_BYTES = env_int("MAX_FILE_SIZE_MB", 10) * 1024 * 1024
+# filetype inspects at most the first 261 bytes of a file.
+FILE_SNIFF_BYTES = 261
+DOWNLOAD_CONNECT_TIMEOUT_SEC = env_float("DOWNLOAD_CONNECT_TIMEOUT_SEC", 5.0)
+DOWNLOAD_READ_TIMEOUT_SEC = env_float("DOWNLOAD_READ_TIMEOUT_SEC", 30.0)
+HTTP_MAX_CONNECTIONS = env_int("HTTP_MAX_CONNECTIONS", 100)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = env_int("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+# comma separated directories file:// urls may point into; empty refuses file:// urls.
+FILE_URL_ROOTS = os.getenv("FILE_URL_ROOTS", "")
+# s3://bucket/key urls, read with boto3 (the `s3` extra); S3_ENDPOINT_URL points at MinIO or another
+# S3-compatible store, empty uses AWS.
+S3_ENABLED = env_bool("S3_ENABLED", False)
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "")
+S3_REGION = os.getenv("S3_REGION", "")
+S3_MAX_CONNECTIONS = env_int("S3_MAX_CONNECTIONS", DOWNLOAD_CONCURRENCY)
+
+RESULT_CACHE_ENABLED = env_bool("RESULT_CACHE_ENABLED", True)
+RESULT_CACHE_MAX_ENTRIES = env_int("RESULT_CACHE_MAX_ENTRIES", 1024)
+URL_CACHE_TTL_SEC = env_int("URL_CACHE_TTL_SEC", 3600)
+# sqlite file shared by every gunicorn worker on the host; empty keeps the cache in memory only.
+RESULT_CACHE_DISK_PATH = os.getenv("RESULT_CACHE_DISK_PATH", "")
+RESULT_CACHE_DISK_MAX_ENTRIES = env_int("RESULT_CACHE_DISK_MAX_ENTRIES", 100000)
+
+BATCH_MAX_URLS = env_int("BATCH_MAX_URLS", 50)
+# items of one batch processed at once; each item pipelines download -> preprocess -> OCR.
+BATCH_CONCURRENCY = env_int("BATCH_CONCURRENCY", OCR_CONCURRENCY)
+
+# calls slower than this are always logged at WARNING; faster ones are logged for a sampled fraction.
+SLOW_LOG_SYNC_SEC = env_float("SLOW_LOG_SYNC_SEC", 3)
+TIMING_LOG_SAMPLE_RATE = env_float("TIMING_LOG_SAMPLE_RATE", 0.01)
+
+# "full" binarizes the decoded page as is; "adaptive" crops to the receipt and rescales it so the
+# text has roughly TARGET_CHAR_HEIGHT_PX tall characters before thresholding and OCR.
+PREPROCESS_MODE = os.getenv("PREPROCESS_MODE", "full")
+TARGET_CHAR_HEIGHT_PX = env_int("TARGET_CHAR_HEIGHT_PX", 28)
+# 1.0 only ever shrinks pages; raise it to also enlarge small print (slower OCR, sometimes better reads).
+PREPROCESS_MAX_SCALE = env_float("PREPROCESS_MAX_SCALE", 1.0)
+# "full" OCRs the whole page; "lower" OCRs only the bottom OCR_LOWER_FRACTION of it, where totals
+# are printed, and falls back to the full page when no total is found there.
+OCR_REGION = os.getenv("OCR_REGION", "full")
+OCR_LOWER_FRACTION = env_float("OCR_LOWER_FRACTION", 0.5)
+# decode straight to grayscale and reuse per-thread scratch buffers while binarizing, instead of a
+# BGR frame plus a fresh array per step; lowers peak memory per worker.
+LEAN_PREPROCESSING = env_bool("LEAN_PREPROCESSING", False)
+# with lean preprocessing, JPEGs at least twice this long are decoded at 1/2, 1/4 or 1/8 scale; 0 keeps
+# full resolution.
+DECODE_MAX_SIDE = env_int("DECODE_MAX_SIDE", 0)
+# comma separated preprocessing variants (see src/cascade.py) OCRed in turn until one yields a total
+# with at least CASCADE_MIN_CONFIDENCE; empty keeps the single median blur + adaptive threshold pass.
+PREPROCESS_CASCADE = os.getenv("PREPROCESS_CASCADE", "")
+CASCADE_MIN_CONFIDENCE = env_float("CASCADE_MIN_CONFIDENCE", 0.6)
+# start every variant at once on the stage pools and keep the first confident one (lower latency,
+# more CPU per request).
+CASCADE_PARALLEL = env_bool("CASCADE_PARALLEL", False)
+
+# "pytesseract" spawns the tesseract binary per image through a temp file; "tesseract-stdin" spawns it
+# but pipes the raw pixels in and the text out, without touching disk; "tesserocr" keeps long-lived
+# in-process tesseract handles (one per concurrent OCR call) fed straight from the NumPy array.
+OCR_BACKEND = os.getenv("OCR_BACKEND", "pytesseract")
+TESSERACT_LANG = os.getenv("TESSERACT_LANG", "eng")
+TESSERACT_PSM = env_int("TESSERACT_PSM", 3)
+TESSERACT_OEM = env_int("TESSERACT_OEM", 3)
+OCR_HANDLE_POOL_SIZE = env_int("OCR_HANDLE_POOL_SIZE", OCR_CONCURRENCY)
+
+MAX_PDF_PAGES = env_int("MAX_PDF_PAGES", 2)
+PDF_DPI = env_int("PDF_DPI", 300)
+# a page whose embedded text layer has at least this many characters is not OCRed at all.
+PDF_MIN_TEXT_CHARS = env_int("PDF_MIN_TEXT_CHARS", 20)
+# multi-page TIFFs (scanner batches): more frames than this are rejected with a 422 like long PDFs;
+# the frames of one TIFF are decoded and OCRed TIFF_FRAME_CONCURRENCY at a time.
+MAX_TIFF_PAGES = env_int("MAX_TIFF_PAGES", 10)
+TIFF_FRAME_CONCURRENCY = env_int("TIFF_FRAME_CONCURRENCY", OCR_CONCURRENCY)
+
+# sqlite queue shared by the web workers (producers) and the job workers (consumers).
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "/tmp/receipt_jobs.db")
+JOB_WORKER_CONCURRENCY = env_int("JOB_WORKER_CONCURRENCY", OCR_CONCURRENCY)
+JOB_POLL_INTERVAL_SEC = env_float("JOB_POLL_INTERVAL_SEC", 0.5)
+# a job left "running" this long is assumed to belong to a dead worker and is queued again.
+JOB_STALE_AFTER_SEC = env_int("JOB_STALE_AFTER_SEC", 600)
+JOB_MAX_ATTEMPTS = env_int("JOB_MAX_ATTEMPTS", 3)
+JOB_RETENTION_SEC = env_int("JOB_RETENTION_SEC", 7 * 24 * 3600)
+
+# append-only sqlite archive of every extraction (hash, url, total, OCR text, stage timings), written
+# by a background thread per worker in batches of up to ARCHIVE_BATCH_SIZE every ARCHIVE_FLUSH_INTERVAL_SEC.
+ARCHIVE_ENABLED = env_bool("ARCHIVE_ENABLED", False)
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "/tmp/receipt_archive.db")
+ARCHIVE_BATCH_SIZE = env_int("ARCHIVE_BATCH_SIZE", 500)
+ARCHIVE_FLUSH_INTERVAL_SEC = env_float("ARCHIVE_FLUSH_INTERVAL_SEC", 1)
+ARCHIVE_QUEUE_SIZE = env_int("ARCHIVE_QUEUE_SIZE", 10000)
+
+# requests extracted at once per worker (each then queues on the download/preprocess/OCR stages) and
+# requests allowed to wait for a slot; beyond that the endpoint answers 503 with Retry-After.
+ADMISSION_CONCURRENCY = env_int("ADMISSION_CONCURRENCY", 2 * OCR_CONCURRENCY)
+ADMISSION_QUEUE_DEPTH = env_int("ADMISSION_QUEUE_DEPTH", 4 * OCR_CONCURRENCY)
+RETRY_AFTER_SEC = env_int("RETRY_AFTER_SEC", 2)
+# token bucket per client key (RATE_LIMIT_KEY_HEADER, else the client address), per worker; 0 disables it.
+RATE_LIMIT_PER_SEC = env_float("RATE_LIMIT_PER_SEC", 0)
+RATE_LIMIT_BURST = env_int("RATE_LIMIT_BURST", 20)
+RATE_LIMIT_KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER", "X-API-Key")
+RATE_LIMIT_MAX_CLIENTS = env_int("RATE_LIMIT_MAX_CLIENTS", 10000)
+# time budget of a request; clients may ask for less with an X-Request-Timeout header (seconds).
+# Kept below gunicorn's --timeout so work is abandoned before the worker is killed.
+REQUEST_DEADLINE_SEC = env_float("REQUEST_DEADLINE_SEC", 170)
+
+# a receipt run through the whole pipeline at startup so the first request finds everything loaded.
+WARMUP_ENABLED = env_bool("WARMUP_ENABLED", True)
+WARMUP_IMAGE = os.getenv("WARMUP_IMAGE", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                      "images", "3331e5f3.jpeg"))
+
+# near-duplicate detection: a receipt whose perceptual hash is within DEDUP_MAX_DISTANCE bits (of 256)
+# of one already processed gets that result without OCR and is flagged as a probable duplicate.
+DEDUP_ENABLED = env_bool("DEDUP_ENABLED", False)
+DEDUP_MAX_DISTANCE = env_int("DEDUP_MAX_DISTANCE", 20)
+DEDUP_MAX_ENTRIES = env_int("DEDUP_MAX_ENTRIES", 200000)
+# sqlite file shared by every worker on the host; empty keeps the index in memory only.
+DEDUP_DISK_PATH = os.getenv("DEDUP_DISK_PATH", "")
+# how often a worker picks up hashes added by the other workers.
+DEDUP_SYNC_SEC = env_float("DEDUP_SYNC_SEC", 5)
+
+# tracing is on when spans have somewhere to go: JSON lines appended to TRACE_FILE and/or OTLP/HTTP
+# JSON posted to TRACE_OTLP_ENDPOINT (e.g. http://otel-collector:4318/v1/traces).
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+# fraction of requests traced when the caller sends no traceparent header (which otherwise decides).
+TRACE_SAMPLE_RATE = env_float("TRACE_SAMPLE_RATE", 0.01)
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "receipt-scanner")
+TRACE_EXPORT_INTERVAL_SEC = env_float("TRACE_EXPORT_INTERVAL_SEC", 2.0)
+TRACE_QUEUE_SIZE = env_int("TRACE_QUEUE_SIZE", 10000)
+
+# workers are recycled on memory instead of after a fixed number of requests: one whose RSS exceeds
+# MEMORY_MAX_RSS_MB, or grew faster than MEMORY_MAX_GROWTH_MB_PER_HOUR over the last
+# MEMORY_GROWTH_WINDOW_SEC, drains its in-flight requests and exits for gunicorn to replace. 0 disables a check.
+MEMORY_MAX_RSS_MB = env_int("MEMORY_MAX_RSS_MB", 1024)
+MEMORY_MAX_GROWTH_MB_PER_HOUR = env_float("MEMORY_MAX_GROWTH_MB_PER_HOUR", 0)
+MEMORY_GROWTH_WINDOW_SEC = env_int("MEMORY_GROWTH_WINDOW_SEC", 1800)
+MEMORY_CHECK_INTERVAL_SEC = env_float("MEMORY_CHECK_INTERVAL_SEC", 10)
+# each worker lowers both limits by a random fraction up to this, so equally loaded workers do not
+# cross them (and restart and warm up) together; the part of --max-requests-jitter it replaces
+MEMORY_LIMIT_JITTER = env_float("MEMORY_LIMIT_JITTER", 0.1)
+# frames recorded per allocation once tracemalloc is started through the memory endpoint
+MEMORY_TRACE_FRAMES = env_int("MEMORY_TRACE_FRAMES", 16)
@@ -0,0 +1,101 @@
+"""
+CPU detection that respects container limits.
+
+`os.cpu_count()` reports the cores of the host; a container pinned to a cpuset or capped by a cgroup
+CPU quota (docker `--cpus`, Kubernetes CPU limits) can only use a fraction of them. This module has
+no other imports so `src.gunicorn_conf` can size the worker count before `src.config` is loaded.
+"""
+import math
+import os
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# cgroup v1 mounts the cpu controller under one of these names
+CGROUP_V1_CPU_DIRS = ("cpu", "cpu,cpuacct", "cpuacct,cpu")
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _own_cgroups():
+    # "hierarchy:controllers:path" lines; cgroup v2 is the single "0::/path" line
+    groups = {}
+    for line in (_read("/proc/self/cgroup") or "").splitlines():
+        parts = line.split(":", 2)
+        if len(parts) == 3:
+            for controller in parts[1].split(",") if parts[1] else [""]:
+                groups[controller] = parts[2]
+    return groups
+
+
+def _ancestors(base, path):
+    # the process's group and every parent up to the mount point: a limit on any of them applies
+    directory = os.path.join(base, path.lstrip("/"))
+    while True:
+        yield directory
+        if os.path.normpath(directory) == os.path.normpath(base):
+            return
+        directory = os.path.dirname(directory)
+
+
+def _quota_v2(directory):
+    value = _read(os.path.join(directory, "cpu.max"))
+    if not value:
+        return None
+    quota, _, period = value.partition(" ")
+    if quota == "max":
+        return None
+    return int(quota) / int(period or 100000)
+
+
+def _quota_v1(directory):
+    quota = _read(os.path.join(directory, "cpu.cfs_quota_us"))
+    period = _read(os.path.join(directory, "cpu.cfs_period_us"))
+    if not quota or not period or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def cgroup_cpu_limit():
+    """
+    The function `cgroup_cpu_limit` reads the CPU quota of this process's cgroup (v2 `cpu.max`, or v1
+    `cpu.cfs_quota_us` / `cpu.cfs_period_us`), the smallest one along its hierarchy.
+
+    :return: the quota in cores (e.g. 1.5), or None when there is none or it cannot be read.
+    """
+    groups = _own_cgroups()
+    limits = []
+    try:
+        if "" in groups:
+            limits += [_quota_v2(directory) for directory in _ancestors(CGROUP_ROOT, groups[""])]
+        if "cpu" in groups:
+            for name in CGROUP_V1_CPU_DIRS:
+                base = os.path.join(CGROUP_ROOT, name)
+                if os.path.isdir(base):
+                    limits += [_quota_v1(directory) for directory in _ancestors(base, groups["cpu"])]
+                    break
+    except ValueError:
+        return None
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+
+def available_cpus():
+    """
+    The function `available_cpus` counts the cores this process may actually use: the CPUs it is
+    allowed to run on, reduced to the cgroup quota (rounded up) when there is one.
+
+    :return: a core count, at least 1.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, math.ceil(limit))
+    return max(1, cpus)
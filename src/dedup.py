@@ -0,0 +1,222 @@
+"""
+Near-duplicate detection on perceptual hashes.
+
+A receipt photographed twice, or re-uploaded after recompression, has different bytes (so the result
+cache misses) but nearly the same perceptual hash. The index finds the closest known hash within
+`DEDUP_MAX_DISTANCE` bits with a BK-tree, and hands back that receipt's result.
+"""
+import asyncio
+import json
+import threading
+import time
+from loguru import logger
+from src import config
+from src.metrics import CACHE_EVENTS
+from src.persistence import wal_connection
+
+# hashes with almost every bit equal come from blank or uniform pages and would match each other.
+MIN_BITS_SET = 16
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def informative(phash, bits):
+    ones = bin(phash).count("1")
+    return MIN_BITS_SET <= ones <= bits - MIN_BITS_SET
+
+
+class BKTree:
+    """
+    The class `BKTree` is a Burkhard-Keller tree over Hamming distance. Children are keyed by their
+    distance to the parent, so by the triangle inequality a search within `radius` of a query only
+    descends into children keyed `d - radius .. d + radius`.
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        node = [key, value, {}, self.size]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(key, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def nearest(self, key, radius):
+        """
+        The function `nearest` finds the closest stored key within `radius`.
+
+        :return: a tuple of (distance, key, value), or None.
+        """
+        best = None
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= radius and (best is None or distance < best[0]):
+                best = (distance, node[0], node[1])
+                if distance == 0:
+                    break
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return best
+
+
+class DedupIndex:
+    """
+    The class `DedupIndex` maps perceptual hashes to the content hash and result of the receipt they
+    came from. It is kept in memory as a BK-tree and, with a disk path, persisted to sqlite so it
+    survives restarts and is shared with the other workers on the host.
+
+    The engine uses `alookup` and `aadd`, which run the sqlite catch-up, the inserts and the trims in
+    a thread instead of on the event loop.
+    """
+    def __init__(self, max_distance, max_entries, path=None, sync_every=5.0):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.path = path
+        self.sync_every = sync_every
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._local = threading.local()
+        self._last_rowid = 0
+        self._synced_at = 0.0
+        self.counters = {"hits": 0, "misses": 0, "skipped": 0}
+        if path:
+            conn = self._conn()
+            conn.execute("""CREATE TABLE IF NOT EXISTS phashes (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                phash TEXT NOT NULL, content_hash TEXT NOT NULL, result TEXT NOT NULL, created_at REAL NOT NULL)""")
+            conn.commit()
+            self._sync()
+
+    def _conn(self):
+        return wal_connection(self._local, self.path, 5)
+
+    def _sync(self):
+        # load rows written since the last sync, by this worker or any other
+        with self._sync_lock:
+            rows = self._conn().execute("SELECT id, phash, content_hash, result FROM phashes WHERE id > ? ORDER BY id",
+                                        (self._last_rowid,)).fetchall()
+            with self._lock:
+                for rowid, phash, digest, result in rows:
+                    self._last_rowid = max(self._last_rowid, rowid)
+                    self._tree.add(int(phash, 16), (digest, json.loads(result)))
+                self._synced_at = time.monotonic()
+                if self._tree.size > self.max_entries:
+                    self._trim()
+
+    def _trim(self):
+        # BK-trees do not support removal: rebuild from the newest half of the entries
+        keep = self.max_entries // 2
+        entries = []
+        stack = [self._tree.root]
+        while stack:
+            node = stack.pop()
+            entries.append((node[3], node[0], node[1]))
+            stack.extend(node[2].values())
+        entries.sort(key=lambda entry: entry[0])
+        self._tree = BKTree()
+        for _, key, value in entries[-keep:]:
+            self._tree.add(key, value)
+        if self.path:
+            conn = self._conn()
+            conn.execute("DELETE FROM phashes WHERE id NOT IN (SELECT id FROM phashes ORDER BY id DESC LIMIT ?)", (keep,))
+            conn.commit()
+        logger.info(f"dedup index trimmed to {self._tree.size} entries")
+
+    def _count(self, name):
+        self.counters[name] += 1
+        CACHE_EVENTS.labels(f"dedup_{name}").inc()
+
+    def lookup(self, phash, bits):
+        """
+        The function `lookup` finds the closest receipt already processed.
+
+        :param phash: The `phash` parameter is the perceptual hash of the new receipt
+        :param bits: The `bits` parameter is the hash length, used to reject uninformative hashes
+        :return: a dict with `contentHash`, `distance` and `result`, or None.
+        """
+        if not informative(phash, bits):
+            self._count("skipped")
+            return None
+        if self._sync_due():
+            self._sync()
+        return self._nearest(phash)
+
+    async def alookup(self, phash, bits):
+        if not informative(phash, bits):
+            self._count("skipped")
+            return None
+        if self._sync_due():
+            await asyncio.to_thread(self._sync)
+        return self._nearest(phash)
+
+    def _sync_due(self):
+        return self.path and time.monotonic() - self._synced_at > self.sync_every
+
+    def _nearest(self, phash):
+        with self._lock:
+            match = self._tree.nearest(phash, self.max_distance)
+        if match is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        distance, _, (digest, result) = match
+        return {"contentHash": digest, "distance": distance, "result": result}
+
+    async def aadd(self, phash, bits, digest, result):
+        # in memory, only an add that trims the tree is worth a thread
+        if self.path or self._tree.size >= self.max_entries:
+            await asyncio.to_thread(self.add, phash, bits, digest, result)
+        else:
+            self.add(phash, bits, digest, result)
+
+    def add(self, phash, bits, digest, result):
+        if not informative(phash, bits):
+            return
+        if self.path:
+            conn = self._conn()
+            conn.execute("INSERT INTO phashes (phash, content_hash, result, created_at) VALUES (?, ?, ?, ?)",
+                         (format(phash, "x"), digest, json.dumps(result), time.time()))
+            conn.commit()
+            # load it, and whatever the other workers added meanwhile, into the tree
+            self._sync()
+            return
+        with self._lock:
+            self._tree.add(phash, (digest, result))
+            if self._tree.size > self.max_entries:
+                self._trim()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=self._tree.size, maxDistance=self.max_distance, disk=self.path or None)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    The function `get_index` returns the worker-wide `DedupIndex`, or None when dedup is disabled.
+    With a disk path the first call loads the whole index: the application makes it at startup, in a thread.
+    """
+    global _index
+    if _index is None and config.DEDUP_ENABLED:
+        with _index_lock:
+            if _index is None:
+                _index = DedupIndex(config.DEDUP_MAX_DISTANCE, config.DEDUP_MAX_ENTRIES,
+                                    config.DEDUP_DISK_PATH or None, config.DEDUP_SYNC_SEC)
+    return _index
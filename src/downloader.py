@@ -0,0 +1,67 @@
+import asyncio
+import httpx
+import requests
+from loguru import logger
+from src import config
+
+_client = None
+_client_loop = None
+_session = None
+
+
+def _timeout():
+    return httpx.Timeout(config.DOWNLOAD_READ_TIMEOUT_SEC, connect=config.DOWNLOAD_CONNECT_TIMEOUT_SEC)
+
+
+def start_client():
+    """
+    The function `start_client` creates the worker-wide connection-pooled async HTTP client. It is
+    called from the application lifespan so every download reuses open connections and TLS sessions.
+
+    :return: the shared `httpx.AsyncClient`.
+    """
+    global _client, _client_loop
+    if _client is None:
+        try:
+            _client_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            _client_loop = None
+        limits = httpx.Limits(max_connections=config.HTTP_MAX_CONNECTIONS,
+                              max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS)
+        _client = httpx.AsyncClient(timeout=_timeout(), limits=limits, follow_redirects=True)
+        logger.debug("shared http client started")
+    return _client
+
+
+def get_client():
+    """
+    The function `get_client` returns the shared async client, starting it when used outside the app.
+    Pooled connections belong to one event loop, so a caller running a different loop (CLI,
+    benchmarks) gets a fresh client.
+    """
+    global _client
+    if _client is not None and _client_loop is not None and _client_loop is not asyncio.get_running_loop():
+        _client = None
+    return _client if _client is not None else start_client()
+
+
+async def close_client():
+    global _client
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.aclose()
+    _client = None
+
+
+def get_session():
+    """
+    The function `get_session` returns a shared `requests.Session` for the synchronous download path,
+    so it also benefits from connection reuse.
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def sync_timeout():
+    return (config.DOWNLOAD_CONNECT_TIMEOUT_SEC, config.DOWNLOAD_READ_TIMEOUT_SEC)
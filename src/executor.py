@@ -0,0 +1,154 @@
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from loguru import logger
+from src.schemas import ErrorObject
+from src import config
+from src.metrics import STAGE_IN_FLIGHT, REJECTIONS
+from src import admission
+from src import tracing
+
+
+class Stage:
+    """
+    The class `Stage` is a bounded execution lane for one pipeline stage. At most `concurrency` calls
+    run at once and up to `queue_depth` more may wait for a slot; beyond that the call is rejected with
+    a 503 instead of piling unbounded work onto the worker.
+    """
+    def __init__(self, name, concurrency, queue_depth, pool=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.pool = pool
+        self.waiting = 0
+        self.running = 0
+        self._slots = None
+        self._loop = None
+
+    def _loop_slots(self):
+        # asyncio primitives bind to the loop that first waits on them; give every loop its own
+        # semaphore so the stage survives callers that run several loops (CLI, benchmarks, tests).
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+        return self._slots
+
+    async def run(self, func, *args, request_id=None):
+        """
+        The function `run` executes `func(*args)` inside the stage limits. Coroutine functions are
+        awaited on the event loop, plain functions are sent to the stage pool.
+
+        :param func: The `func` parameter is the callable implementing the stage
+        :param request_id: The `request_id` parameter is only used for logging
+        :return: the value returned by `func`.
+        """
+        with tracing.span(f"stage.{self.name}", {"stage.waiting": self.waiting, "stage.running": self.running}) as span:
+            return await self._run(span, func, *args, request_id=request_id)
+
+    async def _run(self, span, func, *args, request_id=None):
+        admission.check_deadline(request_id, self.name)
+        if self.waiting >= self.queue_depth:
+            logger.error(f"REQUEST_ID : {request_id} | {self.name} queue full ({self.waiting} waiting) | returning 503")
+            REJECTIONS.labels(f"{self.name}_queue_full").inc()
+            raise ErrorObject({"error": {"status": "503"}}, headers={"Retry-After": str(config.RETRY_AFTER_SEC)})
+        slots = self._loop_slots()
+        waiting_gauge = STAGE_IN_FLIGHT.labels(self.name, "waiting")
+        running_gauge = STAGE_IN_FLIGHT.labels(self.name, "running")
+        self.waiting += 1
+        waiting_gauge.inc()
+        queued_at = time.monotonic()
+        try:
+            await slots.acquire()
+        finally:
+            self.waiting -= 1
+            waiting_gauge.dec()
+            span.set("stage.queue_wait_ms", round((time.monotonic() - queued_at) * 1000, 3))
+        self.running += 1
+        running_gauge.inc()
+
+        def release():
+            self.running -= 1
+            running_gauge.dec()
+            slots.release()
+
+        if asyncio.iscoroutinefunction(func) or self.pool is None:
+            try:
+                if asyncio.iscoroutinefunction(func):
+                    return await func(*args)
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, functools.partial(contextvars.copy_context().run, func, *args))
+            finally:
+                release()
+        # a caller abandoned by its deadline cannot stop a call that is already running in the pool, so
+        # the slot is only given back once the pool is actually done with it.
+        loop = asyncio.get_running_loop()
+        if isinstance(self.pool, ProcessPoolExecutor):
+            # spans opened in the worker process are not exported; the stage span still times the call
+            future = self.pool.submit(func, *args)
+        else:
+            # carry the caller's context (request id, deadline, current span) into the pool thread
+            future = self.pool.submit(contextvars.copy_context().run, func, *args)
+        future.add_done_callback(lambda _: _release_soon(loop, release))
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        return {"running": self.running, "waiting": self.waiting,
+                "concurrency": self.concurrency, "queueDepth": self.queue_depth}
+
+
+def _release_soon(loop, release):
+    try:
+        loop.call_soon_threadsafe(release)
+    except RuntimeError:
+        # the loop is gone (shutdown); nothing waits on the slot any more
+        pass
+
+
+_stages = {}
+
+
+def _make_pool(name, workers):
+    if config.STAGE_POOL_KIND == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-stage")
+
+
+def get_stage(name):
+    """
+    The function `get_stage` returns the shared `Stage` for `name`, creating it (and its pool) on
+    first use so pools are only started inside the worker process that needs them.
+
+    :param name: The `name` parameter is one of "admission", "download", "preprocess" or "ocr"
+    :return: a `Stage` instance.
+    """
+    stage = _stages.get(name)
+    if stage is None:
+        if name == "admission":
+            stage = Stage(name, config.ADMISSION_CONCURRENCY, config.ADMISSION_QUEUE_DEPTH)
+        elif name == "download":
+            stage = Stage(name, config.DOWNLOAD_CONCURRENCY, config.DOWNLOAD_QUEUE_DEPTH)
+        elif name == "preprocess":
+            stage = Stage(name, config.PREPROCESS_CONCURRENCY, config.PREPROCESS_QUEUE_DEPTH,
+                          _make_pool(name, config.PREPROCESS_CONCURRENCY))
+        elif name == "ocr":
+            stage = Stage(name, config.OCR_CONCURRENCY, config.OCR_QUEUE_DEPTH,
+                          _make_pool(name, config.OCR_CONCURRENCY))
+        else:
+            raise KeyError(name)
+        _stages[name] = stage
+    return stage
+
+
+def stage_stats():
+    return {name: stage.stats() for name, stage in _stages.items()}
+
+
+def shutdown():
+    """The function `shutdown` stops every stage pool; stages are recreated lazily afterwards."""
+    for stage in _stages.values():
+        if stage.pool is not None:
+            stage.pool.shutdown(wait=False, cancel_futures=True)
+    _stages.clear()
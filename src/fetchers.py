@@ -0,0 +1,167 @@
+"""
+Fetchers for receipt urls that are not served over http(s).
+
+Internal callers whose images already sit on this host, on a mounted volume or in an object store
+pass `file://` or `s3://` urls instead of exposing them over HTTP, which saves a network hop and the
+copies of a chunked download.
+"""
+import asyncio
+import mmap
+import os
+import threading
+from urllib.parse import unquote, urlsplit
+from loguru import logger
+from src import config
+from src.schemas import ErrorObject
+
+HTTP_SCHEMES = ("http", "https")
+
+
+class FileFetcher:
+    """
+    The class `FileFetcher` reads `file://` urls whose real path (symlinks resolved) lies under one of
+    the allow-listed `FILE_URL_ROOTS`. The file is memory-mapped instead of read, so the buffer handed
+    to validation and decoding is the page cache itself: no copy is made, and pages of a file that is
+    rejected early are never read.
+    """
+    scheme = "file"
+
+    def __init__(self, roots):
+        self.roots = [os.path.realpath(root) for root in roots]
+
+    def resolve(self, url):
+        """
+        The function `resolve` maps a `file://` url to a path under an allowed root.
+
+        :return: the real path, or None when the url points elsewhere.
+        """
+        parts = urlsplit(url)
+        if parts.netloc not in ("", "localhost"):
+            return None
+        path = os.path.realpath(unquote(parts.path))
+        if any(os.path.commonpath([path, root]) == root for root in self.roots):
+            return path
+        return None
+
+    def fetch(self, url, request_id=None):
+        """
+        The function `fetch` maps the file behind a `file://` url.
+
+        :param url: The `url` parameter is the `file://` url
+        :param request_id: The `request_id` parameter tags the logs
+        :return: a read-only buffer over the file (a memoryview of the mapping; b"" for an empty file).
+        """
+        path = self.resolve(url)
+        if path is None:
+            logger.error(f"REQUEST_ID : {request_id} | {url} is outside FILE_URL_ROOTS | returning 422")
+            raise ErrorObject({"error": {"status": "422"}})
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b""
+                # the mapping holds its own reference to the file, which can be closed right away
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except OSError as e:
+            logger.error(f"REQUEST_ID : {request_id} | unable to read {path} --- {e} | returning 422")
+            raise ErrorObject({"error": {"status": "422"}})
+
+    async def afetch(self, url, request_id=None):
+        # mapping is a couple of system calls; the pages are read later, by whoever touches them
+        return self.fetch(url, request_id)
+
+
+class S3Fetcher:
+    """
+    The class `S3Fetcher` reads `s3://bucket/key` urls from S3 or any S3-compatible store (MinIO,
+    Ceph, moto) through one boto3 client per process, whose connection pool is shared by every
+    request. Credentials come from the usual AWS environment variables, config files or instance role.
+    """
+    scheme = "s3"
+
+    def __init__(self, endpoint_url, region, max_connections):
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import BotoCoreError, ClientError
+        client_config = Config(max_pool_connections=max_connections,
+                               connect_timeout=config.DOWNLOAD_CONNECT_TIMEOUT_SEC,
+                               read_timeout=config.DOWNLOAD_READ_TIMEOUT_SEC,
+                               retries={"max_attempts": 2})
+        self._client = boto3.session.Session().client("s3", endpoint_url=endpoint_url or None,
+                                                      region_name=region or None, config=client_config)
+        self._errors = (BotoCoreError, ClientError)
+
+    def fetch(self, url, request_id=None):
+        """
+        The function `fetch` downloads an object, refusing it with a 413 from its declared size before
+        the body is read.
+
+        :param url: The `url` parameter is the `s3://bucket/key` url
+        :param request_id: The `request_id` parameter tags the logs
+        :return: the object bytes.
+        """
+        parts = urlsplit(url)
+        bucket, key = parts.netloc, unquote(parts.path.lstrip("/"))
+        try:
+            obj = self._client.get_object(Bucket=bucket, Key=key)
+            body = obj["Body"]
+            try:
+                if obj.get("ContentLength", 0) > config.MAX_FILE_SIZE_BYTES:
+                    logger.error(f"REQUEST_ID : {request_id} | payload too large ({obj['ContentLength']} bytes) | returning 413")
+                    raise ErrorObject({"error": {"status": "413"}})
+                return body.read()
+            finally:
+                body.close()
+        except self._errors as e:
+            logger.error(f"REQUEST_ID : {request_id} | unable to fetch {url} --- {e} | returning 422")
+            raise ErrorObject({"error": {"status": "422"}})
+
+    async def afetch(self, url, request_id=None):
+        # boto3 is blocking; its client is thread-safe
+        return await asyncio.to_thread(self.fetch, url, request_id)
+
+
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+
+def get_fetcher(scheme):
+    """
+    The function `get_fetcher` returns this process's fetcher for a url scheme, built on first use.
+
+    :param scheme: The `scheme` parameter is the url scheme, e.g. "file" or "s3"
+    :return: the fetcher, or None when the scheme is not enabled.
+    """
+    if scheme not in _fetchers:
+        with _fetchers_lock:
+            if scheme not in _fetchers:
+                _fetchers[scheme] = _create_fetcher(scheme)
+    return _fetchers[scheme]
+
+
+def _create_fetcher(scheme):
+    if scheme == "file":
+        roots = [root.strip() for root in config.FILE_URL_ROOTS.split(",") if root.strip()]
+        return FileFetcher(roots) if roots else None
+    if scheme == "s3" and config.S3_ENABLED:
+        try:
+            return S3Fetcher(config.S3_ENDPOINT_URL, config.S3_REGION, config.S3_MAX_CONNECTIONS)
+        except ImportError:
+            logger.warning("S3_ENABLED is set but boto3 is not installed, s3:// urls are refused")
+    return None
+
+
+def for_url(url, request_id=None):
+    """
+    The function `for_url` picks the fetcher of a receipt url.
+
+    :param url: The `url` parameter is the receipt url
+    :return: the fetcher, or None for http(s) urls, which go through the pooled HTTP client.
+    """
+    scheme = urlsplit(url).scheme
+    if scheme in HTTP_SCHEMES:
+        return None
+    fetcher = get_fetcher(scheme)
+    if fetcher is None:
+        logger.error(f"REQUEST_ID : {request_id} | {scheme}:// urls are not enabled | returning 422")
+        raise ErrorObject({"error": {"status": "422"}})
+    return fetcher
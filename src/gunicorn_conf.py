@@ -0,0 +1,50 @@
+"""
+Gunicorn server hooks, loaded with `gunicorn -c python:src.gunicorn_conf ...`.
+
+Prometheus multiprocess mode keeps one sample file per worker pid in PROMETHEUS_MULTIPROC_DIR; the
+directory is wiped when the master starts and dead workers' live gauges are dropped as they exit.
+
+With `--preload` the master imports the app (OpenCV, PyMuPDF, NumPy, pytesseract ...) before forking,
+so workers start from its already loaded, copy-on-write pages instead of paying the imports again
+after every recycle. The master does imports only: running OCR or OpenCV there could start OpenMP
+thread pools, which do not survive a fork. Each worker warms its own OCR backend in the app lifespan.
+
+The worker count defaults to the cores available to the container (cgroup quota included) and is
+exported as WEB_CONCURRENCY before the app is imported, so each worker sizes its OCR pool and
+threads to its share of the cores instead of to the whole host (see src.scheduler). Set the count
+with WEB_CONCURRENCY, not `--workers`: command line flags are applied after this file is loaded, and
+(with --preload) after the app has read WEB_CONCURRENCY.
+"""
+import os
+import shutil
+from src.cpus import available_cpus
+
+workers = int(os.getenv("WEB_CONCURRENCY") or available_cpus())
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+
+def on_starting(server):
+    if server.cfg.workers != int(os.environ["WEB_CONCURRENCY"]):
+        server.log.warning(f"--workers {server.cfg.workers} differs from WEB_CONCURRENCY={os.environ['WEB_CONCURRENCY']}: "
+                           f"each worker sizes its OCR pool and threads for {os.environ['WEB_CONCURRENCY']} workers; "
+                           f"set WEB_CONCURRENCY instead of --workers")
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    # the master replaces a worker that exits, so the memory watchdog may recycle this one
+    from src import memory
+    memory.enable_recycling()
+    if server.cfg.preload_app:
+        # OCR handles are per process; never reuse one the preloading master might have built
+        from src import ocr
+        ocr.reset_backend()
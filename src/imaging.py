@@ -0,0 +1,225 @@
+import io
+import struct
+import threading
+import cv2
+import numpy as np
+from PIL import Image
+
+# receipt detection and character-height estimation run on a thumbnail of at most this many pixels
+# on its long side, so their cost does not grow with the camera resolution.
+THUMBNAIL_MAX_SIDE = 1200
+MIN_SCALE = 0.2
+# JPEG start-of-frame markers (baseline, extended, progressive, lossless, ...) that carry the size.
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+REDUCED_GRAYSCALE = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                     (2, cv2.IMREAD_REDUCED_GRAYSCALE_2))
+
+# perceptual hash grid: PHASH_SIZE x PHASH_SIZE horizontal gradient bits (256 for 16).
+PHASH_SIZE = 16
+
+_scratch = threading.local()
+
+
+def jpeg_size(buf):
+    """
+    The function `jpeg_size` reads the pixel size of a JPEG from its frame header, without decoding.
+
+    :param buf: The `buf` parameter is the encoded file (bytes or any buffer)
+    :return: `(width, height)`, or None when `buf` is not a readable JPEG.
+    """
+    view = memoryview(buf)
+    if len(view) < 4 or view[0] != 0xFF or view[1] != 0xD8:
+        return None
+    pos = 2
+    while pos + 9 <= len(view):
+        if view[pos] != 0xFF:
+            return None
+        marker = view[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack(">HH", view[pos + 5:pos + 9])
+            return width, height
+        if marker == 0xD8 or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        pos += 2 + struct.unpack(">H", view[pos + 2:pos + 4])[0]
+    return None
+
+
+def decode_gray(buf, max_side=0):
+    """
+    The function `decode_gray` decodes straight to a single channel, skipping the BGR frame and the
+    colour conversion. JPEGs whose long side is at least twice `max_side` are decoded at 1/2, 1/4 or
+    1/8 scale by libjpeg itself, so the full resolution frame is never allocated.
+
+    :param buf: The `buf` parameter is the encoded file
+    :param max_side: The `max_side` parameter is the smallest long side worth keeping; 0 never reduces
+    :return: the grayscale image, or None when it cannot be decoded.
+    """
+    encoded = np.frombuffer(buf, np.uint8)
+    size = jpeg_size(buf) if max_side else None
+    if size is not None:
+        for factor, flag in REDUCED_GRAYSCALE:
+            if max(size) // factor >= max_side:
+                return cv2.imdecode(encoded, flag)
+    return cv2.imdecode(encoded, cv2.IMREAD_GRAYSCALE)
+
+
+def tiff_frame_count(buf):
+    """
+    The function `tiff_frame_count` counts the frames (pages) of a TIFF by walking its directory
+    chain; no pixel data is decoded.
+
+    :param buf: The `buf` parameter is the encoded file
+    :return: the number of frames, 1 for a single-page TIFF.
+    """
+    with Image.open(io.BytesIO(buf)) as image:
+        return getattr(image, "n_frames", 1)
+
+
+def tiff_frame(buf, index, max_side=0):
+    """
+    The function `tiff_frame` decodes one frame of a multi-page TIFF to grayscale. `cv2.imdecode`
+    only ever returns the first frame; here only the requested frame is decompressed, so reading a
+    long TIFF frame by frame holds one page in memory at a time.
+
+    :param buf: The `buf` parameter is the encoded file
+    :param index: The `index` parameter is the frame number, from 0
+    :param max_side: The `max_side` parameter is as in `decode_gray`: frames whose long side is at
+    least twice as large are reduced by 2, 4 or 8
+    :return: the grayscale frame.
+    """
+    with Image.open(io.BytesIO(buf)) as image:
+        image.seek(index)
+        frame = image.convert("L")
+    if max_side:
+        for factor, _ in REDUCED_GRAYSCALE:
+            if max(frame.size) // factor >= max_side:
+                frame = frame.reduce(factor)
+                break
+    return np.asarray(frame)
+
+
+def scratch(shape, dtype=np.uint8):
+    """
+    The function `scratch` returns a reusable buffer of `shape` owned by the calling thread, growing
+    it only when a larger image arrives. Only for intermediates that never leave the function using
+    them: the next call on the same thread overwrites it.
+
+    :param shape: The `shape` parameter is the array shape needed
+    :return: a writable array view of that shape.
+    """
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    buf = getattr(_scratch, "buf", None)
+    if buf is None or buf.nbytes < size:
+        buf = np.empty(size, np.uint8)
+        _scratch.buf = buf
+    return buf[:size].view(dtype).reshape(shape)
+
+
+def perceptual_hash(gray, size=PHASH_SIZE):
+    """
+    The function `perceptual_hash` computes a difference hash: the page is shrunk to
+    `(size + 1) x size` pixels and each bit records whether a pixel is brighter than its left
+    neighbour. Re-encoding, rescaling or small exposure changes flip only a few bits.
+
+    :param gray: The `gray` parameter is the grayscale page (before thresholding)
+    :return: the hash as an int of `size * size` bits.
+    """
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = np.packbits((small[:, 1:] > small[:, :-1]).ravel())
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def thumbnail(gray, max_side=THUMBNAIL_MAX_SIDE):
+    """
+    The function `thumbnail` shrinks a grayscale image so its long side is at most `max_side`.
+
+    :param gray: The `gray` parameter is a single channel uint8 image
+    :return: a tuple of the thumbnail and the factor (thumbnail size / original size).
+    """
+    factor = min(1.0, max_side / max(gray.shape[:2]))
+    if factor == 1.0:
+        return gray, factor
+    return cv2.resize(gray, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA), factor
+
+
+def receipt_box(thumb, min_area=0.2, max_area=0.97):
+    """
+    The function `receipt_box` finds the bounding box of the bright paper against a darker
+    background: Otsu threshold, a closing to merge the printed text into the paper, then the largest
+    external contour.
+
+    :param thumb: The `thumb` parameter is the grayscale thumbnail
+    :param min_area: The `min_area` parameter is the smallest plausible receipt, as a fraction of the image
+    :param max_area: The `max_area` parameter is the largest box still worth cropping to
+    :return: `(x, y, w, h)` in thumbnail coordinates, or None when nothing plausible is found.
+    """
+    blurred = cv2.GaussianBlur(thumb, (5, 5), 0)
+    _, mask = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15)))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    x, y, w, h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    ratio = (w * h) / float(thumb.shape[0] * thumb.shape[1])
+    if ratio < min_area or ratio > max_area:
+        return None
+    return x, y, w, h
+
+
+def char_height(thumb, min_components=20):
+    """
+    The function `char_height` estimates the typical character height as the median height of the
+    connected components that look like glyphs.
+
+    :param thumb: The `thumb` parameter is the grayscale thumbnail (dark text on light paper)
+    :param min_components: The `min_components` parameter is the number of glyphs needed to trust the estimate
+    :return: the median glyph height in thumbnail pixels, or None.
+    """
+    ink = cv2.adaptiveThreshold(thumb, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    glyphs = (heights >= 4) & (heights <= thumb.shape[0] / 10) & (widths <= thumb.shape[1] / 4) & (areas >= 8)
+    if glyphs.sum() < min_components:
+        return None
+    return float(np.median(heights[glyphs]))
+
+
+def normalize(gray, target_char_height, max_scale=1.0):
+    """
+    The function `normalize` crops a decoded page to the receipt and rescales it so characters are
+    about `target_char_height` pixels tall. Each step is skipped when its estimate is not trustworthy,
+    so the worst case is the untouched page.
+
+    :param gray: The `gray` parameter is the full resolution grayscale page
+    :param target_char_height: The `target_char_height` parameter is the desired glyph height in pixels
+    :param max_scale: The `max_scale` parameter caps enlargement; 1.0 only ever shrinks
+    :return: the cropped and rescaled grayscale image.
+    """
+    thumb, factor = thumbnail(gray)
+    box = receipt_box(thumb)
+    if box is not None:
+        x, y, w, h = box
+        thumb = thumb[y:y + h, x:x + w]
+        margin = 4
+        x0, y0 = max(0, int(x / factor) - margin), max(0, int(y / factor) - margin)
+        x1, y1 = int((x + w) / factor) + margin, int((y + h) / factor) + margin
+        gray = gray[y0:y1, x0:x1]
+    height = char_height(thumb)
+    if height is None:
+        return gray
+    scale = min(max_scale, max(MIN_SCALE, target_char_height / (height / factor)))
+    if 0.9 <= scale <= 1.1:
+        return gray
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=interpolation)
+
+
+def lower_region(img, fraction):
+    """The function `lower_region` returns a view of the bottom `fraction` of an image, where totals are printed."""
+    return img[int(img.shape[0] * (1 - fraction)):]
@@ -1,15 +1,35 @@
 import os
+import asyncio
+import contextvars
+import time
 import requests
+import httpx
 import filetype
 from loguru import logger
 from src.schemas import ErrorObject
 import sys
 import traceback
 from src.utils import *
+from src.config import (EXECUTION_MODE, MAX_FILE_SIZE_BYTES, FILE_SNIFF_BYTES, PREPROCESS_MODE,
+                        TARGET_CHAR_HEIGHT_PX, PREPROCESS_MAX_SCALE, OCR_REGION, OCR_LOWER_FRACTION,
+                        MAX_PDF_PAGES, PDF_DPI, PDF_MIN_TEXT_CHARS, WARMUP_ENABLED, WARMUP_IMAGE,
+                        LEAN_PREPROCESSING, DECODE_MAX_SIDE, PREPROCESS_CASCADE, CASCADE_MIN_CONFIDENCE,
+                        CASCADE_PARALLEL, STAGE_POOL_KIND, MAX_TIFF_PAGES, TIFF_FRAME_CONCURRENCY)
+from src import imaging
+from src import cascade
+from src import fetchers
+from src import tracing
+from src import scheduler
+from src import archive
+from src.layout import Layout
+from src.ocr import get_backend
+from src.totals import extract_total
+from src.downloader import get_client, get_session, sync_timeout
+from src.executor import get_stage
+from src.cache import get_cache, content_hash
+from src.dedup import get_index
 import fitz
 import cv2
-import pytesseract
-import re
 import numpy as np
 
 if os.getenv("LOG_ENV" ,"production") == "production":
@@ -17,41 +37,100 @@ if os.getenv("LOG_ENV" ,"production") == "production":
     logger.remove()
     logger.add(sys.stderr, level="INFO")
 
+CASCADE_ORDER = cascade.parse_order(PREPROCESS_CASCADE)
+TIFF_FORMATS = ("tif", "tiff")
+
+# request id of the call in progress; set per call so one engine instance can serve every request.
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+
 @timed_methods
 class InferenceEngine:
-    def __init__(self , request_id):
-        self.request_id = request_id
-        self.supported_formats = ["tif" , "tiff" , 'jpeg','png','jpg']
+    def __init__(self , request_id=None):
+        self._default_request_id = request_id
+        self.supported_formats = ["tif" , "tiff" , 'jpeg','png','jpg', 'pdf']
+
+    @property
+    def request_id(self):
+        return _request_id.get() or self._default_request_id
+
+    @request_id.setter
+    def request_id(self, value):
+        self._default_request_id = value
 
     def download_and_validate(self, url):
         """
-        The function `download_and_validate_file` downloads a file from a given URL, validates its size and
-        file type, and returns the path of the downloaded file.
+        The function `download_and_validate` downloads a file from a given URL over the shared session,
+        validating its size and file type while the body streams in. `file://` and `s3://` urls are
+        read by their fetcher instead.
+
+        :param url: The `url` parameter is the URL of the file that needs to be downloaded and validated
+        :return: a tuple of the downloaded bytes, the detected file extension and the page count.
+        """
+        try:
+            fetcher = fetchers.for_url(str(url), self.request_id)
+            if fetcher is not None:
+                return self._fetched(fetcher.fetch(str(url), self.request_id))
+            with get_session().get(str(url), stream=True, timeout=sync_timeout(), headers=tracing.headers()) as img_data:
+                tracing.annotate({"http.status_code": img_data.status_code})
+                if img_data.status_code != 200:
+                    logger.error(f"REQUEST_ID : {self.request_id} | request failed unable to download , got {img_data.status_code} error | returning 422")
+                    raise ErrorObject({"error":{"status":"422"}})
+                self._check_size(img_data.headers.get("content-length"))
+                chunks, size, ext = [], 0, None
+                for chunk in img_data.iter_content(chunk_size=64 * 1024):
+                    chunks.append(chunk)
+                    size = self._check_size(size + len(chunk))
+                    if ext is None and size >= FILE_SNIFF_BYTES:
+                        ext = self._check_file_type(b"".join(chunks))
+            file_bytes = b"".join(chunks)
+            ext, pages = self.validate_file(file_bytes)
+            return file_bytes , ext, pages
+        except requests.RequestException:
+            logger.error(f"REQUEST_ID : {self.request_id} | request failed unable to download | returning 422")
+            logger.error(f"REQUEST_ID : {self.request_id} | execption trace back --- {traceback.format_exc()}")
+            raise ErrorObject({"error":{"status":"422"}})
+        except Exception as e:
+            if isinstance(e, ErrorObject):
+                raise e
+            else:
+                logger.error(f"REQUEST_ID : {self.request_id} | other exception ")
+                logger.error(f"REQUEST_ID : {self.request_id} | execption trace back --- {traceback.format_exc()}")
+                raise ErrorObject({"error":{"status":"500"}})
+
+    async def async_download_and_validate(self, url):
+        """
+        The function `async_download_and_validate` is the non-blocking counterpart of
+        `download_and_validate`. It streams the body through the shared pooled client and aborts as
+        soon as the declared or received size exceeds the limit, or the first bytes reveal an
+        unsupported file type.
 
         :param url: The `url` parameter is the URL of the file that needs to be downloaded and validated
-        :return: The function `download_and_validate_file` returns the temporary file path where the
-        downloaded file is saved.
+        :return: a tuple of the downloaded bytes, the detected file extension and the page count.
         """
-        # tmp_file_pref = "/tmp"
         try:
-            img_data = requests.get(url)
-            if img_data.status_code != 200:
-                logger.error(f"REQUEST_ID : {self.request_id} | request failed unable to download , got {img_data.status_code} error | returning 422")
-                raise ErrorObject({"error":{"status":"422"}})
-            file_bytes  =  img_data.content
-            if (sys.getsizeof(file_bytes) /10485676) > 10:
-                logger.error(f"REQUEST_ID : {self.request_id} | payload too large | returning 413")
-                raise ErrorObject({"error":{"status":"413"}})
-            ext = filetype.guess_extension(file_bytes)
-            if ext == "pdf":
-                pdf_reader = fitz.open(stream=file_bytes)
-                if len(pdf_reader) > 2:
-                    logger.error(f"REQUEST_ID: {self.request_id} | PDF file with more than 2 pages detected | returning 422")
-                    raise ErrorObject({"error": {"status": "422"}})
-            if ext not in self.supported_formats:
-                logger.error(f"REQUEST_ID : {self.request_id} | invalid filetype ,got {ext} file | returning 413")
-                raise ErrorObject({"error":{"status":"415"}})
-            return file_bytes , ext
+            fetcher = fetchers.for_url(str(url), self.request_id)
+            if fetcher is not None:
+                return self._fetched(await fetcher.afetch(str(url), self.request_id))
+            async with get_client().stream("GET", str(url), headers=tracing.headers()) as img_data:
+                tracing.annotate({"http.status_code": img_data.status_code})
+                if img_data.status_code != 200:
+                    logger.error(f"REQUEST_ID : {self.request_id} | request failed unable to download , got {img_data.status_code} error | returning 422")
+                    raise ErrorObject({"error":{"status":"422"}})
+                self._check_size(img_data.headers.get("content-length"))
+                chunks, size, ext = [], 0, None
+                async for chunk in img_data.aiter_bytes():
+                    chunks.append(chunk)
+                    size = self._check_size(size + len(chunk))
+                    if ext is None and size >= FILE_SNIFF_BYTES:
+                        ext = self._check_file_type(b"".join(chunks))
+            file_bytes = b"".join(chunks)
+            ext, pages = self.validate_file(file_bytes)
+            return file_bytes , ext, pages
+        except httpx.HTTPError:
+            logger.error(f"REQUEST_ID : {self.request_id} | request failed unable to download | returning 422")
+            logger.error(f"REQUEST_ID : {self.request_id} | execption trace back --- {traceback.format_exc()}")
+            raise ErrorObject({"error":{"status":"422"}})
         except Exception as e:
             if isinstance(e, ErrorObject):
                 raise e
@@ -60,57 +139,507 @@ class InferenceEngine:
                 logger.error(f"REQUEST_ID : {self.request_id} | execption trace back --- {traceback.format_exc()}")
                 raise ErrorObject({"error":{"status":"500"}})
 
-    def img_preprocessing(self, img):
-        """preprocess the image before callling pytesseract"""
-        image = np.frombuffer(img, np.uint8)
-        img = cv2.imdecode(image, cv2.IMREAD_COLOR)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        img = cv2.medianBlur(img, 5)
-        img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11,2)
+    def _fetched(self, buf):
+        if STAGE_POOL_KIND == "process" and not isinstance(buf, bytes):
+            # a memory map cannot be pickled to the process pools
+            buf = bytes(buf)
+        return (buf, *self.validate_file(buf))
+
+    def _check_size(self, size):
+        """
+        The function `_check_size` raises a 413 when a (declared or received) size exceeds the limit.
+
+        :param size: The `size` parameter is a byte count, or the raw Content-Length header value
+        :return: the size as an integer (0 when unknown).
+        """
+        try:
+            size = int(size) if size else 0
+        except ValueError:
+            # a malformed Content-Length: the bytes received are checked as they stream in
+            logger.warning(f"REQUEST_ID : {self.request_id} | invalid Content-Length {size!r}, ignored")
+            size = 0
+        if size > MAX_FILE_SIZE_BYTES:
+            logger.error(f"REQUEST_ID : {self.request_id} | payload too large ({size} bytes) | returning 413")
+            raise ErrorObject({"error":{"status":"413"}})
+        return size
+
+    def _check_file_type(self, head):
+        """
+        The function `_check_file_type` sniffs the file type from the first bytes of a download and
+        raises a 415 before the rest of an unsupported file is fetched.
+
+        :param head: The `head` parameter holds the first bytes of the file
+        :return: the detected file extension.
+        """
+        ext = filetype.guess_extension(head)
+        if ext != "pdf" and ext not in self.supported_formats:
+            logger.error(f"REQUEST_ID : {self.request_id} | invalid filetype ,got {ext} file | returning 415")
+            raise ErrorObject({"error":{"status":"415"}})
+        return ext
+
+    def validate_file(self, file_bytes):
+        """
+        The function `validate_file` checks the size, file type and page count of downloaded bytes.
+
+        :param file_bytes: The `file_bytes` parameter is the raw content of the downloaded file
+        :return: the detected file extension and the page count (PDF pages, TIFF frames, 1 for other
+        images), which the extraction takes along instead of opening the document again.
+        """
+        self._check_size(len(file_bytes))
+        pages = 1
+        ext = self._check_file_type(file_bytes)
+        tracing.annotate({"file.bytes": len(file_bytes), "file.type": ext})
+        if ext == "pdf":
+            with fitz.open(stream=file_bytes, filetype="pdf") as pdf_reader:
+                pages = len(pdf_reader)
+            tracing.annotate({"pdf.pages": pages})
+            if pages > MAX_PDF_PAGES:
+                logger.error(f"REQUEST_ID: {self.request_id} | PDF file with more than {MAX_PDF_PAGES} pages detected | returning 422")
+                raise ErrorObject({"error": {"status": "422"}})
+        if ext in TIFF_FORMATS:
+            pages = imaging.tiff_frame_count(file_bytes)
+            tracing.annotate({"tiff.pages": pages})
+            if pages > MAX_TIFF_PAGES:
+                logger.error(f"REQUEST_ID: {self.request_id} | TIFF file with more than {MAX_TIFF_PAGES} pages detected | returning 422")
+                raise ErrorObject({"error": {"status": "422"}})
+        if ext not in self.supported_formats:
+            logger.error(f"REQUEST_ID : {self.request_id} | invalid filetype ,got {ext} file | returning 415")
+            raise ErrorObject({"error":{"status":"415"}})
+        return ext, pages
+
+    def img_preprocessing(self, img, with_phash=False):
+        """preprocess the image before callling pytesseract
+
+        :param with_phash: The `with_phash` parameter also returns the perceptual hash of the page,
+        taken from the grayscale image before thresholding, as `(image, phash)`
+        """
+        img = self._decode(img)
+        if with_phash:
+            phash = imaging.perceptual_hash(img)
+            return self._binarize(img), phash
+        return self._binarize(img)
+
+    def decode_page(self, img, with_phash=False):
+        """
+        The function `decode_page` is `img_preprocessing` without the thresholding: the grayscale page
+        (cropped and rescaled in adaptive mode) that the preprocessing cascade derives its variants from.
+
+        :param img: The `img` parameter is the encoded image
+        :param with_phash: The `with_phash` parameter also returns the perceptual hash, as `(page, phash)`
+        :return: the grayscale page.
+        """
+        img = self._decode(img)
+        if with_phash:
+            return img, imaging.perceptual_hash(img)
+        return img
+
+    def preprocess_variant(self, gray, variant):
+        """
+        The function `preprocess_variant` applies one cascade variant to the grayscale page.
+
+        :param variant: The `variant` parameter is a name from `src.cascade.VARIANTS`
+        :return: the image to OCR, or None when the variant does not apply to this page.
+        """
+        return cascade.apply(gray, variant)
+
+    def _decode(self, img):
+        with tracing.span("decode", {"file.bytes": len(img), "decode.lean": LEAN_PREPROCESSING}) as span:
+            if LEAN_PREPROCESSING:
+                img = imaging.decode_gray(img, DECODE_MAX_SIDE)
+            else:
+                image = np.frombuffer(img, np.uint8)
+                img = cv2.imdecode(image, cv2.IMREAD_COLOR)
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            span.update({"image.height": img.shape[0], "image.width": img.shape[1]})
+        return self._normalize(img)
+
+    def _normalize(self, img):
+        if PREPROCESS_MODE == "adaptive":
+            shape = img.shape
+            with tracing.span("normalize", {"image.height": shape[0], "image.width": shape[1]}) as span:
+                img = imaging.normalize(img, TARGET_CHAR_HEIGHT_PX, PREPROCESS_MAX_SCALE)
+                span.update({"normalized.height": img.shape[0], "normalized.width": img.shape[1]})
+            logger.debug(f"REQUEST_ID : {self.request_id} | normalized {shape} -> {img.shape}")
         return img
 
+    def _binarize(self, img):
+        with tracing.span("binarize", {"image.height": img.shape[0], "image.width": img.shape[1]}):
+            if LEAN_PREPROCESSING:
+                # blur into this thread's scratch buffer and threshold back into the decoded frame, so a
+                # page costs one full-size allocation instead of one per step
+                blurred = cv2.medianBlur(img, 5, dst=imaging.scratch(img.shape))
+                out = img if img.flags.c_contiguous and img.flags.writeable else None
+                return cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2, dst=out)
+            img = cv2.medianBlur(img, 5)
+            img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11,2)
+            return img
+
     def get_ocr(self, image):
-        text = pytesseract.image_to_string(image)
+        with scheduler.ocr_call() as threads:
+            text = get_backend().image_to_string(image, threads)
+        tracing.annotate({"image.height": image.shape[0], "image.width": image.shape[1], "ocr.chars": len(text)})
         return text
 
+    def get_ocr_data(self, image):
+        """
+        The function `get_ocr_data` OCRs an image once and returns every word with its bounding box
+        and confidence, as tesseract TSV, for structured responses.
+
+        :param image: The `image` parameter is the preprocessed image
+        :return: the TSV text.
+        """
+        tracing.annotate({"image.height": image.shape[0], "image.width": image.shape[1]})
+        with scheduler.ocr_call() as threads:
+            return get_backend().image_to_data(image, threads)
+
     def get_bill(self,ocr_text):
-        k=[]
-        k.append(ocr_text.split('\n'))
-        for i in k:
-          j=0
-          while j<len(i):
-              result1=re.search(r"subtotal", i[j].lower())
-              result2=re.search(r"total", i[j].lower())
-              result3=re.search(r"amount", i[j].lower())
-              result4=re.search(r"cash", i[j].lower())
-              if result1==None and result2==None and result3==None:
-                i.pop(j)
-              else:
-                j=j+1
-        final=[]
-        for i in range(len(k)):
-          for_this=[]
-          for j in range(len(k[i])):
-            result=re.findall("\d+\.\d+",k[i][j])     #This searches all the floating values in the string containg total,subtotal and amount
-            if len(result)>0:
-              for_this.append(float(result[0]))
-          if len(for_this)==0:
-            final.append(0)
-          else:
-            final.append(max(for_this))               #Appending the maximum float value present for each image since total amount is the sum of prices of all the items
-        for i in range(len(final)):
-          if final[i]==0:
-            final[i]=sum(final)/len(final)
-        return final[0]
-
-    async def execute_image(self, request):
+        """
+        The function `get_bill` returns the receipt total found in the OCR text, or 0.0 when there is none.
+
+        :param ocr_text: The `ocr_text` parameter is the text returned by OCR
+        :return: the total as a float.
+        """
+        extraction = extract_total(ocr_text)
+        tracing.annotate({"ocr.chars": len(ocr_text), "total": extraction.total, "total.confidence": extraction.confidence})
+        return extraction.total
+
+    def get_total(self, ocr_text):
+        """
+        The function `get_total` is `get_bill` with its evidence: the chosen total, the line it came
+        from, every candidate line and a confidence score.
+
+        :param ocr_text: The `ocr_text` parameter is the text returned by OCR
+        :return: a `TotalExtraction`.
+        """
+        extraction = extract_total(ocr_text)
+        tracing.annotate({"ocr.chars": len(ocr_text), "total": extraction.total, "total.confidence": extraction.confidence})
+        return extraction
+
+    async def _download(self, url):
+        if EXECUTION_MODE == "inline":
+            return self.download_and_validate(url)
+        return await self._run("download", self.async_download_and_validate, url)
+
+    def pdf_text_layer(self, file_bytes):
+        """
+        The function `pdf_text_layer` reads the embedded text of every PDF page. Digital receipts carry
+        their text already, which is far cheaper than rasterizing and OCRing them.
+
+        :param file_bytes: The `file_bytes` parameter is the raw content of the PDF
+        :return: a list with the text of each page, or None for pages that need OCR.
+        """
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            pages = [page.get_text() for page in doc]
+        return [text if len(text.strip()) >= PDF_MIN_TEXT_CHARS else None for text in pages]
+
+    def pdf_words(self, file_bytes, index):
+        """
+        The function `pdf_words` reads the words of one PDF page's text layer with their boxes.
+
+        :param file_bytes: The `file_bytes` parameter is the raw content of the PDF
+        :param index: The `index` parameter is the zero-based page number
+        :return: a tuple of the PyMuPDF words and the page size in points.
+        """
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            page = doc[index]
+            return page.get_text("words"), (page.rect.width, page.rect.height)
+
+    def rasterize_pdf_page(self, file_bytes, index):
+        """
+        The function `rasterize_pdf_page` renders one PDF page at `PDF_DPI` straight into a grayscale
+        NumPy array and binarizes it for OCR. Pages are rendered one at a time, only when needed.
+
+        :param file_bytes: The `file_bytes` parameter is the raw content of the PDF
+        :param index: The `index` parameter is the zero-based page number
+        :return: the binarized page image.
+        """
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            pix = doc[index].get_pixmap(dpi=PDF_DPI, colorspace=fitz.csGRAY, alpha=False)
+        img = np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+        return self._binarize(img)
+
+    def decode_tiff_frame(self, file_bytes, index):
+        """
+        The function `decode_tiff_frame` decodes and preprocesses one frame of a multi-page TIFF like
+        `img_preprocessing` does a single image (`decode_page` when a cascade is configured).
+
+        :param file_bytes: The `file_bytes` parameter is the raw content of the TIFF
+        :param index: The `index` parameter is the frame number, from 0
+        :return: the binarized frame, or the grayscale frame with a cascade.
+        """
+        with tracing.span("decode", {"file.bytes": len(file_bytes), "tiff.frame": index}) as span:
+            img = imaging.tiff_frame(file_bytes, index, DECODE_MAX_SIDE if LEAN_PREPROCESSING else 0)
+            span.update({"image.height": img.shape[0], "image.width": img.shape[1]})
+        img = self._normalize(img)
+        return img if CASCADE_ORDER else self._binarize(img)
+
+    def extract_text(self, file_bytes, ext, pages=1):
+        """
+        The function `extract_text` runs preprocessing and OCR synchronously on validated bytes; it is
+        the entry point for offline (CLI) processing.
+
+        :param file_bytes: The `file_bytes` parameter is the raw content of the document
+        :param ext: The `ext` parameter is the extension returned by `validate_file`
+        :param pages: The `pages` parameter is the page count returned by `validate_file`
+        :return: the OCR text.
+        """
+        return asyncio.run(self._extract_text(file_bytes, ext, pages, inline=True))
+
+    async def _run(self, stage, func, *args, inline=False):
+        if inline or EXECUTION_MODE == "inline":
+            return func(*args)
+        return await get_stage(stage).run(func, *args, request_id=self.request_id)
+
+    async def _extract_text(self, file_bytes, ext, pages, inline=False, layout=None):
+        # with a `layout`, the words and boxes of every page are collected into it as well
+        if ext == "pdf":
+            return await self._extract_pdf_text(file_bytes, inline, layout)
+        if ext in TIFF_FORMATS and pages > 1:
+            return await self._extract_tiff_text(file_bytes, pages, inline, layout)
+        page, _ = await self._prepare(file_bytes, False, inline)
+        return await self._read_page(page, inline, layout)
+
+    async def _prepare(self, file_bytes, with_phash, inline):
+        # with a cascade, the variants are derived from the grayscale page; otherwise it is binarized here
+        func = self.decode_page if CASCADE_ORDER else self.img_preprocessing
+        if with_phash:
+            return await self._run("preprocess", func, file_bytes, True, inline=inline)
+        return await self._run("preprocess", func, file_bytes, inline=inline), None
+
+    async def _read_page(self, page, inline, layout=None):
+        if CASCADE_ORDER:
+            return await self._cascade(page, inline, layout)
+        return await self._ocr_page(page, inline, layout)
+
+    async def _try_variant(self, gray, variant, inline, structured=False):
+        # an attempt is (variant, text, extraction, layout, error)
+        with tracing.span("cascade.variant", {"cascade.variant": variant}) as span:
+            try:
+                image = await self._run("preprocess", self.preprocess_variant, gray, variant, inline=inline)
+                if image is None:
+                    cascade.record(variant, "skipped")
+                    span.set("cascade.outcome", "skipped")
+                    return variant, None, None, None, None
+                layout = Layout() if structured else None
+                text = await self._ocr_page(image, inline, layout)
+            except ErrorObject as e:
+                # a full stage queue (503) or the deadline (504): the other variants may still answer
+                cascade.record(variant, "failed")
+                span.set("cascade.outcome", "failed")
+                logger.warning(f"REQUEST_ID : {self.request_id} | cascade variant {variant} failed with {e.error_obj.error.status}")
+                return variant, None, None, None, e
+            extraction = self.get_total(text)
+            outcome = "confident" if self._confident(extraction) else ("low_confidence" if extraction.total else "no_total")
+            cascade.record(variant, outcome)
+            span.set("cascade.outcome", outcome)
+            return variant, text, extraction, layout, None
+
+    def _confident(self, extraction):
+        return extraction is not None and extraction.total > 0 and extraction.confidence >= CASCADE_MIN_CONFIDENCE
+
+    async def _cascade(self, gray, inline, layout=None):
+        """
+        The function `_cascade` OCRs preprocessing variants of the page in `PREPROCESS_CASCADE` order
+        and stops at the first one whose total reaches `CASCADE_MIN_CONFIDENCE`. With
+        `CASCADE_PARALLEL` every variant is started at once on the stage pools and the first confident
+        one wins; the others are cancelled. Without a confident variant the best one is kept. A variant
+        rejected by a stage (503, 504) is left out; its error is raised only when no variant was read.
+
+        :param layout: The `layout` parameter, when given, receives the words of the chosen variant
+        :return: the OCR text of the chosen variant.
+        """
+        attempts = []
+        structured = layout is not None
+        if CASCADE_PARALLEL and not inline and EXECUTION_MODE != "inline":
+            tasks = [asyncio.ensure_future(self._try_variant(gray, variant, inline, structured))
+                     for variant in CASCADE_ORDER]
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    attempt = await finished
+                    attempts.append(attempt)
+                    if self._confident(attempt[2]):
+                        break
+            finally:
+                for task in tasks:
+                    task.cancel()
+        else:
+            for variant in CASCADE_ORDER:
+                attempt = await self._try_variant(gray, variant, inline, structured)
+                attempts.append(attempt)
+                if self._confident(attempt[2]):
+                    break
+        tried = [attempt for attempt in attempts if attempt[2] is not None]
+        if not tried:
+            errors = [attempt[4] for attempt in attempts if attempt[4] is not None]
+            if errors:
+                raise errors[0]
+            return ""
+        # the confident variant if any, else the most confident total, earlier variants first on ties
+        order = {variant: position for position, variant in enumerate(CASCADE_ORDER)}
+        variant, text, extraction, chosen, _ = max(tried, key=lambda attempt: (attempt[2].total > 0, attempt[2].confidence,
+                                                                                 -order[attempt[0]]))
+        if structured:
+            layout.extend(chosen)
+        cascade.record(variant, "chosen")
+        tracing.annotate({"cascade.chosen": variant, "cascade.tried": len(attempts)})
+        logger.info(f"REQUEST_ID : {self.request_id} | cascade chose {variant} after {len(attempts)} variant(s) "
+                    f"| confidence {extraction.confidence}")
+        return text
+
+    async def _ocr_page(self, img_preprocessed, inline, layout=None):
+        if layout is not None:
+            # a single pass over the whole page: structured output needs every line, not only the total
+            page = Layout()
+            page.add_tsv(await self._run("ocr", self.get_ocr_data, img_preprocessed, inline=inline))
+            layout.extend(page)
+            return page.text()
+        if OCR_REGION == "lower":
+            region = imaging.lower_region(img_preprocessed, OCR_LOWER_FRACTION)
+            text = await self._run("ocr", self.get_ocr, region, inline=inline)
+            if self.get_bill(text):
+                return text
+            logger.info(f"REQUEST_ID : {self.request_id} | no total in lower region, falling back to full page")
+        return await self._run("ocr", self.get_ocr, img_preprocessed, inline=inline)
+
+    async def _extract_pdf_text(self, file_bytes, inline, layout=None):
+        pages = await self._run("preprocess", self.pdf_text_layer, file_bytes, inline=inline)
+        texts = []
+        for index, text in enumerate(pages):
+            if text is None:
+                img_preprocessed = await self._run("preprocess", self.rasterize_pdf_page, file_bytes, index, inline=inline)
+                text = await self._ocr_page(img_preprocessed, inline, layout)
+            elif layout is not None:
+                # boxes of the text layer, scaled to the pixels of a page rasterized at PDF_DPI
+                words, size = await self._run("preprocess", self.pdf_words, file_bytes, index, inline=inline)
+                page = Layout()
+                page.add_pdf_words(words, size, PDF_DPI / 72)
+                layout.extend(page)
+                text = page.text()
+            else:
+                logger.debug(f"REQUEST_ID : {self.request_id} | page {index} has a text layer, skipping OCR")
+            texts.append(text)
+        return "\n".join(texts)
+
+    async def _extract_tiff_text(self, file_bytes, frames, inline, layout=None):
+        """
+        The function `_extract_tiff_text` reads every frame of a multi-page TIFF. Each frame is decoded
+        inside the preprocess stage call that prepares it, and at most `TIFF_FRAME_CONCURRENCY` frames
+        are in flight, so a long TIFF never has all its pages decoded at once while its frames are
+        OCRed in parallel on the stage pools.
+
+        :param frames: The `frames` parameter is the frame count found by `validate_file`
+        :param layout: The `layout` parameter, when given, receives the words of every frame in page order
+        :return: the OCR text of the frames, in page order.
+        """
+        parallel = not inline and EXECUTION_MODE != "inline"
+        limit = asyncio.Semaphore(TIFF_FRAME_CONCURRENCY if parallel else 1)
+
+        async def read(index):
+            async with limit:
+                with tracing.span("tiff.frame", {"tiff.frame": index}):
+                    page = await self._run("preprocess", self.decode_tiff_frame, file_bytes, index, inline=inline)
+                    frame_layout = Layout() if layout is not None else None
+                    return await self._read_page(page, inline, frame_layout), frame_layout
+
+        tasks = [asyncio.ensure_future(read(index)) for index in range(frames)]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if layout is not None:
+            for _, frame_layout in results:
+                layout.extend(frame_layout)
+        return "\n".join(text for text, _ in results)
+
+    async def _extract_structured(self, file_bytes, ext, pages, inline=False):
+        layout = Layout()
+        text = await self._extract_text(file_bytes, ext, pages, inline, layout)
+        archive.note_text(text)
+        return layout.to_dict(self.get_total(text))
+
+    async def _extract_or_match(self, file_bytes, ext, pages, digest, meta, inline=False):
+        # OCR the receipt, unless its perceptual hash is close to one already processed
+        index = get_index()
+        if index is None or ext == "pdf" or pages > 1:
+            text = await self._extract_text(file_bytes, ext, pages, inline)
+            archive.note_text(text)
+            return self.get_bill(text)
+        bits = imaging.PHASH_SIZE ** 2
+        page, phash = await self._prepare(file_bytes, True, inline)
+        match = await index.alookup(phash, bits)
+        tracing.annotate({"dedup.match": match is not None})
+        if match is not None:
+            logger.info(f"REQUEST_ID : {self.request_id} | probable duplicate of {match['contentHash']} "
+                        f"(distance {match['distance']}) | result --- {match['result']}")
+            if meta is not None:
+                meta["duplicateOf"] = {"contentHash": match["contentHash"], "distance": match["distance"]}
+            archive.note_duplicate(match["contentHash"])
+            return match["result"]
+        text = await self._read_page(page, inline)
+        archive.note_text(text)
+        result = self.get_bill(text)
+        await index.aadd(phash, bits, digest, result)
+        return result
+
+    async def execute_image(self, request, request_id=None, meta=None):
+        """
+        The function `execute_image` downloads, validates, preprocesses and OCRs one receipt and returns
+        its total, answering from the result cache when it can.
+
+        :param request: The `request` parameter is the request dict with a one-element `img_url` list
+        :param request_id: The `request_id` parameter tags this call's logs; it is scoped to the calling
+        task, so concurrent calls on the shared engine keep their own ids
+        :param meta: The `meta` parameter is an optional dict filled with facts about how the result was
+        obtained (`duplicateOf` when, with dedup enabled, the receipt matched one already processed)
+        :return: the total as a float, or with `structured` set in the request the dict built by
+        `Layout.to_dict` (lines, word boxes and confidences, and the total with its source line).
+        """
+        if request_id is not None:
+            _request_id.set(request_id)
+        archive.start_record()
+        try:
+            url = str(request["img_url"][0])
+            structured = bool(request.get("structured"))
+            cache = get_cache()
+            known_hash = None
+            if cache is not None:
+                known_hash = await cache.alookup_hash(url)
+                result = await cache.aget(result_key(known_hash, structured)) if known_hash is not None else None
+                if result is not None:
+                    tracing.annotate({"cache": "url_hit"})
+                    logger.info(f"REQUEST_ID : {self.request_id} | url cache hit {known_hash} | result --- {result}")
+                    # archived as a copy of the receipt it was extracted from; the file was not downloaded
+                    archive.note_duplicate(known_hash)
+                    archive.submit(self.request_id, known_hash, url, None, result)
+                    return result
+            file_bytes, ext, pages = await self._download(url)
+            return await self._execute_content(file_bytes, ext, pages, url, known_hash, structured, meta)
+        except Exception as e:
+            if isinstance(e, ErrorObject):
+                raise e
+            else:
+                logger.error(f"REQUEST_ID : {self.request_id} | other exception ")
+                logger.error(f"REQUEST_ID : {self.request_id} | execption trace back --- {traceback.format_exc()}")
+                raise ErrorObject({"error":{"status":"500"}})
+
+    async def execute_upload(self, file_bytes, request_id=None, meta=None, structured=False):
+        """
+        The function `execute_upload` is `execute_image` for bytes posted with the request: they are
+        validated, then looked up in the result cache by content and extracted like a download.
+
+        :param file_bytes: The `file_bytes` parameter is the uploaded file
+        :param request_id: The `request_id` parameter tags this call's logs
+        :param meta: The `meta` parameter is filled as in `execute_image`
+        :param structured: The `structured` parameter returns the structured result instead of the total
+        :return: the total as a float, or the structured result.
+        """
+        if request_id is not None:
+            _request_id.set(request_id)
+        archive.start_record()
         try:
-            file_bytes, ext = self.download_and_validate(request["img_url"][0])
-            img_preprocessed = self.img_preprocessing(file_bytes)
-            text = self.get_ocr(img_preprocessed)
-            result = self.get_bill(text)
-            logger.info(f"REQUEST_ID : {self.request_id} | result --- {result}")
-            return result
+            ext, pages = self.validate_file(file_bytes)
+            return await self._execute_content(file_bytes, ext, pages, None, None, structured, meta)
         except Exception as e:
             if isinstance(e, ErrorObject):
                 raise e
@@ -118,3 +647,80 @@ class InferenceEngine:
                 logger.error(f"REQUEST_ID : {self.request_id} | other exception ")
                 logger.error(f"REQUEST_ID : {self.request_id} | execption trace back --- {traceback.format_exc()}")
                 raise ErrorObject({"error":{"status":"500"}})
+
+    async def _execute_content(self, file_bytes, ext, pages, url, known_hash, structured, meta):
+        # content cache, extraction and cache fill, shared by downloads (`url` set) and uploads
+        cache = get_cache()
+        digest = content_hash(file_bytes)
+        if cache is not None and digest != known_hash:
+            result = await cache.aget(result_key(digest, structured))
+            if result is not None:
+                if url is not None:
+                    await cache.aremember_url(url, digest)
+                tracing.annotate({"cache": "content_hit"})
+                logger.info(f"REQUEST_ID : {self.request_id} | content cache hit {digest} | result --- {result}")
+                if meta is not None and get_index() is not None:
+                    # the same bytes re-uploaded under another url
+                    meta["duplicateOf"] = {"contentHash": digest, "distance": 0}
+                archive.note_duplicate(digest)
+                archive.submit(self.request_id, digest, url, ext, result)
+                return result
+        tracing.annotate({"cache": "miss" if cache is not None else "off", "result.structured": structured})
+        if structured:
+            # near-duplicates are not looked up: their word boxes would not match this image
+            result = await self._extract_structured(file_bytes, ext, pages)
+        else:
+            result = await self._extract_or_match(file_bytes, ext, pages, digest, meta)
+        if cache is not None:
+            await cache.aput(url, digest, result, key=result_key(digest, structured))
+        archive.submit(self.request_id, digest, url, ext, result)
+        logger.info(f"REQUEST_ID : {self.request_id} | result --- {result}")
+        return result
+
+
+def result_key(digest, structured=False):
+    """The function `result_key` is the result cache key of a receipt; structured results are stored apart from totals."""
+    return f"{digest}:structured" if structured else digest
+
+
+_engine = None
+
+
+def get_engine():
+    """
+    The function `get_engine` returns the process-wide `InferenceEngine`. The engine holds no
+    per-request state (request ids are passed per call), so every request and job shares it.
+    """
+    global _engine
+    if _engine is None:
+        _engine = InferenceEngine()
+    return _engine
+
+
+def warm_up(engine=None):
+    """
+    The function `warm_up` runs the bundled `WARMUP_IMAGE` through validation, preprocessing, OCR and
+    total extraction once, outside the cache and the stage pools, so the first real request does not
+    pay for lazy imports, OCR backend creation or the tesseract model load.
+
+    :param engine: The `engine` parameter is the engine to warm, the shared one by default
+    :return: the seconds spent, or None when warm-up is disabled or failed.
+    """
+    if not WARMUP_ENABLED:
+        return None
+    engine = engine or get_engine()
+    token = _request_id.set("warmup")
+    start = time.monotonic()
+    try:
+        with open(WARMUP_IMAGE, "rb") as f:
+            file_bytes = f.read()
+        ext, pages = engine.validate_file(file_bytes)
+        total = engine.get_bill(engine.extract_text(file_bytes, ext, pages))
+    except Exception as e:
+        logger.warning(f"REQUEST_ID : warmup | warm-up on {WARMUP_IMAGE} failed --- {e}")
+        return None
+    finally:
+        _request_id.reset(token)
+    elapsed = time.monotonic() - start
+    logger.info(f"REQUEST_ID : warmup | pid {os.getpid()} warmed up in {elapsed:.3f} seconds | result --- {total}")
+    return elapsed
@@ -0,0 +1,243 @@
+"""
+Durable local job queue for long-running extractions.
+
+The web workers only insert jobs (`JobStore.submit`) and read their state; a separate pool of job
+workers, started with
+
+    python -m src.jobs --concurrency 8
+
+claims queued jobs from the same sqlite file, runs them through the inference engine and stores the
+result, optionally POSTing it to the job's callback url. Accepting a request therefore never waits
+for OCR capacity, and a burst simply lengthens the queue.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from loguru import logger
+from src import config
+from src import tracing
+from src import archive
+from src.persistence import wal_connection
+from src.schemas import ErrorObject
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class JobStore:
+    """
+    The class `JobStore` is the sqlite-backed job table. WAL mode lets the web workers insert and
+    read while job workers claim and update; claiming runs in an IMMEDIATE transaction so a job is
+    handed to exactly one worker.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, status TEXT NOT NULL, img_url TEXT NOT NULL, request_id TEXT,
+            callback_url TEXT, result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, traceparent TEXT)""")
+        if "traceparent" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+            # job files created before jobs carried the trace of the request that submitted them
+            conn.execute("ALTER TABLE jobs ADD COLUMN traceparent TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+        conn.commit()
+
+    def _conn(self):
+        return wal_connection(self._local, self.path, 10, autocommit=True, rows=True)
+
+    def submit(self, img_url, request_id=None, callback_url=None, traceparent=None):
+        """
+        The function `submit` queues an extraction and returns immediately.
+
+        :param img_url: The `img_url` parameter is the receipt url
+        :param request_id: The `request_id` parameter is carried into the worker's logs
+        :param callback_url: The `callback_url` parameter is POSTed the finished job, if given
+        :param traceparent: The `traceparent` parameter is the W3C trace context of the submitting
+        request; the job's trace joins it
+        :return: the new job id.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO jobs (id, status, img_url, request_id, callback_url, created_at, updated_at, traceparent) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, QUEUED, img_url, request_id, callback_url, now, now, traceparent))
+        return job_id
+
+    def get(self, job_id):
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._as_dict(row) if row is not None else None
+
+    def claim(self, worker):
+        """
+        The function `claim` atomically moves the oldest queued job to running.
+
+        :param worker: The `worker` parameter identifies the claiming worker
+        :return: the claimed job as a dict, or None when the queue is empty.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                             (RUNNING, worker, time.time(), row["id"]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return self._as_dict(row) if row is not None else None
+
+    def finish(self, job_id, result=None, error=None):
+        status = FAILED if error is not None else DONE
+        self._conn().execute("UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                             (status, json.dumps(result), json.dumps(error) if error is not None else None,
+                              time.time(), job_id))
+
+    def recover_stale(self, stale_after, max_attempts):
+        """
+        The function `recover_stale` re-queues jobs whose worker died mid-run, and fails the ones that
+        already used up their attempts.
+
+        :return: the number of re-queued jobs.
+        """
+        conn = self._conn()
+        cutoff = time.time() - stale_after
+        error = json.dumps({"status": "500", "msg": "unable to process - worker lost", "responseCode": "fail"})
+        conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE status = ? AND updated_at < ? AND attempts >= ?",
+                     (FAILED, error, time.time(), RUNNING, cutoff, max_attempts))
+        return conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE status = ? AND updated_at < ?",
+                            (QUEUED, time.time(), RUNNING, cutoff)).rowcount
+
+    def purge(self, older_than):
+        return self._conn().execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                                    (DONE, FAILED, time.time() - older_than)).rowcount
+
+    def depth(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    @staticmethod
+    def _as_dict(row):
+        return {"jobId": row["id"], "status": row["status"], "img_url": row["img_url"], "requestId": row["request_id"],
+                "callback_url": row["callback_url"], "attempts": row["attempts"],
+                "result": json.loads(row["result"]) if row["result"] else None,
+                "error": json.loads(row["error"]) if row["error"] else None,
+                "createdAt": row["created_at"], "updatedAt": row["updated_at"], "traceparent": row["traceparent"]}
+
+
+_store = None
+
+
+def get_store():
+    """The function `get_store` returns this process's `JobStore` for `JOB_DB_PATH`."""
+    global _store
+    if _store is None:
+        _store = JobStore(config.JOB_DB_PATH)
+    return _store
+
+
+def public_view(job):
+    """The function `public_view` strips the internal columns from a job before returning it to clients."""
+    return {key: job[key] for key in ("jobId", "status", "requestId", "result", "error", "createdAt", "updatedAt")}
+
+
+async def _send_callback(job):
+    from src.downloader import get_client
+    try:
+        response = await get_client().post(job["callback_url"], json=public_view(job))
+        logger.info(f"REQUEST_ID : {job['requestId']} | job {job['jobId']} callback answered {response.status_code}")
+    except Exception as e:
+        logger.error(f"REQUEST_ID : {job['requestId']} | job {job['jobId']} callback failed --- {e}")
+
+
+async def _run_job(store, job):
+    from src.inferenceEngine import get_engine
+    request_id = job["requestId"] or job["jobId"]
+    result, error = None, None
+    # in the trace of the request that submitted the job, if it had one, and sampled as it was
+    with tracing.trace("job", job["traceparent"], {"job.id": job["jobId"], "request.id": request_id},
+                       kind=tracing.KIND_CONSUMER) as span:
+        try:
+            result = await get_engine().execute_image({"img_url": [job["img_url"]]}, request_id)
+        except ErrorObject as e:
+            error = e.error_obj.error.dict()
+        except Exception:
+            logger.error(f"REQUEST_ID : {request_id} | job {job['jobId']} crashed --- {traceback.format_exc()}")
+            error = {"status": "500", "msg": "unable to process - internal server error", "responseCode": "fail"}
+        span.set("job.status", FAILED if error else DONE)
+    await asyncio.to_thread(store.finish, job["jobId"], result, error)
+    if job["callback_url"]:
+        await _send_callback(dict(job, status=FAILED if error else DONE, result=result, error=error,
+                                  updatedAt=time.time()))
+
+
+async def _consume(store, worker, stop):
+    while not stop.is_set():
+        job = await asyncio.to_thread(store.claim, worker)
+        if job is None:
+            try:
+                await asyncio.wait_for(stop.wait(), config.JOB_POLL_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await _run_job(store, job)
+
+
+async def _housekeeping(store, stop):
+    while not stop.is_set():
+        requeued = await asyncio.to_thread(store.recover_stale, config.JOB_STALE_AFTER_SEC, config.JOB_MAX_ATTEMPTS)
+        purged = await asyncio.to_thread(store.purge, config.JOB_RETENTION_SEC)
+        if requeued or purged:
+            logger.info(f"job housekeeping | {requeued} stale jobs re-queued | {purged} old jobs purged")
+        try:
+            await asyncio.wait_for(stop.wait(), 60)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_workers(concurrency):
+    """
+    The function `run_workers` runs `concurrency` job consumers in this process until SIGINT/SIGTERM.
+    OCR itself goes through the engine's stage pools, so consumers mostly wait on those.
+    """
+    import signal
+    from src import downloader, executor
+    from src.inferenceEngine import warm_up
+    store = get_store()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    downloader.start_client()
+    await asyncio.to_thread(warm_up)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"job worker {worker} | {concurrency} consumers | queue {config.JOB_DB_PATH}")
+    try:
+        await asyncio.gather(_housekeeping(store, stop),
+                             *(_consume(store, f"{worker}/{i}", stop) for i in range(concurrency)))
+    finally:
+        await downloader.close_client()
+        executor.shutdown()
+        tracing.shutdown()
+        archive.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run extraction job workers.")
+    parser.add_argument("--concurrency", "-c", type=int, default=config.JOB_WORKER_CONCURRENCY)
+    args = parser.parse_args(argv)
+    asyncio.run(run_workers(args.concurrency))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
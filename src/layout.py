@@ -0,0 +1,113 @@
+"""
+Column-oriented OCR layout for structured responses.
+
+Tesseract's TSV output (one row per page, block, paragraph, line and word) is folded into the text
+of each line plus one array per word attribute, so a receipt with a few hundred words serializes
+as a handful of flat arrays instead of a few hundred small objects.
+"""
+
+# word attributes, one array each; `line` indexes `lines`, coordinates are pixels of the OCRed page
+WORD_COLUMNS = ("text", "conf", "left", "top", "width", "height", "line", "page")
+# tesseract marks words that did not come from recognition (e.g. a PDF text layer) with conf -1
+NO_CONFIDENCE = -1
+
+
+class Layout:
+    """
+    The class `Layout` accumulates the lines and words of one document, page after page, from
+    tesseract TSV or from the words of a PDF text layer.
+    """
+    def __init__(self):
+        self.lines = []
+        self.pages = []
+        self.words = {column: [] for column in WORD_COLUMNS}
+
+    def _add_word(self, text, conf, box, line, page):
+        words = self.words
+        words["text"].append(text)
+        words["conf"].append(conf)
+        words["left"].append(box[0])
+        words["top"].append(box[1])
+        words["width"].append(box[2])
+        words["height"].append(box[3])
+        words["line"].append(line)
+        words["page"].append(page)
+
+    def _line(self, lines, key, text):
+        # join the words of a line with single spaces, as `image_to_string` would print them
+        index = lines.get(key)
+        if index is None:
+            index = lines[key] = len(self.lines)
+            self.lines.append(text)
+        else:
+            self.lines[index] += " " + text
+        return index
+
+    def add_tsv(self, tsv):
+        """
+        The function `add_tsv` appends one page of tesseract TSV output.
+
+        :param tsv: The `tsv` parameter is the TSV text (with or without its header row)
+        """
+        page = len(self.pages)
+        self.pages.append([0, 0])
+        lines = {}
+        for row in tsv.splitlines():
+            fields = row.split("\t")
+            if len(fields) < 12:
+                continue
+            if fields[0] == "1":
+                self.pages[page] = [int(fields[8]), int(fields[9])]
+            if fields[0] != "5" or not fields[11].strip():
+                continue
+            text = fields[11].strip()
+            line = self._line(lines, (fields[2], fields[3], fields[4]), text)
+            self._add_word(text, round(float(fields[10])), [int(value) for value in fields[6:10]], line, page)
+
+    def add_pdf_words(self, words, size, scale):
+        """
+        The function `add_pdf_words` appends one page read from a PDF text layer.
+
+        :param words: The `words` parameter is the output of PyMuPDF's `page.get_text("words")`
+        :param size: The `size` parameter is the page size in PDF points
+        :param scale: The `scale` parameter converts points to pixels of the page rasterized at
+        `PDF_DPI`, so text-layer and OCRed pages share a coordinate system
+        """
+        page = len(self.pages)
+        self.pages.append([round(size[0] * scale), round(size[1] * scale)])
+        lines = {}
+        for x0, y0, x1, y1, text, block, line_no, _ in words:
+            line = self._line(lines, (block, line_no), text)
+            box = [round(x0 * scale), round(y0 * scale), round((x1 - x0) * scale), round((y1 - y0) * scale)]
+            self._add_word(text, NO_CONFIDENCE, box, line, page)
+
+    def extend(self, other):
+        """The function `extend` appends the pages of another layout, renumbering its lines and pages."""
+        offsets = {"line": len(self.lines), "page": len(self.pages)}
+        self.lines.extend(other.lines)
+        self.pages.extend(other.pages)
+        for column in WORD_COLUMNS:
+            values = other.words[column]
+            if column in offsets:
+                values = [value + offsets[column] for value in values]
+            self.words[column].extend(values)
+
+    def text(self):
+        """The function `text` returns the document as plain text, one line per layout line."""
+        return "\n".join(self.lines)
+
+    def to_dict(self, extraction):
+        """
+        The function `to_dict` builds the structured result.
+
+        :param extraction: The `extraction` parameter is the `TotalExtraction` found in `text()`
+        :return: a dict with the total, its source line (and its index in `lines`), the page sizes,
+        the lines and the word columns.
+        """
+        try:
+            source_index = self.lines.index(extraction.sourceLine)
+        except ValueError:
+            source_index = None
+        return {"total": extraction.total, "confidence": extraction.confidence,
+                "sourceLine": extraction.sourceLine, "sourceLineIndex": source_index,
+                "pages": self.pages, "lines": self.lines, "words": self.words}
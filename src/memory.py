@@ -0,0 +1,272 @@
+"""
+Per-worker memory tracking and memory-based recycling.
+
+OpenCV, PyMuPDF and tesseract keep buffers around, so a worker's resident memory creeps up over
+thousands of requests. Instead of recycling every worker after a fixed number of requests (which
+throws away its warm caches and imports), each worker samples its RSS and only recycles itself when
+it exceeds `MEMORY_MAX_RSS_MB` or has grown faster than `MEMORY_MAX_GROWTH_MB_PER_HOUR` over the last
+`MEMORY_GROWTH_WINDOW_SEC`. Recycling is a SIGTERM to itself: uvicorn stops accepting connections,
+lets the requests in flight finish, and gunicorn starts a fresh worker in its place.
+
+To find out where memory goes, tracemalloc can be started on demand; growth between the baseline
+snapshot and now is attributed to the function of `src/` that made each allocation, i.e. to the
+pipeline stage (`_decode`, `get_ocr`, `pdf_text_layer`, ...).
+"""
+import ast
+import asyncio
+import collections
+import functools
+import os
+import random
+import signal
+import time
+import tracemalloc
+from loguru import logger
+from src import config
+from src.metrics import WORKER_RSS, WORKER_RECYCLES
+
+MB = 1024 * 1024
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def rss_bytes():
+    """
+    The function `rss_bytes` returns the current resident set size of this process, read from
+    /proc/self/statm (one small read, cheap enough for every check).
+
+    :return: the RSS in bytes; the peak RSS where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        import resource
+        # peak rather than current; kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryWatchdog:
+    """
+    The class `MemoryWatchdog` samples this worker's RSS every `interval` seconds, keeps the samples
+    of the last `window` seconds to estimate the growth rate, and recycles the worker once a limit
+    is crossed. A limit of 0 disables that check. Both limits are lowered by a random fraction up to
+    `jitter`, drawn per worker, so that workers started together are not recycled together.
+    """
+    def __init__(self, max_rss_mb, max_growth_mb_per_hour, window, interval, jitter=0):
+        scale = 1 - random.uniform(0, jitter)
+        self.max_rss = int(max_rss_mb * MB * scale)
+        self.max_growth = max_growth_mb_per_hour * scale
+        self.window = window
+        self.interval = interval
+        self.samples = collections.deque()
+        self.started = time.monotonic()
+        self.baseline = None
+        self.peak = 0
+        self.requests = 0
+        self.recycling = None
+
+    def sample(self):
+        now, rss = time.monotonic(), rss_bytes()
+        self.samples.append((now, rss))
+        while now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        if self.baseline is None:
+            self.baseline = rss
+            if self.max_rss and rss > self.max_rss:
+                # a fresh worker would be replaced by another just as big, over and over
+                logger.error(f"worker {os.getpid()} | RSS {rss / MB:.0f} MB at start is above its MEMORY_MAX_RSS_MB "
+                             f"{self.max_rss // MB} | ceiling disabled for this worker")
+                self.max_rss = 0
+        self.peak = max(self.peak, rss)
+        WORKER_RSS.set(rss)
+        return rss
+
+    def growth_rate(self):
+        """
+        The function `growth_rate` fits a line through the RSS samples of the window.
+
+        :return: the slope in MB per hour, or None until the samples cover (almost) a whole window.
+        """
+        samples = self.samples
+        if len(samples) < 3 or samples[-1][0] - samples[0][0] < self.window * 0.9:
+            return None
+        start = samples[0][0]
+        xs = [t - start for t, _ in samples]
+        ys = [rss for _, rss in samples]
+        mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+        variance = sum((x - mean_x) ** 2 for x in xs)
+        if not variance:
+            return None
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+        return slope * 3600 / MB
+
+    def check(self, rss):
+        """The function `check` returns why the worker should be recycled ("rss_ceiling", "growth_rate"), or None."""
+        if self.max_rss and rss > self.max_rss:
+            return "rss_ceiling"
+        rate = self.growth_rate()
+        if self.max_growth and rate is not None and rate > self.max_growth:
+            return "growth_rate"
+        return None
+
+    def recycle(self, reason, rss):
+        self.recycling = reason
+        WORKER_RECYCLES.labels(reason).inc()
+        if not _recycling_enabled:
+            logger.warning(f"worker {os.getpid()} | RSS {rss / MB:.0f} MB | {reason} | not running under gunicorn, "
+                           f"not recycling")
+            return
+        logger.warning(f"worker {os.getpid()} | RSS {rss / MB:.0f} MB | {reason} after {self.requests} requests served "
+                       f"| draining in-flight requests and exiting")
+        # uvicorn's handler: stop accepting, finish the requests in flight, run the lifespan shutdown
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    async def run(self):
+        while True:
+            rss = self.sample()
+            reason = self.check(rss)
+            if reason is not None and self.recycling is None:
+                self.recycle(reason, rss)
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        rss = rss_bytes()
+        growth = self.growth_rate()
+        per_request = (rss - self.baseline) / self.requests if self.requests and self.baseline else None
+        return {"pid": os.getpid(), "rssMb": round(rss / MB, 1), "peakRssMb": round(self.peak / MB, 1),
+                "baselineRssMb": round(self.baseline / MB, 1) if self.baseline else None,
+                "growthMbPerHour": round(growth, 2) if growth is not None else None,
+                "kbPerRequest": round(per_request / 1024, 2) if per_request is not None else None,
+                "requests": self.requests, "uptimeSec": round(time.monotonic() - self.started),
+                "maxRssMb": self.max_rss // MB, "maxGrowthMbPerHour": round(self.max_growth, 2),
+                "recycling": self.recycling, "tracemalloc": tracemalloc.is_tracing()}
+
+
+_watchdog = None
+_recycling_enabled = False
+
+
+def get_watchdog():
+    """The function `get_watchdog` returns this process's `MemoryWatchdog`, created on first use."""
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = MemoryWatchdog(config.MEMORY_MAX_RSS_MB, config.MEMORY_MAX_GROWTH_MB_PER_HOUR,
+                                   config.MEMORY_GROWTH_WINDOW_SEC, config.MEMORY_CHECK_INTERVAL_SEC,
+                                   config.MEMORY_LIMIT_JITTER)
+    return _watchdog
+
+
+def enable_recycling():
+    """
+    The function `enable_recycling` lets the watchdog terminate this process; called in gunicorn
+    workers, whose master replaces them. Elsewhere (uvicorn alone, tests) crossing a limit is only logged.
+    """
+    global _recycling_enabled
+    _recycling_enabled = True
+
+
+def count_request():
+    get_watchdog().requests += 1
+
+
+def start_watchdog():
+    """The function `start_watchdog` starts sampling on the running loop; the task is cancelled at shutdown."""
+    return asyncio.get_running_loop().create_task(get_watchdog().run())
+
+
+_baseline = None
+_baseline_at = None
+
+
+def _snapshot():
+    # leave out tracemalloc's own bookkeeping
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def start_tracing(frames):
+    """
+    The function `start_tracing` starts tracemalloc (keeping `frames` frames per allocation) if it is
+    not running, and takes the baseline snapshot that `growth_report` compares with. Tracing slows
+    allocations down noticeably; stop it once the report has been read.
+
+    :return: the tracing status.
+    """
+    global _baseline, _baseline_at
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    _baseline, _baseline_at = _snapshot(), time.monotonic()
+    return tracing_status()
+
+
+def stop_tracing():
+    global _baseline, _baseline_at
+    tracemalloc.stop()
+    _baseline = _baseline_at = None
+    return tracing_status()
+
+
+def tracing_status():
+    traced, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+    return {"pid": os.getpid(), "tracing": tracemalloc.is_tracing(), "frames": tracemalloc.get_traceback_limit(),
+            "tracedMb": round(traced / MB, 1), "tracedPeakMb": round(peak / MB, 1),
+            "baselineAgeSec": round(time.monotonic() - _baseline_at) if _baseline_at is not None else None}
+
+
+@functools.lru_cache(maxsize=64)
+def _functions(filename):
+    # (first line, last line, name) of every function defined in a source file
+    try:
+        with open(filename) as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError, ValueError):
+        return []
+    return [(node.lineno, node.end_lineno, node.name) for node in ast.walk(tree)
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))]
+
+
+def _function_at(filename, lineno):
+    spans = [span for span in _functions(filename) if span[0] <= lineno <= span[1]]
+    name = min(spans, key=lambda span: span[1] - span[0])[2] if spans else "<module>"
+    return f"{os.path.splitext(os.path.basename(filename))[0]}.{name}"
+
+
+def _stage_of(traceback):
+    # the innermost frame of our own code: the pipeline function that asked for the memory
+    for frame in reversed(traceback):
+        if frame.filename.startswith(SRC_DIR) and not frame.filename.endswith("memory.py"):
+            return _function_at(frame.filename, frame.lineno)
+    return "other"
+
+
+def growth_report(limit=20):
+    """
+    The function `growth_report` compares a fresh snapshot with the baseline taken by `start_tracing`.
+    Only Python-heap allocations are seen (NumPy arrays included); memory allocated natively inside
+    tesseract or OpenCV shows in the RSS only.
+
+    :param limit: The `limit` parameter is the number of entries of each list
+    :return: the growth since the baseline, by pipeline function of `src/` and by allocation site
+    (innermost frame), largest first; None when no baseline was taken.
+    """
+    if _baseline is None or not tracemalloc.is_tracing():
+        return None
+    diffs = _snapshot().compare_to(_baseline, "traceback")
+    stages = collections.defaultdict(lambda: [0, 0])
+    sites = collections.defaultdict(lambda: [0, 0, None])
+    for diff in diffs:
+        stage = _stage_of(diff.traceback)
+        stages[stage][0] += diff.size_diff
+        stages[stage][1] += diff.count_diff
+        frame = diff.traceback[-1]
+        site = sites[f"{frame.filename}:{frame.lineno}"]
+        site[0] += diff.size_diff
+        site[1] += diff.count_diff
+        site[2] = stage
+    by_size = functools.partial(sorted, key=lambda item: item[1][0], reverse=True)
+    return {"pid": os.getpid(), "sinceSec": round(time.monotonic() - _baseline_at),
+            "growthMb": round(sum(diff.size_diff for diff in diffs) / MB, 2),
+            "stages": [{"stage": stage, "growthKb": round(size / 1024, 1), "blocks": count}
+                       for stage, (size, count) in by_size(stages.items())[:limit]],
+            "sites": [{"site": site, "stage": stage, "growthKb": round(size / 1024, 1), "blocks": count}
+                      for site, (size, count, stage) in by_size(sites.items())[:limit]]}
@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+if os.environ.get("PROMETHEUS_MULTIPROC_DIR") == "":
+    # prometheus_client turns multiprocess mode on when the variable is merely present, and would then
+    # write its sample files to the working directory; an empty value (docker-compose) means off
+    del os.environ["PROMETHEUS_MULTIPROC_DIR"]
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR and `/metrics` merges them,
+# so a scrape sees the whole pod whichever worker answers it.
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+if MULTIPROCESS:
+    # live gauges open their sample file as soon as they are built, which with --preload is before
+    # gunicorn's on_starting hook has prepared the directory
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 40, 90, 180)
+
+STAGE_LATENCY = Histogram("receipt_stage_duration_seconds", "Duration of a pipeline stage.",
+                          ["stage", "outcome"], buckets=LATENCY_BUCKETS)
+REQUESTS = Counter("receipt_http_requests_total", "HTTP requests by route and status code.", ["route", "status"])
+REQUEST_LATENCY = Histogram("receipt_http_request_duration_seconds", "HTTP request duration by route.",
+                            ["route"], buckets=LATENCY_BUCKETS)
+CACHE_EVENTS = Counter("receipt_cache_events_total", "Result cache hits, misses and evictions.", ["event"])
+STAGE_IN_FLIGHT = Gauge("receipt_stage_in_flight", "Calls running or waiting in a stage.", ["stage", "state"],
+                        multiprocess_mode="livesum")
+CASCADE_VARIANTS = Counter("receipt_cascade_variants_total", "Preprocessing cascade variants by outcome.",
+                           ["variant", "outcome"])
+REJECTIONS = Counter("receipt_rejections_total", "Requests refused or abandoned by admission control.", ["reason"])
+OCR_THREADS = Counter("receipt_ocr_threads_total", "OCR calls by the number of threads they were given.", ["threads"])
+WORKER_RSS = Gauge("receipt_worker_rss_bytes", "Resident memory of a worker process.", multiprocess_mode="liveall")
+WORKER_RECYCLES = Counter("receipt_worker_recycles_total", "Workers recycled for their memory use, by reason.", ["reason"])
+TRACE_SPANS = Counter("receipt_trace_spans_total", "Sampled trace spans by export outcome.", ["outcome"])
+ARCHIVE_ROWS = Counter("receipt_archive_rows_total", "Extraction results archived, by write outcome.", ["outcome"])
+
+
+def outcome_of(exc):
+    """
+    The function `outcome_of` maps the exception raised by a stage to a metrics outcome label.
+
+    :param exc: The `exc` parameter is the raised exception, or None on success
+    :return: "ok", "cancelled", the `ErrorObject` status code ("413", "415", "422", ...) or "500".
+    """
+    if exc is None:
+        return "ok"
+    if isinstance(exc, asyncio.CancelledError):
+        return "cancelled"
+    error_obj = getattr(exc, "error_obj", None)
+    if error_obj is not None:
+        return str(error_obj.error.status)
+    return "500"
+
+
+def observe_stage(stage, seconds, exc=None):
+    STAGE_LATENCY.labels(stage, outcome_of(exc)).observe(seconds)
+
+
+def render():
+    """
+    The function `render` serializes every metric in Prometheus text format, aggregating the samples
+    of all workers in multiprocess mode.
+
+    :return: a tuple of the payload bytes and its content type.
+    """
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
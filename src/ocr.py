@@ -0,0 +1,187 @@
+import os
+import queue
+import subprocess
+import threading
+import numpy as np
+import pytesseract
+from loguru import logger
+from src import config
+from src import scheduler
+
+
+class PytesseractBackend:
+    """
+    The class `PytesseractBackend` runs the tesseract binary through pytesseract: a temp file and a
+    fresh process (and model load) per image, but no native bindings required. pytesseract starts
+    tesseract with this process's environment, so `threads` cannot be honoured per call; the
+    process-wide `OMP_THREAD_LIMIT` set by `src.scheduler` applies instead.
+    """
+    name = "pytesseract"
+
+    def __init__(self, lang, psm, oem):
+        self.lang = lang
+        self.config = f"--psm {psm} --oem {oem}"
+
+    def image_to_string(self, image, threads=None):
+        return pytesseract.image_to_string(image, lang=self.lang, config=self.config)
+
+    def image_to_data(self, image, threads=None):
+        return pytesseract.image_to_data(image, lang=self.lang, config=self.config)
+
+
+class TesseractStdinBackend:
+    """
+    The class `TesseractStdinBackend` still runs one tesseract process per image, but writes the
+    pixels to its stdin as a binary PGM/PPM (a short header in front of the raw buffer, no encoding)
+    and reads the text from its stdout, instead of pytesseract's temp image and temp text files.
+    """
+    name = "tesseract-stdin"
+
+    def __init__(self, lang, psm, oem):
+        self.lang = lang
+        self.psm = psm
+        self.oem = oem
+
+    @staticmethod
+    def to_pnm(image):
+        """
+        The function `to_pnm` wraps a uint8 grayscale or RGB array in a binary PNM header.
+
+        :return: the PNM bytes (header + pixel buffer).
+        """
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        magic = b"P5" if image.ndim == 2 else b"P6"
+        return b"%s\n%d %d\n255\n" % (magic, width, height) + image.data
+
+    def _run(self, image, *configs, threads=None):
+        command = [pytesseract.pytesseract.tesseract_cmd, "stdin", "stdout", "-l", self.lang,
+                   "--psm", str(self.psm), "--oem", str(self.oem), *configs]
+        # the OpenMP threads of this tesseract process only
+        env = dict(os.environ, OMP_THREAD_LIMIT=str(threads)) if threads else None
+        proc = subprocess.run(command, input=self.to_pnm(image), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              env=env)
+        if proc.returncode != 0:
+            raise RuntimeError(f"tesseract exited with {proc.returncode}: {proc.stderr.decode(errors='replace').strip()}")
+        return proc.stdout.decode("utf-8")
+
+    def image_to_string(self, image, threads=None):
+        return self._run(image, threads=threads)
+
+    def image_to_data(self, image, threads=None):
+        return self._run(image, "tsv", threads=threads)
+
+
+class TesserocrBackend:
+    """
+    The class `TesserocrBackend` keeps a pool of long-lived `tesserocr.PyTessBaseAPI` handles so the
+    language model is loaded once per handle instead of once per image. Each concurrent OCR call
+    borrows one handle; handles are created on demand up to `pool_size`, after which callers wait.
+    """
+    name = "tesserocr"
+
+    def __init__(self, lang, psm, oem, pool_size):
+        import tesserocr
+        self._tesserocr = tesserocr
+        self.lang = lang
+        self.psm = psm
+        self.oem = oem
+        self.pool_size = pool_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_handle(self):
+        return self._tesserocr.PyTessBaseAPI(lang=self.lang, psm=self.psm, oem=self.oem)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.pool_size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._new_handle()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def _recognize(self, image, read, threads=None):
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        # recognition runs on this thread, so its OpenMP team size is the call's thread count
+        scheduler.limit_openmp(threads)
+        api = self._acquire()
+        try:
+            api.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+            return read(api)
+        finally:
+            api.Clear()
+            self._idle.put(api)
+
+    def image_to_string(self, image, threads=None):
+        """
+        The function `image_to_string` OCRs a grayscale or BGR NumPy image on a pooled handle, passing
+        the pixel buffer directly instead of through a temp file.
+
+        :param image: The `image` parameter is a uint8 NumPy array (H x W or H x W x C)
+        :param threads: The `threads` parameter is the number of threads tesseract may use, None for its default
+        :return: the recognized text.
+        """
+        return self._recognize(image, lambda api: api.GetUTF8Text(), threads)
+
+    def image_to_data(self, image, threads=None):
+        """
+        The function `image_to_data` is `image_to_string` returning tesseract's TSV instead of plain
+        text: one row per page, block, paragraph, line and word with its box and confidence.
+        """
+        return self._recognize(image, lambda api: api.GetTSVText(0), threads)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    The function `get_backend` returns this process's OCR backend, built on first use so handles are
+    created inside each worker (never inherited across fork). Falls back to pytesseract when
+    tesserocr is requested but not installed.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _create_backend(config.OCR_BACKEND)
+    return _backend
+
+
+def reset_backend():
+    """
+    The function `reset_backend` forgets the backend built in this process. Called in freshly forked
+    workers so native handles created by a preloading parent are never used from the child.
+    """
+    global _backend
+    _backend = None
+
+
+def _create_backend(name):
+    # thread limits first: libgomp reads OMP_THREAD_LIMIT once, when tesserocr loads it
+    scheduler.configure_process(name)
+    if name == "tesserocr":
+        try:
+            return TesserocrBackend(config.TESSERACT_LANG, config.TESSERACT_PSM, config.TESSERACT_OEM,
+                                    config.OCR_HANDLE_POOL_SIZE)
+        except ImportError:
+            logger.warning("OCR_BACKEND=tesserocr but tesserocr is not installed, using pytesseract")
+            scheduler.configure_process("pytesseract")
+    if name == "tesseract-stdin":
+        return TesseractStdinBackend(config.TESSERACT_LANG, config.TESSERACT_PSM, config.TESSERACT_OEM)
+    return PytesseractBackend(config.TESSERACT_LANG, config.TESSERACT_PSM, config.TESSERACT_OEM)
@@ -0,0 +1,105 @@
+"""
+Plumbing shared by the stores and exporters of the service: per-thread sqlite connections in WAL mode,
+and background writers that take records off the request path and write them in batches.
+"""
+import os
+import queue
+import sqlite3
+import threading
+
+
+def wal_connection(local, path, timeout, autocommit=False, rows=False):
+    """
+    The function `wal_connection` returns the calling thread's connection to a sqlite file, opened in
+    WAL mode on first use so every worker on the host can read while another writes.
+
+    :param local: The `local` parameter is the store's `threading.local` holding its connections
+    :param path: The `path` parameter is the database file
+    :param timeout: The `timeout` parameter is how long a statement waits on another writer's lock
+    :param autocommit: The `autocommit` parameter leaves transactions to explicit BEGIN/COMMIT
+    :param rows: The `rows` parameter returns `sqlite3.Row` instead of tuples
+    :return: the connection.
+    """
+    conn = getattr(local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=timeout, isolation_level=None if autocommit else "")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if rows:
+            conn.row_factory = sqlite3.Row
+        local.conn = conn
+    return conn
+
+
+class BatchWriter:
+    """
+    The class `BatchWriter` queues records for a background thread that hands them to `write` every
+    `interval` seconds, at most `batch_size` at a time (all of them without one). The queue is bounded:
+    while the writer is stalled, new records are dropped and counted on `counter` instead of piling up.
+    Subclasses implement `write(batch)`.
+    """
+    def __init__(self, interval, max_queue, counter, batch_size=None, name="batch-writer"):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.counter = counter
+        self._queue = queue.Queue(max_queue)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.counter.labels("dropped").inc()
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) == self.batch_size:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def shutdown(self):
+        self._stop.set()
+        self._thread.join(timeout=self.interval + 5)
+        self.flush()
+
+
+class ProcessLocal:
+    """
+    The class `ProcessLocal` holds one `BatchWriter` per process, built by `factory` on first use. A
+    forked gunicorn worker builds its own: the parent's writer thread does not survive the fork.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self._writer = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._writer is None or self._pid != os.getpid():
+            with self._lock:
+                if self._writer is None or self._pid != os.getpid():
+                    self._writer = self.factory()
+                    self._pid = os.getpid()
+        return self._writer
+
+    def shutdown(self):
+        """The function `shutdown` writes what this process's writer still has queued; called when the worker stops."""
+        if self._writer is not None and self._pid == os.getpid():
+            self._writer.shutdown()
+        self._writer = None
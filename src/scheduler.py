@@ -0,0 +1,137 @@
+"""
+Core-aware scheduling of the OCR threads.
+
+Tesseract parallelizes recognition with OpenMP and OpenCV keeps its own thread pool. Left alone,
+both start one thread per host core in every call of every gunicorn worker, so a busy node spends
+its time context switching. Each worker process gets its share of the available cores,
+`WORKER_CPUS`. That share accounts for cgroup quotas and the number of workers. The stage pools are
+sized to it in `src.config`, and this module decides how many threads each OCR call may use:
+
+    throughput  one thread per image, as many images at once as the worker has cores
+    latency     OCR_MAX_THREADS threads per image, correspondingly fewer images at once
+    adaptive    the worker's cores split among the images being read right now: a lone request
+                gets many threads, a busy worker runs one thread per image
+    off         no limits (the tesseract and OpenCV defaults)
+
+Per-call thread counts reach tesseract through the `OMP_THREAD_LIMIT` of its process
+(tesseract-stdin) or through `omp_set_num_threads` on the calling thread (tesserocr). pytesseract
+gives no control over the environment of a single call, so it runs with a fixed limit per process.
+"""
+import ctypes
+import ctypes.util
+import os
+import threading
+from contextlib import contextmanager
+from loguru import logger
+from src import config
+from src import tracing
+from src.metrics import OCR_THREADS
+
+MODES = ("throughput", "latency", "adaptive", "off")
+# backends that take a thread count per call; the others only follow the process-wide limit
+PER_CALL_BACKENDS = ("tesserocr", "tesseract-stdin")
+
+mode = config.OCR_SCHEDULING if config.OCR_SCHEDULING in MODES else "adaptive"
+_running = 0
+_running_lock = threading.Lock()
+_omp_set_num_threads = None
+
+
+def set_mode(value):
+    """The function `set_mode` overrides `OCR_SCHEDULING` for this process (e.g. one CLI process per core)."""
+    global mode
+    mode = value
+
+
+def process_threads(concurrency):
+    """
+    The function `process_threads` is the fixed thread count of a library limited per process: each
+    of `concurrency` simultaneous calls gets an equal share of the worker's cores.
+
+    :return: the thread count, or None when scheduling is off.
+    """
+    if mode == "off":
+        return None
+    if mode == "throughput":
+        return 1
+    return max(1, min(config.OCR_MAX_THREADS, config.WORKER_CPUS // max(1, concurrency)))
+
+
+def call_threads(running):
+    """
+    The function `call_threads` is the thread count of an OCR call started while `running` calls
+    (this one included) are in progress in this process.
+
+    :return: the thread count, or None when scheduling is off.
+    """
+    if mode == "off":
+        return None
+    if mode == "throughput":
+        return 1
+    if mode == "latency":
+        return config.OCR_MAX_THREADS
+    return max(1, min(config.OCR_MAX_THREADS, config.WORKER_CPUS // running))
+
+
+def configure_process(backend):
+    """
+    The function `configure_process` applies the process-wide limits before the OCR backend is
+    loaded: `OMP_THREAD_LIMIT` (read by tesseract processes at start and by libgomp when tesserocr
+    loads it) and OpenCV's thread pool size.
+
+    :param backend: The `backend` parameter is the name of the OCR backend about to be created
+    """
+    if mode == "off":
+        return
+    omp = config.OCR_MAX_THREADS if backend in PER_CALL_BACKENDS else process_threads(config.OCR_CONCURRENCY)
+    os.environ["OMP_THREAD_LIMIT"] = str(omp)
+    import cv2
+    cv2.setNumThreads(process_threads(config.PREPROCESS_CONCURRENCY))
+    logger.info(f"OCR scheduling {mode} | {config.WORKER_CPUS} of {config.CPU_COUNT} cores for this worker "
+                f"| {config.OCR_CONCURRENCY} OCR calls at once | OMP_THREAD_LIMIT={omp} "
+                f"| OpenCV threads {cv2.getNumThreads()}")
+
+
+@contextmanager
+def ocr_call():
+    """
+    The function `ocr_call` brackets one OCR call, counting it among the running ones.
+
+    :return: a context manager yielding the call's thread count (None when scheduling is off).
+    """
+    global _running
+    with _running_lock:
+        _running += 1
+        threads = call_threads(_running)
+    OCR_THREADS.labels(str(threads) if threads else "default").inc()
+    tracing.annotate({"ocr.threads": threads or 0})
+    try:
+        yield threads
+    finally:
+        with _running_lock:
+            _running -= 1
+
+
+def limit_openmp(threads):
+    """
+    The function `limit_openmp` sets the size of the OpenMP teams the calling thread starts, for
+    tesseract running in this process. It does nothing when libgomp cannot be found.
+
+    :param threads: The `threads` parameter is the thread count, None to leave it unchanged
+    """
+    global _omp_set_num_threads
+    if not threads:
+        return
+    if _omp_set_num_threads is None:
+        _omp_set_num_threads = _load_openmp()
+    if _omp_set_num_threads:
+        _omp_set_num_threads(threads)
+
+
+def _load_openmp():
+    # the soname resolves to the libgomp tesseract already loaded, if it was built with OpenMP
+    name = ctypes.util.find_library("gomp")
+    try:
+        return ctypes.CDLL(name).omp_set_num_threads if name else False
+    except (OSError, AttributeError):
+        return False
@@ -1,7 +1,8 @@
-from pydantic import BaseModel , conlist , confloat , AnyHttpUrl, conint
-from typing import Dict , Optional , List ,Any, Callable, Generator, Type, TypeVar
+from pydantic import BaseModel , conlist , confloat , AnyHttpUrl, conint, AnyUrl, UrlConstraints
+from typing import Dict , Optional , List ,Any, Callable, Generator, Type, TypeVar, Annotated
 from enum import Enum
 from fastapi import Query , Request
+from src.config import BATCH_MAX_URLS
 
 
 
@@ -36,6 +37,26 @@ class ErrorObject500(BaseModel):
     msg: str = "unable to process - internal server error"
     responseCode: str = "fail"
 
+class ErrorObject404(BaseModel):
+    status: str = "404"
+    msg: str = "job not found"
+    responseCode: str = "fail"
+
+class ErrorObject429(BaseModel):
+    status: str = "429"
+    msg: str = "rate limit exceeded - please retry later"
+    responseCode: str = "fail"
+
+class ErrorObject504(BaseModel):
+    status: str = "504"
+    msg: str = "request deadline exceeded before the receipt could be processed"
+    responseCode: str = "fail"
+
+class ErrorObject503(BaseModel):
+    status: str = "503"
+    msg: str = "service busy - too many requests in flight, please retry later"
+    responseCode: str = "fail"
+
 class ErrorResponse422(BaseModel):
     error: ErrorObject422
 
@@ -49,17 +70,52 @@ class ErrorResponse415(BaseModel):
     error: ErrorObject415
 class ErrorResponse500(BaseModel):
     error: ErrorObject500
+class ErrorResponse503(BaseModel):
+    error: ErrorObject503
+class ErrorResponse404(BaseModel):
+    error: ErrorObject404
+class ErrorResponse429(BaseModel):
+    error: ErrorObject429
+class ErrorResponse504(BaseModel):
+    error: ErrorObject504
+# http(s) urls are downloaded; file:// (under FILE_URL_ROOTS) and s3:// urls are read by src.fetchers
+ReceiptUrl = Annotated[AnyUrl, UrlConstraints(max_length=2083, allowed_schemes=["http", "https", "file", "s3"])]
+
 class BaseRequest(BaseModel):
     requestId: str = None
 
 class ImageRequest(BaseRequest):
-    img_url: conlist(AnyHttpUrl , min_length=1 , max_length=1) = Query(
-        ..., description="List of image(s) [JPEG/TIFF/PNG/PDF] urls."
+    img_url: conlist(ReceiptUrl , min_length=1 , max_length=1) = Query(
+        ..., description="List of image(s) [JPEG/TIFF/PNG/PDF] urls: http(s)://, file:// or s3://."
     )
 
 
 class ImgRequest(ImageRequest):
-    pass
+    structured: bool = Query(
+        False, description="Return the lines, word boxes and confidences of the OCR pass along with the total."
+    )
+
+class BatchImageRequest(BaseRequest):
+    img_url: conlist(ReceiptUrl , min_length=1 , max_length=BATCH_MAX_URLS) = Query(
+        ..., description=f"List of up to {BATCH_MAX_URLS} image [JPEG/TIFF/PNG/PDF] urls: http(s)://, file:// or s3://."
+    )
+    stream: bool = Query(
+        False, description="Stream one NDJSON line per image as soon as it completes instead of a single JSON response."
+    )
+
+class JobRequest(ImageRequest):
+    callback_url: Optional[AnyHttpUrl] = Query(
+        None, description="Optional url the finished job is POSTed to."
+    )
+
+class JobResponse(BaseModel):
+    jobId: str
+    status: str
+    requestId: Optional[str] = None
+    result: Any = None
+    error: Optional[Dict[str, Any]] = None
+    createdAt: Optional[float] = None
+    updatedAt: Optional[float] = None
 
 class ResultObject(BaseModel):
     pass
@@ -67,11 +123,63 @@ class ResultObject(BaseModel):
 class ResponseSchema(ResultObject):
     pass
 
+class TotalCandidate(BaseModel):
+    line: str
+    amount: float
+    keyword: str
+
+class TotalExtraction(BaseModel):
+    total: float = 0.0
+    confidence: float = 0.0
+    sourceLine: Optional[str] = None
+    candidates: List[TotalCandidate] = []
+
+class OcrWords(BaseModel):
+    # one array per attribute, index i of each describing word i
+    text: List[str] = []
+    conf: List[int] = []
+    left: List[int] = []
+    top: List[int] = []
+    width: List[int] = []
+    height: List[int] = []
+    line: List[int] = []
+    page: List[int] = []
+
+class StructuredResult(BaseModel):
+    total: float = 0.0
+    confidence: float = 0.0
+    sourceLine: Optional[str] = None
+    sourceLineIndex: Optional[int] = None
+    pages: List[List[int]] = []
+    lines: List[str] = []
+    words: OcrWords = OcrWords()
+
+class BatchItemError(BaseModel):
+    status: str
+    msg: str
+    responseCode: str = "fail"
+
+class DuplicateMatch(BaseModel):
+    contentHash: str
+    distance: int
+
+class BatchItem(BaseModel):
+    index: int
+    img_url: str
+    result: Any = None
+    error: Optional[BatchItemError] = None
+    duplicateOf: Optional[DuplicateMatch] = None
+
+class BatchResponseSchema(BaseModel):
+    results: List[BatchItem]
+
 
 # The class `ErrorObject` is used to handle different types of error responses based on their status
 # code.
 class ErrorObject(Exception):
-    def __init__(self, response):
+    def __init__(self, response, headers=None):
+        # extra response headers, e.g. Retry-After on 429/503
+        self.headers = headers
         if response['error']['status'] == '422':
             self.error_obj = ErrorResponse422(**response)
         elif response['error']['status'] == '400':
@@ -80,5 +188,13 @@ class ErrorObject(Exception):
             self.error_obj = ErrorResponse413(**response)
         elif response['error']['status'] == '415':
             self.error_obj = ErrorResponse415(**response)
+        elif response['error']['status'] == '404':
+            self.error_obj = ErrorResponse404(**response)
+        elif response['error']['status'] == '503':
+            self.error_obj = ErrorResponse503(**response)
+        elif response['error']['status'] == '429':
+            self.error_obj = ErrorResponse429(**response)
+        elif response['error']['status'] == '504':
+            self.error_obj = ErrorResponse504(**response)
         else:
             self.error_obj = ErrorResponse500(**response)
\ No newline at end of file
@@ -0,0 +1,64 @@
+import re
+from src.schemas import TotalCandidate, TotalExtraction
+
+# "sub total" / "subtotal" is matched first so it is not mistaken for a grand total.
+KEYWORD = re.compile(r"sub\s*-?\s*total|grand\s*total|total|amount|balance\s*due")
+# An amount needs a decimal part, like the legacy `\d+\.\d+`, but also accepts a comma as the decimal
+# mark, thousands separators (1,234.56 / 1.234,56 / 1 234,56) and a leading currency sign. A comma
+# decimal has at most 2 digits so "1,234" is not read as 1.234.
+AMOUNT = re.compile(r"(?<![\d.,])([$€£₹¥]\s?)?(\d{1,3}(?:[,. '](?=\d{3}(?!\d))\d{3})+|\d+)(?:\.(\d{1,3})|,(\d{1,2}))(?!\d)")
+SEPARATORS = re.compile(r"[,. ']")
+
+KEYWORD_WEIGHT = {"total": 0.6, "grand total": 0.7, "balance due": 0.6, "amount": 0.4, "subtotal": 0.3}
+
+
+def _keyword(match):
+    word = " ".join(match.group(0).replace("-", " ").split())
+    if word.startswith("sub"):
+        return "subtotal"
+    return word
+
+
+def _amount(match):
+    return float(SEPARATORS.sub("", match.group(2)) + "." + (match.group(3) or match.group(4)))
+
+
+def extract_total(ocr_text):
+    """
+    The function `extract_total` scans the OCR text once and picks the receipt total. Every line with
+    a total/subtotal/amount keyword and a decimal amount becomes a candidate (its right-most amount);
+    the largest candidate wins, as with the legacy parser, since the total is never smaller than
+    the subtotal or the item amounts.
+
+    The confidence grows with the strength of the winning keyword (grand total > total > amount >
+    subtotal), with other lines agreeing on the same amount and with a currency sign next to it.
+
+    :param ocr_text: The `ocr_text` parameter is the text returned by OCR
+    :return: a `TotalExtraction` with the total, its source line, the candidates and a 0-1 confidence.
+    """
+    candidates = []
+    signed = set()
+    for line in ocr_text.splitlines():
+        keyword = KEYWORD.search(line.lower())
+        if keyword is None:
+            continue
+        amounts = list(AMOUNT.finditer(line))
+        if not amounts:
+            continue
+        match = amounts[-1]
+        candidate = TotalCandidate(line=line.strip(), amount=_amount(match), keyword=_keyword(keyword))
+        if match.group(1):
+            signed.add(len(candidates))
+        candidates.append(candidate)
+    if not candidates:
+        return TotalExtraction()
+
+    best = max(range(len(candidates)), key=lambda i: (candidates[i].amount, KEYWORD_WEIGHT[candidates[i].keyword]))
+    chosen = candidates[best]
+    confidence = KEYWORD_WEIGHT[chosen.keyword]
+    if any(i != best and c.amount == chosen.amount for i, c in enumerate(candidates)):
+        confidence += 0.2
+    if best in signed:
+        confidence += 0.1
+    return TotalExtraction(total=chosen.amount, confidence=round(min(confidence, 1.0), 2),
+                           sourceLine=chosen.line, candidates=candidates)
@@ -0,0 +1,280 @@
+"""
+Request-scoped tracing of the pipeline stages.
+
+A trace is started per HTTP request (or job) and every stage below it records a span: stage queue
+waits, downloads, validation, decoding, preprocessing, OCR and parsing, with sizes and image
+dimensions as attributes. Spans follow the current task through the stage pools (the executor copies
+the caller's context into pool threads), so one slow receipt shows where its time went.
+
+The sampling decision is taken once, at the head of the trace: an incoming W3C `traceparent` header
+decides for its trace, other requests are sampled with probability `TRACE_SAMPLE_RATE`. Unsampled
+requests only pay for a context variable lookup per stage. Sampled spans are exported in the
+background as JSON lines to `TRACE_FILE` and/or as OTLP/HTTP JSON to `TRACE_OTLP_ENDPOINT`.
+"""
+import contextvars
+import json
+import os
+import random
+import re
+import socket
+import time
+import requests
+from loguru import logger
+from src import config
+from src.metrics import TRACE_SPANS, outcome_of
+from src.persistence import BatchWriter, ProcessLocal
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+INVALID_TRACE_ID = "0" * 32
+INVALID_SPAN_ID = "0" * 16
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+KIND_CONSUMER = 5
+
+ENABLED = bool(config.TRACE_FILE or config.TRACE_OTLP_ENDPOINT)
+
+_current = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    """
+    The class `Span` is one timed operation of a sampled trace. Used as a context manager it becomes
+    the parent of the spans opened inside it (in this task and in the pool threads it hands work to)
+    and is exported when it ends; an exception escaping it marks it failed with the same outcome
+    label the stage metrics use.
+    """
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind", "attributes", "start_ns", "end_ns",
+                 "error", "_token", "_open")
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None, kind=KIND_INTERNAL):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes) if attributes else {}
+        self.start_ns = 0
+        self.end_ns = 0
+        self.error = None
+        self._token = None
+        self._open = False
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def update(self, attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        if exc is not None:
+            self.error = outcome_of(exc)
+        if not self._open:
+            self.end()
+        return False
+
+    def keep_open(self):
+        """
+        The function `keep_open` leaves the span running when its `with` block exits: the work it
+        times goes on elsewhere (a streamed response body), which calls `end` when done.
+        """
+        self._open = True
+
+    def end(self, exc=None):
+        if exc is not None:
+            self.error = outcome_of(exc)
+        self.end_ns = time.time_ns()
+        get_exporter().export(self)
+
+    def to_dict(self):
+        return {"traceId": self.trace_id, "spanId": self.span_id, "parentSpanId": self.parent_id,
+                "name": self.name, "kind": self.kind, "startTimeUnixNano": self.start_ns,
+                "endTimeUnixNano": self.end_ns, "durationMs": round((self.end_ns - self.start_ns) / 1e6, 3),
+                "status": "error" if self.error else "ok", "error": self.error, "attributes": self.attributes}
+
+
+class _NoopSpan:
+    """The class `_NoopSpan` stands in for spans of unsampled requests: every call does nothing."""
+    traceparent = None
+
+    def set(self, key, value):
+        pass
+
+    def update(self, attributes):
+        pass
+
+    def keep_open(self):
+        pass
+
+    def end(self, exc=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP = _NoopSpan()
+
+
+def parse_traceparent(header):
+    """
+    The function `parse_traceparent` reads a W3C `traceparent` header.
+
+    :return: a tuple of (trace id, parent span id, sampled), or None when the header is absent or invalid.
+    """
+    match = TRACEPARENT.match(header.strip().lower()) if header else None
+    if match is None or match.group(1) == INVALID_TRACE_ID or match.group(2) == INVALID_SPAN_ID:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+def trace(name, traceparent=None, attributes=None, kind=KIND_SERVER):
+    """
+    The function `trace` opens the root span of a request, taking the head sampling decision: the
+    caller's `traceparent` decides when present (its trace id and parent are kept), otherwise the
+    request is sampled with probability `TRACE_SAMPLE_RATE`.
+
+    :param name: The `name` parameter is the span name
+    :param traceparent: The `traceparent` parameter is the incoming W3C header, if any
+    :param attributes: The `attributes` parameter is a dict of initial span attributes
+    :return: a `Span` to use as a context manager, or `NOOP` when the request is not traced.
+    """
+    if not ENABLED:
+        return NOOP
+    parent = parse_traceparent(traceparent)
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id, parent_id, sampled = os.urandom(16).hex(), None, random.random() < config.TRACE_SAMPLE_RATE
+    if not sampled:
+        return NOOP
+    return Span(name, trace_id, parent_id, attributes, kind)
+
+
+def span(name, attributes=None, kind=KIND_INTERNAL):
+    """
+    The function `span` opens a child of the current span.
+
+    :return: a `Span` to use as a context manager, or `NOOP` outside a sampled trace.
+    """
+    parent = _current.get()
+    if parent is None:
+        return NOOP
+    return Span(name, parent.trace_id, parent.span_id, attributes, kind)
+
+
+def current():
+    """The function `current` returns the innermost open span, or `NOOP` outside a sampled trace."""
+    return _current.get() or NOOP
+
+
+def annotate(attributes):
+    """The function `annotate` adds attributes to the innermost open span, if the request is traced."""
+    parent = _current.get()
+    if parent is not None:
+        parent.update(attributes)
+
+
+def headers():
+    """The function `headers` returns the `traceparent` header propagating the current span to a downstream call."""
+    parent = _current.get()
+    return {"traceparent": parent.traceparent} if parent is not None else {}
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def to_otlp(spans, resource):
+    """
+    The function `to_otlp` encodes finished spans as an OTLP/HTTP JSON `ExportTraceServiceRequest`.
+
+    :param spans: The `spans` parameter is a list of `Span.to_dict()` records
+    :param resource: The `resource` parameter is a dict of resource attributes (service.name, ...)
+    :return: the request body as a dict.
+    """
+    encoded = []
+    for record in spans:
+        item = {"traceId": record["traceId"], "spanId": record["spanId"], "name": record["name"],
+                "kind": record["kind"], "startTimeUnixNano": str(record["startTimeUnixNano"]),
+                "endTimeUnixNano": str(record["endTimeUnixNano"]),
+                "attributes": _otlp_attributes(dict(record["attributes"], error=record["error"])),
+                # STATUS_CODE_OK = 1, STATUS_CODE_ERROR = 2
+                "status": {"code": 2 if record["error"] else 1}}
+        if record["parentSpanId"]:
+            item["parentSpanId"] = record["parentSpanId"]
+        encoded.append(item)
+    return {"resourceSpans": [{"resource": {"attributes": _otlp_attributes(resource)},
+                               "scopeSpans": [{"scope": {"name": "src.tracing"}, "spans": encoded}]}]}
+
+
+class SpanExporter(BatchWriter):
+    """
+    The class `SpanExporter` writes finished spans every `TRACE_EXPORT_INTERVAL_SEC` to the trace file
+    and/or the OTLP collector, from the background thread of a `BatchWriter`.
+    """
+    def __init__(self, path, endpoint, interval, max_queue):
+        self.path = path
+        self.endpoint = endpoint
+        self.resource = {"service.name": config.TRACE_SERVICE_NAME, "host.name": socket.gethostname(),
+                         "process.pid": os.getpid()}
+        super().__init__(interval, max_queue, TRACE_SPANS, name="span-exporter")
+
+    def export(self, finished):
+        self.put(finished.to_dict())
+
+    def write(self, batch):
+        if self.path:
+            try:
+                with open(self.path, "a") as f:
+                    f.write("".join(json.dumps(dict(record, resource=self.resource)) + "\n" for record in batch))
+                TRACE_SPANS.labels("written").inc(len(batch))
+            except OSError as e:
+                TRACE_SPANS.labels("failed").inc(len(batch))
+                logger.warning(f"unable to write {len(batch)} spans to {self.path} --- {e}")
+        if self.endpoint:
+            try:
+                response = requests.post(self.endpoint, json=to_otlp(batch, self.resource), timeout=5)
+                response.raise_for_status()
+                TRACE_SPANS.labels("sent").inc(len(batch))
+            except requests.RequestException as e:
+                TRACE_SPANS.labels("failed").inc(len(batch))
+                logger.warning(f"unable to send {len(batch)} spans to {self.endpoint} --- {e}")
+
+
+_exporter = ProcessLocal(lambda: SpanExporter(config.TRACE_FILE, config.TRACE_OTLP_ENDPOINT,
+                                              config.TRACE_EXPORT_INTERVAL_SEC, config.TRACE_QUEUE_SIZE))
+
+
+def get_exporter():
+    """The function `get_exporter` returns this process's `SpanExporter`."""
+    return _exporter.get()
+
+
+def shutdown():
+    """The function `shutdown` exports the spans still queued; called when the worker stops."""
+    _exporter.shutdown()
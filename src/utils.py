@@ -3,9 +3,27 @@ from loguru import logger
 import functools
 import time
 import inspect
+import random
 import re
+from src.config import SLOW_LOG_SYNC_SEC, TIMING_LOG_SAMPLE_RATE
+from src.metrics import observe_stage
+from src import tracing
+from src import archive
 
-SLOW_LOG_SYNC_SEC = 3
+
+def log_timing(message, total):
+    """
+    The function `log_timing` logs a timing line only when it is worth reading: always (as a warning)
+    when the call took longer than `SLOW_LOG_SYNC_SEC`, otherwise for a `TIMING_LOG_SAMPLE_RATE`
+    fraction of calls. Every call is recorded in the stage histograms regardless.
+
+    :param message: The `message` parameter is the formatted timing line
+    :param total: The `total` parameter is the measured duration in seconds
+    """
+    if total > SLOW_LOG_SYNC_SEC:
+        logger.warning(f"SLOW | {message}")
+    elif random.random() < TIMING_LOG_SAMPLE_RATE:
+        logger.info(message)
 
 def async_timed_app():
     """
@@ -24,15 +42,17 @@ def async_timed_app():
                 request_id = None
 
             start = time.monotonic()
+            error = None
             try:
                 return await func(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
             finally:
                 end = time.monotonic()
                 total = end - start
-                if total > SLOW_LOG_SYNC_SEC:
-                    logger.info(f"FUNCTION_NAME: {func.__name__} | EXEC_TIME: {total:.4f} seconds | REQUEST_ID: {request_id}")
-                else:
-                    logger.info(f"FUNCTION_NAME: {func.__name__} | EXEC_TIME: {total:.4f} seconds | REQUEST_ID: {request_id}")
+                observe_stage(func.__name__, total, error)
+                log_timing(f"FUNCTION_NAME: {func.__name__} | EXEC_TIME: {total:.4f} seconds | REQUEST_ID: {request_id}", total)
 
         return wrapped
 
@@ -41,12 +61,15 @@ def async_timed_app():
 def timed_methods(cls):
     """
     The `timed_methods` function is a decorator that adds timing functionality to all methods of a
-    class.
+    class. Private helpers and dunder methods (leading underscore) are left untimed since they run
+    per chunk or per line inside the timed stages and are not pipeline stages themselves.
 
     :param cls: The parameter `cls` is a class object
     :return: The `timed_methods` function returns the modified class with the timed methods.
     """
-    for name, method in cls.__dict__.items():
+    for name, method in list(cls.__dict__.items()):
+        if name.startswith("_"):
+            continue
         if callable(method):
             if inspect.iscoroutinefunction(method):
                 setattr(cls, name, async_timed(method))
@@ -64,13 +87,20 @@ def timed(func):
     @functools.wraps(func)
     def wrapped(self,*args, **kwargs):
         start_time = time.monotonic()
+        error = None
         try:
-            return func(self,*args, **kwargs)
+            with tracing.span(func.__name__):
+                return func(self,*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
         finally:
             end_time = time.monotonic()
             total_time = end_time - start_time
+            observe_stage(func.__name__, total_time, error)
+            archive.add_timing(func.__name__, total_time)
             request_id = getattr(self, 'request_id', None)
-            logger.info(f"REQUEST_ID : {request_id} | FUNCTION_NAME : {func.__name__} | EXEC_TIME {total_time} seconds |")
+            log_timing(f"REQUEST_ID : {request_id} | FUNCTION_NAME : {func.__name__} | EXEC_TIME {total_time} seconds |", total_time)
     return wrapped
 
 def async_timed(func):
@@ -85,13 +115,20 @@ def async_timed(func):
     @functools.wraps(func)
     async def wrapped(self,*args, **kwargs):
         start_time = time.monotonic()
+        error = None
         try:
-            return await func(self,*args, **kwargs)
+            with tracing.span(func.__name__):
+                return await func(self,*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
         finally:
             end_time = time.monotonic()
             total_time = end_time - start_time
+            observe_stage(func.__name__, total_time, error)
+            archive.add_timing(func.__name__, total_time)
             request_id = getattr(self, 'request_id', None)
-            logger.info(f" REQUEST_ID : {request_id} | FUNCTION_NAME : {func.__name__} | EXEC_TIME {total_time} seconds | REQUEST_ID : {request_id}")
+            log_timing(f" REQUEST_ID : {request_id} | FUNCTION_NAME : {func.__name__} | EXEC_TIME {total_time} seconds | REQUEST_ID : {request_id}", total_time)
     return wrapped
 
 def validate_pan(pan_num):
@@ -0,0 +1,47 @@
+import asyncio
+import contextvars
+import pytest
+from src import admission, config
+from src.schemas import ErrorObject
+
+
+class FakeRequest:
+    def __init__(self, timeout=None):
+        self.headers = {"X-Request-Timeout": timeout} if timeout is not None else {}
+
+
+def remaining_after(timeout, server_deadline, monkeypatch):
+    monkeypatch.setattr(config, "REQUEST_DEADLINE_SEC", server_deadline)
+
+    def start():
+        admission.start_deadline(FakeRequest(timeout))
+        return admission.remaining()
+    return contextvars.copy_context().run(start)
+
+
+@pytest.mark.parametrize("timeout, server_deadline, low, high", [
+    (None, 170, 169, 170),
+    ("5", 170, 4, 5),
+    ("500", 170, 169, 170),     # the client cannot extend the server's budget
+    ("abc", 170, 169, 170),     # unparsable: ignored
+    ("5", 0, 4, 5),             # no server deadline: the client's applies
+])
+def test_budget(timeout, server_deadline, low, high, monkeypatch):
+    assert low < remaining_after(timeout, server_deadline, monkeypatch) <= high
+
+
+def test_no_deadline_at_all(monkeypatch):
+    assert remaining_after(None, 0, monkeypatch) is None
+
+
+@pytest.mark.parametrize("timeout", ["0", "-1", "-0.5"])
+def test_non_positive_timeout_is_already_expired(timeout, monkeypatch):
+    monkeypatch.setattr(config, "REQUEST_DEADLINE_SEC", 170)
+
+    async def request():
+        admission.start_deadline(FakeRequest(timeout))
+        return await admission.within_deadline(asyncio.sleep(0, "done"))
+
+    with pytest.raises(ErrorObject) as raised:
+        asyncio.run(request())
+    assert raised.value.error_obj.error.status == "504"
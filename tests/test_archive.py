@@ -0,0 +1,85 @@
+import asyncio
+import contextvars
+import threading
+import pytest
+from src import archive
+from src import config
+from src import inferenceEngine
+from src.cache import ResultCache
+from src.inferenceEngine import InferenceEngine
+from src.persistence import ProcessLocal
+
+URL = "http://receipts/a.jpeg"
+FILE = b"receipt bytes"
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = archive.ArchiveStore(str(tmp_path / "archive.db"))
+    monkeypatch.setattr(config, "ARCHIVE_ENABLED", True)
+    monkeypatch.setattr(archive, "_writer", ProcessLocal(lambda: archive.ArchiveWriter(store, 100, 3600, 100)))
+    monkeypatch.setattr(inferenceEngine, "get_cache", lambda cache=ResultCache(16, 3600): cache)
+    monkeypatch.setattr(inferenceEngine, "get_index", lambda: None)
+    return store
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = InferenceEngine()
+
+    async def download(url):
+        return FILE, "jpeg", 1
+
+    async def extract(file_bytes, ext, pages, digest, meta, inline=False):
+        archive.note_text("TOTAL 12,50")
+        return 12.5
+    monkeypatch.setattr(engine, "_download", download)
+    monkeypatch.setattr(engine, "_extract_or_match", extract)
+    monkeypatch.setattr(engine, "validate_file", lambda file_bytes: ("jpeg", 1))
+    return engine
+
+
+def rows(store):
+    archive.shutdown()
+    return sorted(store.query()["results"], key=lambda row: row["requestId"])
+
+
+def test_cache_hits_are_archived(store, engine):
+    # extraction, url cache hit, content cache hit (the same bytes uploaded)
+    assert asyncio.run(engine.execute_image({"img_url": [URL]}, "1-miss")) == 12.5
+    assert asyncio.run(engine.execute_image({"img_url": [URL]}, "2-url-hit")) == 12.5
+    assert asyncio.run(engine.execute_upload(FILE, "3-content-hit")) == 12.5
+    miss, url_hit, content_hit = rows(store)
+    digest = miss["contentHash"]
+    assert miss["duplicateOf"] is None and miss["fileType"] == "jpeg"
+    assert url_hit["duplicateOf"] == digest and url_hit["url"] == URL and url_hit["fileType"] is None
+    assert content_hit["duplicateOf"] == digest and content_hit["url"] is None
+    assert [row["total"] for row in (miss, url_hit, content_hit)] == [12.5, 12.5, 12.5]
+    assert store.query(search="total")["count"] == 1
+
+
+def test_query_opens_the_store_in_the_calling_thread(tmp_path, monkeypatch):
+    # the API runs `archive.query` through asyncio.to_thread: the DDL must not run on the event loop
+    monkeypatch.setattr(config, "ARCHIVE_DB_PATH", str(tmp_path / "archive.db"))
+    monkeypatch.setattr(archive, "_store", None)
+    opened = []
+    monkeypatch.setattr(archive, "ArchiveStore", lambda path, store=archive.ArchiveStore: opened.append(
+        threading.current_thread()) or store(path))
+
+    async def serve():
+        return await asyncio.to_thread(archive.query, None, None, None, None, None, 10, False)
+    assert asyncio.run(serve())["count"] == 0
+    assert opened and opened[0] is not threading.main_thread()
+
+
+def test_timings_from_parallel_threads(store):
+    archive.start_record()
+    # the stage pools run each call in a copy of the request's context, sharing its record
+    add = lambda: [archive.add_timing("ocr", 0.001) for _ in range(1000)]
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(add,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    archive.submit("r1", "abc", None, "jpeg", 1.0)
+    assert rows(store)[0]["timings"]["ocr"] == pytest.approx(8.0)
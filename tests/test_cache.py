@@ -0,0 +1,47 @@
+import asyncio
+import threading
+import pytest
+from src.cache import DiskStore, ResultCache
+
+
+@pytest.fixture
+def disk(tmp_path):
+    return DiskStore(str(tmp_path / "cache.db"), 100)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_disk_tier_runs_off_the_event_loop(disk, monkeypatch):
+    threads = []
+    for name in ("get_hash", "put_hash", "get_result", "put_result"):
+        method = getattr(disk, name)
+        monkeypatch.setattr(disk, name, lambda *args, method=method: threads.append(threading.current_thread()) or method(*args))
+    cache = ResultCache(16, 3600, disk)
+    run(cache.aput("http://x/a.jpeg", "abc", 12.5))
+    fresh = ResultCache(16, 3600, disk)
+    assert run(fresh.alookup_hash("http://x/a.jpeg")) == "abc"
+    assert run(fresh.aget("abc")) == 12.5
+    assert len(threads) == 4
+    assert threading.main_thread() not in threads
+
+
+def test_memory_hits_stay_inline(disk, monkeypatch):
+    cache = ResultCache(16, 3600, disk)
+    run(cache.aput("http://x/a.jpeg", "abc", 12.5))
+    monkeypatch.setattr("asyncio.to_thread", None)
+    assert run(cache.alookup_hash("http://x/a.jpeg")) == "abc"
+    assert run(cache.aget("abc")) == 12.5
+
+
+@pytest.mark.parametrize("with_disk", [False, True])
+def test_counters(with_disk, disk):
+    cache = ResultCache(16, 3600, disk if with_disk else None)
+    assert run(cache.alookup_hash("http://x/a.jpeg")) is None
+    assert run(cache.aget("abc")) is None
+    run(cache.aput("http://x/a.jpeg", "abc", 12.5))
+    assert run(cache.alookup_hash("http://x/a.jpeg")) == "abc"
+    assert run(cache.aget("abc")) == 12.5
+    stats = cache.stats()
+    assert (stats["urlHits"], stats["urlMisses"], stats["contentHits"], stats["contentMisses"]) == (1, 1, 1, 1)
@@ -0,0 +1,47 @@
+import asyncio
+import pytest
+from src import inferenceEngine
+from src.inferenceEngine import InferenceEngine
+from src.schemas import ErrorObject
+
+TEXT = "COFFEE 2,50\nTOTAL 12,50"
+
+
+@pytest.fixture(params=[True, False], ids=["parallel", "sequential"])
+def engine(request, monkeypatch):
+    monkeypatch.setattr(inferenceEngine, "CASCADE_ORDER", ["default", "otsu", "gray"])
+    monkeypatch.setattr(inferenceEngine, "CASCADE_PARALLEL", request.param)
+    monkeypatch.setattr(inferenceEngine, "EXECUTION_MODE", "pool")
+    engine = InferenceEngine()
+
+    async def run(stage, func, *args, inline=False):
+        return func(*args)
+    monkeypatch.setattr(engine, "_run", run)
+    monkeypatch.setattr(engine, "preprocess_variant", lambda gray, variant: variant)
+    return engine
+
+
+def read_with(engine, monkeypatch, texts):
+    # `texts` maps each variant to its OCR text, or to the status its OCR stage rejects it with
+    async def ocr_page(image, inline, layout=None):
+        await asyncio.sleep(0)
+        if texts[image].isdigit():
+            raise ErrorObject({"error": {"status": texts[image]}})
+        return texts[image]
+    monkeypatch.setattr(engine, "_ocr_page", ocr_page)
+    return asyncio.run(engine._cascade("page", False))
+
+
+@pytest.mark.parametrize("texts", [
+    {"default": "503", "otsu": TEXT, "gray": "504"},
+    {"default": TEXT, "otsu": "503", "gray": "503"},
+    {"default": "504", "otsu": "no total here", "gray": TEXT},
+])
+def test_failed_variants_are_left_out(engine, monkeypatch, texts):
+    assert read_with(engine, monkeypatch, texts) == TEXT
+
+
+def test_raises_when_every_variant_failed(engine, monkeypatch):
+    with pytest.raises(ErrorObject) as e:
+        read_with(engine, monkeypatch, {"default": "503", "otsu": "503", "gray": "503"})
+    assert e.value.error_obj.error.status == "503"
@@ -0,0 +1,59 @@
+import os
+import pytest
+from src import cpus
+
+
+def write(root, files):
+    for path, value in files.items():
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(value + "\n")
+
+
+@pytest.mark.parametrize("groups, files, expected", [
+    # cgroup v2: cpu.max is "<quota> <period>" or "max <period>"
+    ({"": "/"}, {"cpu.max": "150000 100000"}, 1.5),
+    ({"": "/"}, {"cpu.max": "max 100000"}, None),
+    ({"": "/"}, {}, None),
+    ({"": "/kubepods/pod1/ctr"}, {"kubepods/pod1/ctr/cpu.max": "max 100000",
+                                  "kubepods/pod1/cpu.max": "200000 100000"}, 2.0),    # the pod's quota applies
+    ({"": "/kubepods/pod1/ctr"}, {"kubepods/pod1/ctr/cpu.max": "50000 100000",
+                                  "kubepods/pod1/cpu.max": "200000 100000",
+                                  "cpu.max": "max 100000"}, 0.5),                     # the smallest one wins
+    ({"": "/"}, {"cpu.max": "50000"}, 0.5),                                           # default period
+    ({"": "/"}, {"cpu.max": "lots 100000"}, None),                                   # unparsable
+    # cgroup v1: cfs quota and period, -1 for none, under whichever cpu mount exists
+    ({"cpu": "/docker/abc", "cpuacct": "/docker/abc"},
+     {"cpu,cpuacct/docker/abc/cpu.cfs_quota_us": "50000", "cpu,cpuacct/docker/abc/cpu.cfs_period_us": "100000"}, 0.5),
+    ({"cpu": "/docker/abc"},
+     {"cpu/docker/abc/cpu.cfs_quota_us": "-1", "cpu/docker/abc/cpu.cfs_period_us": "100000"}, None),
+    ({"cpu": "/docker/abc"},
+     {"cpu/docker/abc/cpu.cfs_quota_us": "-1", "cpu/docker/abc/cpu.cfs_period_us": "100000",
+      "cpu/docker/cpu.cfs_quota_us": "300000", "cpu/docker/cpu.cfs_period_us": "100000"}, 3.0),
+    ({"cpu": "/docker/abc"}, {}, None),                                              # no cpu mount
+    ({}, {"cpu.max": "150000 100000"}, None),                                        # not in any cgroup
+])
+def test_cgroup_cpu_limit(groups, files, expected, tmp_path, monkeypatch):
+    write(tmp_path, files)
+    monkeypatch.setattr(cpus, "CGROUP_ROOT", str(tmp_path))
+    monkeypatch.setattr(cpus, "_own_cgroups", lambda: groups)
+    assert cpus.cgroup_cpu_limit() == expected
+
+
+@pytest.mark.parametrize("proc, expected", [
+    ("0::/kubepods/pod1/ctr", {"": "/kubepods/pod1/ctr"}),
+    ("4:cpu,cpuacct:/docker/abc\n3:memory:/docker/abc", {"cpu": "/docker/abc", "cpuacct": "/docker/abc",
+                                                         "memory": "/docker/abc"}),
+    ("", {}),
+])
+def test_own_cgroups(proc, expected, monkeypatch):
+    monkeypatch.setattr(cpus, "_read", lambda path: proc if path == "/proc/self/cgroup" else None)
+    assert cpus._own_cgroups() == expected
+
+
+@pytest.mark.parametrize("affinity, limit, expected", [(8, None, 8), (8, 1.5, 2), (8, 0.2, 1), (2, 4.0, 2)])
+def test_available_cpus(affinity, limit, expected, monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(affinity)))
+    monkeypatch.setattr(cpus, "cgroup_cpu_limit", lambda: limit)
+    assert cpus.available_cpus() == expected
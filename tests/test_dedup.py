@@ -0,0 +1,146 @@
+import asyncio
+import random
+import threading
+import pytest
+from src.dedup import BKTree, DedupIndex, hamming, informative
+
+BITS = 256
+
+
+def random_hash(rng):
+    # about half the bits set, so every hash is informative
+    return rng.getrandbits(BITS)
+
+
+def flip(phash, positions):
+    for position in positions:
+        phash ^= 1 << position
+    return phash
+
+
+def test_hamming():
+    assert hamming(0b1011, 0b1011) == 0
+    assert hamming(0b1011, 0b0010) == 2
+    assert hamming(0, (1 << BITS) - 1) == BITS
+
+
+@pytest.mark.parametrize("ones, expected", [(0, False), (15, False), (16, True), (128, True), (240, True), (241, False)])
+def test_informative(ones, expected):
+    assert informative((1 << ones) - 1, BITS) is expected
+
+
+def test_empty_tree():
+    assert BKTree().nearest(123, 10) is None
+
+
+@pytest.mark.parametrize("radius", [0, 1, 4, 10, 40])
+def test_nearest_matches_brute_force(radius):
+    rng = random.Random(radius)
+    base = [random_hash(rng) for _ in range(20)]
+    # clusters of near-duplicates around random hashes, so small radii have something to find
+    keys = base + [flip(key, rng.sample(range(BITS), rng.randint(1, 12))) for key in base for _ in range(5)]
+    tree = BKTree()
+    for i, key in enumerate(keys):
+        tree.add(key, i)
+    assert tree.size == len(keys)
+    for _ in range(50):
+        query = flip(rng.choice(keys), rng.sample(range(BITS), rng.randint(0, 8)))
+        expected = min((hamming(query, key) for key in keys if hamming(query, key) <= radius), default=None)
+        found = tree.nearest(query, radius)
+        if expected is None:
+            assert found is None
+        else:
+            distance, key, value = found
+            assert distance == expected == hamming(query, key)
+            assert keys[value] == key
+
+
+def test_radius_is_inclusive():
+    tree = BKTree()
+    key = random_hash(random.Random(1))
+    tree.add(key, "a")
+    near = flip(key, [0, 1, 2])
+    assert tree.nearest(near, 2) is None
+    assert tree.nearest(near, 3) == (3, key, "a")
+
+
+def test_index_lookup_and_add():
+    rng = random.Random(2)
+    index = DedupIndex(max_distance=6, max_entries=100)
+    phash = random_hash(rng)
+    assert index.lookup(phash, BITS) is None
+    index.add(phash, BITS, "digest-1", 41.32)
+    assert index.lookup(flip(phash, [3, 70, 200]), BITS) == {"contentHash": "digest-1", "distance": 3, "result": 41.32}
+    assert index.lookup(flip(phash, range(7)), BITS) is None
+    assert index.stats()["hits"] == 1
+    assert index.stats()["misses"] == 2
+
+
+def test_uninformative_hashes_are_neither_stored_nor_matched():
+    index = DedupIndex(max_distance=6, max_entries=100)
+    index.add(0, BITS, "blank", 0.0)
+    assert index.stats()["entries"] == 0
+    assert index.lookup(0, BITS) is None
+    assert index.stats()["skipped"] == 1
+
+
+def test_eviction_keeps_the_newest_half():
+    rng = random.Random(3)
+    hashes = [random_hash(rng) for _ in range(11)]
+    index = DedupIndex(max_distance=0, max_entries=10)
+    for i, phash in enumerate(hashes):
+        index.add(phash, BITS, f"digest-{i}", i)
+    assert index.stats()["entries"] == 5
+    for i, phash in enumerate(hashes):
+        match = index.lookup(phash, BITS)
+        assert (match is not None) == (i >= 6), i
+
+
+def test_sqlite_round_trip(tmp_path):
+    rng = random.Random(4)
+    path = str(tmp_path / "dedup.db")
+    phash = random_hash(rng)
+    DedupIndex(max_distance=6, max_entries=100, path=path).add(phash, BITS, "digest-1", {"total": 9.5})
+    reopened = DedupIndex(max_distance=6, max_entries=100, path=path)
+    assert reopened.stats()["entries"] == 1
+    assert reopened.lookup(flip(phash, [5]), BITS) == {"contentHash": "digest-1", "distance": 1, "result": {"total": 9.5}}
+
+
+def test_workers_see_each_others_entries(tmp_path):
+    rng = random.Random(5)
+    path = str(tmp_path / "dedup.db")
+    first = DedupIndex(max_distance=6, max_entries=100, path=path, sync_every=0)
+    second = DedupIndex(max_distance=6, max_entries=100, path=path, sync_every=0)
+    phash = random_hash(rng)
+    first.add(phash, BITS, "digest-1", 1.0)
+    assert second.lookup(phash, BITS)["contentHash"] == "digest-1"
+
+
+def test_eviction_is_persisted(tmp_path):
+    rng = random.Random(6)
+    path = str(tmp_path / "dedup.db")
+    index = DedupIndex(max_distance=0, max_entries=4, path=path)
+    hashes = [random_hash(rng) for _ in range(5)]
+    for i, phash in enumerate(hashes):
+        index.add(phash, BITS, f"digest-{i}", i)
+    reopened = DedupIndex(max_distance=0, max_entries=4, path=path)
+    assert reopened.stats()["entries"] == 2
+    assert reopened.lookup(hashes[-1], BITS)["contentHash"] == "digest-4"
+    assert reopened.lookup(hashes[0], BITS) is None
+
+
+def test_disk_index_runs_sqlite_off_the_event_loop(tmp_path, monkeypatch):
+    path = str(tmp_path / "dedup.db")
+    index = DedupIndex(max_distance=6, max_entries=100, path=path, sync_every=0)
+    threads = []
+    for name in ("_sync", "add"):
+        method = getattr(index, name)
+        monkeypatch.setattr(index, name, lambda *args, method=method: threads.append(threading.current_thread()) or method(*args))
+    phash = random_hash(random.Random(7))
+
+    async def serve():
+        assert await index.alookup(phash, BITS) is None
+        await index.aadd(phash, BITS, "digest-1", 2.5)
+        return await index.alookup(flip(phash, [1]), BITS)
+    assert asyncio.run(serve())["contentHash"] == "digest-1"
+    assert threads and threading.main_thread() not in threads
@@ -0,0 +1,29 @@
+import pytest
+from src.config import MAX_FILE_SIZE_BYTES
+from src.inferenceEngine import InferenceEngine
+from src.schemas import ErrorObject
+
+
+@pytest.fixture
+def engine():
+    return InferenceEngine()
+
+
+@pytest.mark.parametrize("size, expected", [
+    (None, 0),
+    ("", 0),
+    ("1234", 1234),
+    (1234, 1234),
+    ("12abc", 0),          # malformed headers are treated as unknown
+    ("1234, 1234", 0),
+    ("-", 0),
+])
+def test_check_size(engine, size, expected):
+    assert engine._check_size(size) == expected
+
+
+@pytest.mark.parametrize("size", [MAX_FILE_SIZE_BYTES + 1, str(MAX_FILE_SIZE_BYTES + 1)])
+def test_check_size_over_the_limit(engine, size):
+    with pytest.raises(ErrorObject) as e:
+        engine._check_size(size)
+    assert e.value.error_obj.error.status == "413"
@@ -0,0 +1,31 @@
+import pytest
+from fastapi.testclient import TestClient
+from src import app as app_module
+from src import archive
+from src.app import app, MEMORY_ENDPOINT, ARCHIVE_ENDPOINT
+
+# endpoints that need no OCR; the lifespan (warm-up) is not run
+client = TestClient(app)
+
+
+def test_memory_growth_without_snapshot():
+    response = client.get(f"{MEMORY_ENDPOINT}/growth")
+    assert response.status_code == 404
+    assert "no memory snapshot" in response.json()["error"]["msg"]
+
+
+def test_archive_disabled(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "ARCHIVE_ENABLED", False)
+    monkeypatch.setattr(app_module, "ARCHIVE_DB_PATH", str(tmp_path / "missing.db"))
+    response = client.get(ARCHIVE_ENDPOINT)
+    assert response.status_code == 404
+    assert response.json()["error"]["msg"] == "results archive is disabled (ARCHIVE_ENABLED)"
+
+
+@pytest.mark.parametrize("params", [{"q": 'AND"'}, {"since": "yesterday"}])
+def test_archive_invalid_query(params, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "ARCHIVE_ENABLED", True)
+    monkeypatch.setattr(archive, "_store", archive.ArchiveStore(str(tmp_path / "archive.db")))
+    response = client.get(ARCHIVE_ENDPOINT, params=params)
+    assert response.status_code == 422
+    assert response.json()["error"]["msg"].startswith("invalid archive query")
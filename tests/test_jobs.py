@@ -0,0 +1,25 @@
+import sqlite3
+from src import jobs
+
+
+def test_submit_keeps_the_traceparent(tmp_path):
+    store = jobs.JobStore(str(tmp_path / "jobs.db"))
+    traceparent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+    job_id = store.submit("http://receipts/a.jpeg", "r1", None, traceparent)
+    assert store.get(job_id)["traceparent"] == traceparent
+    assert "traceparent" not in jobs.public_view(store.get(job_id))
+
+
+def test_job_file_without_traceparent_is_migrated(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE jobs (
+        id TEXT PRIMARY KEY, status TEXT NOT NULL, img_url TEXT NOT NULL, request_id TEXT,
+        callback_url TEXT, result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0,
+        worker TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)""")
+    conn.execute("INSERT INTO jobs (id, status, img_url, created_at, updated_at) VALUES ('old', 'queued', 'http://x', 1, 1)")
+    conn.commit()
+    conn.close()
+    store = jobs.JobStore(path)
+    assert store.claim("test")["traceparent"] is None
+    assert store.get(store.submit("http://receipts/a.jpeg", traceparent="00-" + "1" * 32 + "-" + "2" * 16 + "-00"))["traceparent"]
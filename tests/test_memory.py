@@ -0,0 +1,33 @@
+import pytest
+from src.memory import MB, MemoryWatchdog
+
+
+def watchdog(jitter, max_rss_mb=1000, max_growth=100):
+    return MemoryWatchdog(max_rss_mb, max_growth, 1800, 10, jitter)
+
+
+def test_no_jitter_keeps_the_limits():
+    dog = watchdog(0)
+    assert (dog.max_rss, dog.max_growth) == (1000 * MB, 100)
+
+
+@pytest.mark.parametrize("jitter", [0.05, 0.1, 0.5])
+def test_limits_are_lowered_within_the_jitter(jitter):
+    dogs = [watchdog(jitter) for _ in range(50)]
+    for dog in dogs:
+        assert 1000 * MB * (1 - jitter) <= dog.max_rss <= 1000 * MB
+        assert dog.max_rss / (1000 * MB) == pytest.approx(dog.max_growth / 100)
+    # workers get limits of their own
+    assert len({dog.max_rss for dog in dogs}) > 40
+
+
+def test_disabled_limits_stay_disabled():
+    dog = watchdog(0.1, max_rss_mb=0, max_growth=0)
+    assert (dog.max_rss, dog.max_growth) == (0, 0)
+    assert dog.check(10_000 * MB) is None
+
+
+def test_check_uses_the_lowered_ceiling():
+    dog = watchdog(0.1)
+    assert dog.check(dog.max_rss) is None
+    assert dog.check(dog.max_rss + 1) == "rss_ceiling"
@@ -0,0 +1,64 @@
+import threading
+from src import archive
+from src.metrics import ARCHIVE_ROWS
+from src.persistence import BatchWriter, ProcessLocal, wal_connection
+
+
+class ListWriter(BatchWriter):
+    def __init__(self, max_queue=100, batch_size=None):
+        self.batches = []
+        super().__init__(3600, max_queue, ARCHIVE_ROWS, batch_size)
+
+    def write(self, batch):
+        self.batches.append(batch)
+
+
+def test_flush_in_batches():
+    writer = ListWriter(batch_size=2)
+    for record in range(5):
+        writer.put(record)
+    writer.shutdown()
+    assert writer.batches == [[0, 1], [2, 3], [4]]
+
+
+def test_full_queue_drops():
+    writer = ListWriter(max_queue=2)
+    dropped = ARCHIVE_ROWS.labels("dropped")._value.get()
+    for record in range(3):
+        writer.put(record)
+    writer.shutdown()
+    assert writer.batches == [[0, 1]]
+    assert ARCHIVE_ROWS.labels("dropped")._value.get() == dropped + 1
+
+
+def test_process_local_builds_once():
+    built = []
+    slot = ProcessLocal(lambda: built.append(ListWriter()) or built[-1])
+    assert slot.get() is slot.get()
+    slot.shutdown()
+    assert len(built) == 1
+    assert slot.get() is not built[0]
+    slot.shutdown()
+
+
+def test_wal_connection_per_thread(tmp_path):
+    local = threading.local()
+    path = str(tmp_path / "store.db")
+    conn = wal_connection(local, path, 5, rows=True)
+    assert wal_connection(local, path, 5) is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    other = []
+    thread = threading.Thread(target=lambda: other.append(wal_connection(local, path, 5)))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+
+def test_archive_writer_round_trip(tmp_path):
+    store = archive.ArchiveStore(str(tmp_path / "archive.db"))
+    writer = archive.ArchiveWriter(store, 10, 3600, 100)
+    writer.put((1.0, "r1", "abc", "http://x/a.jpeg", "jpeg", 12.5, None, "TOTAL 12,50", "{}"))
+    writer.shutdown()
+    found = store.query(min_total=10, search="total")
+    assert found["count"] == 1
+    assert found["results"][0]["requestId"] == "r1"
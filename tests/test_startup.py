@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(code, **env):
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=dict(os.environ, **env),
+                          capture_output=True, text=True, timeout=120)
+
+
+def test_metrics_create_the_multiprocess_dir(tmp_path):
+    # the Dockerfile sets PROMETHEUS_MULTIPROC_DIR; the app is imported (--preload) before any hook runs
+    path = tmp_path / "prometheus_multiproc"
+    proc = run_python("import src.metrics", PROMETHEUS_MULTIPROC_DIR=str(path))
+    assert proc.returncode == 0, proc.stderr
+    assert path.is_dir()
+
+
+def test_job_worker_imports_with_the_image_environment(tmp_path):
+    # `python -m src.jobs` runs from the API image and inherits its PROMETHEUS_MULTIPROC_DIR
+    proc = run_python("import src.jobs", PROMETHEUS_MULTIPROC_DIR=str(tmp_path / "missing"))
+    assert proc.returncode == 0, proc.stderr
+
+
+def test_job_worker_imports_with_the_compose_environment():
+    # docker-compose.yml unsets PROMETHEUS_MULTIPROC_DIR for the job worker service
+    proc = run_python("import src.jobs, src.metrics, prometheus_client.values as values; "
+                      "assert not src.metrics.MULTIPROCESS; assert values.ValueClass is values.MutexValue",
+                      PROMETHEUS_MULTIPROC_DIR="")
+    assert proc.returncode == 0, proc.stderr
+
+
+def test_preloaded_master_starts_no_threads():
+    # with --preload gunicorn forks workers from this process: it must not have started any
+    # (OpenMP, OpenCV, exporter ...) thread by then
+    code = ("import os, src.gunicorn_conf, src.app; "
+            "print(len(os.listdir('/proc/self/task')))")
+    proc = run_python(code)
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip().splitlines()[-1] == "1"
+
+
+@pytest.mark.parametrize("workers, warned", [(None, False), (3, True)])
+def test_workers_flag_is_reported(workers, warned):
+    # `--workers` is applied after the config file has exported WEB_CONCURRENCY
+    code = ("import types; from src import gunicorn_conf as conf; warnings = []; "
+            f"cfg = types.SimpleNamespace(workers={workers} or conf.workers); "
+            "conf.on_starting(types.SimpleNamespace(cfg=cfg, log=types.SimpleNamespace(warning=warnings.append))); "
+            "print(warnings)")
+    proc = run_python(code, WEB_CONCURRENCY="2", PROMETHEUS_MULTIPROC_DIR="")
+    assert proc.returncode == 0, proc.stderr
+    assert ("--workers 3 differs from WEB_CONCURRENCY=2" in proc.stdout) is warned
@@ -0,0 +1,46 @@
+import asyncio
+import io
+import pytest
+from PIL import Image
+from src import imaging
+from src.config import MAX_TIFF_PAGES
+from src.inferenceEngine import InferenceEngine
+from src.schemas import ErrorObject
+
+
+def tiff(frames):
+    images = [Image.new("L", (64, 48), 255) for _ in range(frames)]
+    buf = io.BytesIO()
+    images[0].save(buf, format="TIFF", save_all=True, append_images=images[1:])
+    return buf.getvalue()
+
+
+@pytest.fixture
+def engine():
+    return InferenceEngine()
+
+
+@pytest.mark.parametrize("frames", [1, 3, MAX_TIFF_PAGES])
+def test_validate_file_counts_frames(engine, frames):
+    assert engine.validate_file(tiff(frames)) == ("tif", frames)
+
+
+def test_validate_file_rejects_long_tiff(engine):
+    with pytest.raises(ErrorObject) as e:
+        engine.validate_file(tiff(MAX_TIFF_PAGES + 1))
+    assert e.value.error_obj.error.status == "422"
+
+
+def test_frames_counted_once(engine, monkeypatch):
+    calls = []
+    count = imaging.tiff_frame_count
+    monkeypatch.setattr(imaging, "tiff_frame_count", lambda buf: calls.append(1) or count(buf))
+
+    async def read_page(page, inline, layout=None):
+        return f"frame {page.shape}"
+    monkeypatch.setattr(engine, "_read_page", read_page)
+    file_bytes = tiff(3)
+    ext, pages = engine.validate_file(file_bytes)
+    text = asyncio.run(engine._extract_text(file_bytes, ext, pages, inline=True))
+    assert len(text.splitlines()) == 3
+    assert len(calls) == 1
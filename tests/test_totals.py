@@ -0,0 +1,63 @@
+import pytest
+from src.totals import extract_total
+
+
+@pytest.mark.parametrize("line, amount", [
+    # currency signs, with and without a space
+    ("TOTAL $12.50", 12.50),
+    ("Total: € 8.99", 8.99),
+    ("TOTAL £1,204.00", 1204.00),
+    ("Total ₹ 450.00", 450.00),
+    # thousands separators
+    ("TOTAL 1,234.56", 1234.56),
+    ("TOTAL 1.234,56", 1234.56),
+    ("TOTAL 1 234,56", 1234.56),
+    ("TOTAL 12'345.60", 12345.60),
+    # decimal commas
+    ("TOTAL 41,32", 41.32),
+    ("Summe total 7,5", 7.5),
+    # the right-most amount of the line
+    ("TOTAL 3 items 27.10", 27.10),
+])
+def test_amount_formats(line, amount):
+    assert extract_total(line).total == amount
+
+
+@pytest.mark.parametrize("line", [
+    "TOTAL 1,234",        # a comma with 3 digits is a thousands separator, not a decimal
+    "TOTAL 42",           # no decimal part
+    "Thank you for shopping",
+    "",
+])
+def test_lines_without_an_amount(line):
+    extraction = extract_total(line)
+    assert extraction.total == 0.0
+    assert extraction.candidates == []
+
+
+@pytest.mark.parametrize("text, total, keyword", [
+    ("SUBTOTAL 10.00\nTAX 0.80\nTOTAL 10.80", 10.80, "total"),
+    ("Sub-total 10.00\nGrand Total 10.80", 10.80, "grand total"),
+    ("Sub Total 55.00\nAmount 20.00", 55.00, "subtotal"),
+    ("ITEM 99.99\nTOTAL 12.00", 12.00, "total"),
+    ("Balance due 7.25\nCash 10.00\nChange 2.75", 7.25, "balance due"),
+    # on a tie the stronger keyword is the source
+    ("Amount 5.00\nTOTAL 5.00", 5.00, "total"),
+])
+def test_picks_the_total_line(text, total, keyword):
+    extraction = extract_total(text)
+    assert extraction.total == total
+    assert extraction.sourceLine in text.splitlines()
+    assert any(c.keyword == keyword and c.line == extraction.sourceLine for c in extraction.candidates)
+
+
+@pytest.mark.parametrize("text, confidence", [
+    ("TOTAL 10.80", 0.6),
+    ("Grand Total 10.80", 0.7),
+    ("SUBTOTAL 10.80\nTOTAL 10.80", 0.8),      # another line agrees
+    ("TOTAL $10.80", 0.7),                      # currency sign
+    ("Grand Total $10.80\nTOTAL 10.80", 1.0),   # capped
+    ("SUBTOTAL 3.00", 0.3),
+])
+def test_confidence(text, confidence):
+    assert extract_total(text).confidence == confidence
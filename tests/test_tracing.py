@@ -0,0 +1,192 @@
+import asyncio
+import uuid
+import pytest
+from fastapi.testclient import TestClient
+from src import app as app_module
+from src import inferenceEngine
+from src import jobs
+from src import tracing
+from src.app import app, BATCH_ENDPOINT, JOBS_ENDPOINT, MEMORY_ENDPOINT
+
+client = TestClient(app)
+SAMPLED = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    exported = []
+
+    class Exporter:
+        def export(self, finished):
+            exported.append(finished.to_dict())
+    monkeypatch.setattr(tracing, "ENABLED", True)
+    monkeypatch.setattr(tracing, "get_exporter", lambda exporter=Exporter(): exporter)
+    return exported
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    class Engine:
+        async def execute_image(self, request, request_id=None, meta=None):
+            with tracing.span("stage"):
+                await asyncio.sleep(0.05)
+            return 12.5
+    monkeypatch.setattr(app_module, "get_engine", lambda engine=Engine(): engine)
+
+
+def test_streamed_batch_root_span_ends_with_the_body(spans, engine):
+    body = {"img_url": ["http://receipts/a.jpeg", "http://receipts/b.jpeg"], "stream": True}
+    response = client.post(BATCH_ENDPOINT, json=body, headers={"traceparent": SAMPLED})
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 2
+    root = next(span for span in spans if span["name"] == "http.request")
+    stages = [span for span in spans if span["name"] == "stage"]
+    assert len(stages) == 2
+    assert all(stage["parentSpanId"] is not None for stage in stages)
+    assert root["endTimeUnixNano"] >= max(stage["endTimeUnixNano"] for stage in stages)
+    assert root["error"] is None
+
+
+def test_job_joins_the_trace_of_its_request(spans, monkeypatch, tmp_path):
+    store = jobs.JobStore(str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(jobs, "_store", store)
+    response = client.post(JOBS_ENDPOINT, json={"img_url": ["http://receipts/a.jpeg"]}, headers={"traceparent": SAMPLED})
+    assert response.status_code == 202
+    root = next(span for span in spans if span["name"] == "http.request")
+    job = store.claim("test")
+    assert job["traceparent"] == f"00-{root['traceId']}-{root['spanId']}-01"
+
+    class Engine:
+        async def execute_image(self, request, request_id=None, meta=None):
+            return 12.5
+    monkeypatch.setattr(inferenceEngine, "get_engine", lambda: Engine())
+    asyncio.run(jobs._run_job(store, job))
+    consumer = next(span for span in spans if span["name"] == "job")
+    assert (consumer["traceId"], consumer["parentSpanId"]) == (root["traceId"], root["spanId"])
+
+
+TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+SPAN_ID = "b7ad6b7169203331"
+
+
+@pytest.mark.parametrize("header, expected", [
+    (f"00-{TRACE_ID}-{SPAN_ID}-01", (TRACE_ID, SPAN_ID, True)),
+    (f"00-{TRACE_ID}-{SPAN_ID}-00", (TRACE_ID, SPAN_ID, False)),
+    (f"00-{TRACE_ID}-{SPAN_ID}-03", (TRACE_ID, SPAN_ID, True)),      # other flags besides sampled
+    (f"00-{TRACE_ID}-{SPAN_ID}-02", (TRACE_ID, SPAN_ID, False)),
+    (f" 00-{TRACE_ID.upper()}-{SPAN_ID}-01 ", (TRACE_ID, SPAN_ID, True)),
+    (f"00-{'0' * 32}-{SPAN_ID}-01", None),                          # all-zero trace id
+    (f"00-{TRACE_ID}-{'0' * 16}-01", None),                         # all-zero parent id
+    (f"01-{TRACE_ID}-{SPAN_ID}-01", None),                          # unknown version
+    (f"00-{TRACE_ID[:-1]}-{SPAN_ID}-01", None),
+    (f"00-{TRACE_ID}-{SPAN_ID}-1", None),
+    (f"00-{TRACE_ID}-{SPAN_ID}-01-extra", None),
+    (f"00-{TRACE_ID[:-1]}g-{SPAN_ID}-01", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_traceparent(header, expected):
+    assert tracing.parse_traceparent(header) == expected
+
+
+@pytest.mark.parametrize("enabled, header, rate, sampled, parent", [
+    (False, f"00-{TRACE_ID}-{SPAN_ID}-01", 1.0, False, None),       # no exporter configured
+    (True, f"00-{TRACE_ID}-{SPAN_ID}-01", 0.0, True, SPAN_ID),      # the caller's decision wins
+    (True, f"00-{TRACE_ID}-{SPAN_ID}-00", 1.0, False, None),
+    (True, None, 1.0, True, None),
+    (True, None, 0.0, False, None),
+    (True, "garbage", 1.0, True, None),                             # invalid header: sampled locally
+])
+def test_sampling_decision(enabled, header, rate, sampled, parent, monkeypatch):
+    monkeypatch.setattr(tracing, "ENABLED", enabled)
+    monkeypatch.setattr(tracing.config, "TRACE_SAMPLE_RATE", rate)
+    root = tracing.trace("http.request", header)
+    if not sampled:
+        assert root is tracing.NOOP
+        return
+    assert root.parent_id == parent
+    if parent is not None:
+        assert root.trace_id == TRACE_ID
+    assert len(root.trace_id) == 32 and len(root.span_id) == 16
+
+
+def test_child_spans_follow_the_root(spans):
+    with tracing.trace("job", f"00-{TRACE_ID}-{SPAN_ID}-01") as root:
+        with tracing.span("stage") as child:
+            assert tracing.headers() == {"traceparent": child.traceparent}
+    assert tracing.span("outside") is tracing.NOOP
+    assert [(span["name"], span["parentSpanId"]) for span in spans] == [("stage", root.span_id), ("job", SPAN_ID)]
+    assert {span["traceId"] for span in spans} == {TRACE_ID}
+
+
+@pytest.mark.parametrize("value, encoded", [
+    (True, {"boolValue": True}),
+    (3, {"intValue": "3"}),
+    (2.5, {"doubleValue": 2.5}),
+    ("jpeg", {"stringValue": "jpeg"}),
+    ([1, 2], {"stringValue": "[1, 2]"}),
+])
+def test_otlp_values(value, encoded):
+    assert tracing._otlp_value(value) == encoded
+
+
+@pytest.mark.parametrize("error, parent, status", [(None, SPAN_ID, 1), ("503", None, 2)])
+def test_to_otlp(error, parent, status):
+    record = {"traceId": TRACE_ID, "spanId": "1" * 16, "parentSpanId": parent, "name": "ocr", "kind": tracing.KIND_INTERNAL,
+              "startTimeUnixNano": 10, "endTimeUnixNano": 25, "error": error, "attributes": {"ocr.chars": 12, "skip": None}}
+    body = tracing.to_otlp([record], {"service.name": "receipts"})
+    resource_spans = body["resourceSpans"][0]
+    assert resource_spans["resource"]["attributes"] == [{"key": "service.name", "value": {"stringValue": "receipts"}}]
+    encoded = resource_spans["scopeSpans"][0]["spans"][0]
+    assert (encoded["startTimeUnixNano"], encoded["endTimeUnixNano"]) == ("10", "25")
+    assert encoded["status"] == {"code": status}
+    assert encoded.get("parentSpanId") == parent
+    attributes = {item["key"]: item["value"] for item in encoded["attributes"]}
+    assert attributes["ocr.chars"] == {"intValue": "12"}
+    assert "skip" not in attributes
+    assert ("error" in attributes) == (error is not None)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("abc-123", "abc-123"),
+    ("  abc  ", "abc"),
+    ("x" * 128, "x" * 128),
+    ("x" * 129, None),
+    ("a\nb", None),
+    ("a\x00b", None),
+    ("   ", None),
+    ("", None),
+    (None, None),
+])
+def test_valid_request_id(value, expected):
+    assert app_module._valid_request_id(value) == expected
+
+
+@pytest.mark.parametrize("header, echoed", [
+    ("caller-id", "caller-id"),
+    ("bad\x7fid", None),
+    (None, None),
+])
+def test_request_id_header_is_echoed(header, echoed):
+    response = client.get(f"{MEMORY_ENDPOINT}/growth", headers={"X-Request-ID": header} if header else {})
+    if echoed is not None:
+        assert response.headers["X-Request-ID"] == echoed
+    else:
+        assert str(uuid.UUID(response.headers["X-Request-ID"])) == response.headers["X-Request-ID"]
+
+
+@pytest.mark.parametrize("header, body, expected", [
+    ("header-id", "body-id", "body-id"),      # the body's requestId wins over the header
+    ("header-id", None, "header-id"),
+    (None, "body-id", "body-id"),
+    ("header-id", "x" * 129, "header-id"),    # an invalid body id is ignored
+])
+def test_body_request_id_is_adopted(header, body, expected, monkeypatch, tmp_path):
+    monkeypatch.setattr(jobs, "_store", jobs.JobStore(str(tmp_path / "jobs.db")))
+    payload = {"img_url": ["http://receipts/a.jpeg"]}
+    if body is not None:
+        payload["requestId"] = body
+    response = client.post(JOBS_ENDPOINT, json=payload, headers={"X-Request-ID": header} if header else {})
+    assert response.status_code == 202
+    assert response.headers["X-Request-ID"] == expected
+    assert response.json()["requestId"] == expected